@@ -0,0 +1,613 @@
+"""
+Benchmarks, run with `python benchmarks.py [name ...]`
+
+Timings are in seconds per operation, the best of a few repeats.
+`--save results.json` writes them as JSON, and `--compare baseline.json`
+reports the timings slower than the baseline by more than --tolerance,
+exiting with status 1 if there are any.
+"""
+import argparse
+import datetime
+import hmac
+import io
+import itertools
+import json
+import os
+import pathlib
+import platform
+import sys
+import tempfile
+import timeit
+import urllib.parse
+import warnings
+
+import yaml
+
+from trustx import (SecretKey, TTLCache, __version__, base58decode,
+                    base58decode_many, base58encode, base58encode_many,
+                    hashfunc)
+from trustx import metrics
+from trustx.exports import Exporter
+from trustx.metrics import InstrumentedStorage, Metrics
+from trustx.profilers import Profiler
+from trustx.profiles import (Block, Blocks, Profile, Profiles, YAMLLoader,
+                             _stringify_yaml, iter_blocks)
+from trustx.servers import WSGI, jsonify, wsgi
+from trustx.sessions import HMACSessionFactory, Session, joinb, splitb
+from trustx.storages import CODECS, LocalStorage
+
+BENCHMARKS = {}
+
+# Values reported by name, as saved by --save
+RESULTS = {}
+
+# Numbers of stored entities of the storage benchmarks, set by --entities
+ENTITIES = [10 ** 3, 10 ** 4]
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__[len('bench_'):]] = f
+    return f
+
+
+def measure(f, repeat=3):
+    timer = timeit.Timer(f)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def format_time(seconds):
+    return f'{seconds * 1e6:.1f}us' if seconds < 1 else f'{seconds:.3f}s'
+
+
+def report(name, **values):
+    RESULTS[name] = values
+    fields = []
+    for k, v in values.items():
+        if isinstance(v, float):
+            v = format_time(v)
+        fields.append(f'{k}={v}')
+    print(f'{name:<40}', *fields)
+
+
+def make_profile_entity(n_blocks):
+    tz = datetime.timezone(datetime.timedelta(hours=9))
+    by, to = b'\x02' + os.urandom(32), b'\x03' + os.urandom(32)
+    blocks = {}
+    for i in range(n_blocks):
+        blocks[os.urandom(64)] = dict(by=by, to=to, data=dict(
+            skills={f'skill{i}': dict(level=i % 5)},
+            signed=datetime.datetime(2020, 1, 1, tzinfo=tz)))
+    return dict(id=os.urandom(16).hex(), name='user', key='1' * 34,
+                hook='https://hooks.example.com/user', blocks=blocks)
+
+
+@benchmark
+def bench_codecs():
+    for n_blocks in (10, 100, 1000):
+        entity = make_profile_entity(n_blocks)
+        for codec in CODECS.values():
+            data = codec.dumps(entity)
+            report(f'codecs/{codec.name}/{n_blocks}',
+                   dumps=measure(lambda: codec.dumps(entity)),
+                   loads=measure(lambda: codec.loads(data)),
+                   size=len(data))
+
+
+@benchmark
+def bench_storage():
+    entity = make_profile_entity(10)
+    for n_entities in ENTITIES:
+        with tempfile.TemporaryDirectory() as path:
+            kind = LocalStorage(pathlib.Path(path)).profiles
+            for i in range(n_entities):
+                kind.put(dict(entity, id=f'{i:032x}'))
+            last = dict(entity, id=f'{n_entities - 1:032x}')
+            report(f'storage/local/{n_entities}',
+                   get=measure(lambda: kind.get(last['id'])),
+                   put=measure(lambda: kind.put(last)),
+                   iter=measure(lambda: sum(1 for _ in kind), 1))
+
+
+@benchmark
+def bench_keys():
+    sk = SecretKey()
+    pk = sk.public_key
+    data = os.urandom(100)
+    signature = sk.sign(data)
+    forged = sk.sign(os.urandom(100))
+    pk.hash
+
+    def first_hash():
+        # Forget the keyhash memoized on the interned key
+        object.__delattr__(pk, '_hash')
+        return pk.hash
+
+    report('keys/sign', sign=measure(lambda: sk.sign(data)))
+    report('keys/verify',
+           valid=measure(lambda: pk.verify(signature, data=data)),
+           invalid=measure(lambda: pk.verify(forged, data=data)))
+    report('keys/hash', first=measure(first_hash),
+           memoized=measure(lambda: pk.hash))
+
+
+@benchmark
+def bench_base58():
+    try:
+        import base58 as b58
+    except ImportError:
+        b58 = None
+    for name, n in (('key', 33), ('keyhash', 25), ('signature', 64),
+                    ('token', 100)):
+        data = os.urandom(n)
+        encoded = base58encode(data)
+        values = dict(encode=measure(lambda: base58encode(data)),
+                      decode=measure(lambda: base58decode(encoded)))
+        if b58:
+            values.update(
+                b58_encode=measure(lambda: b58.b58encode(data)),
+                b58_decode=measure(lambda: b58.b58decode(encoded)))
+        report(f'base58/{name}/{n}', **values)
+    items = [os.urandom(64) for _ in range(100)]
+    encoded = base58encode_many(items)
+    report('base58/many/signature/100',
+           encode=measure(lambda: base58encode_many(items)) / 100,
+           decode=measure(lambda: base58decode_many(encoded)) / 100)
+
+
+@benchmark
+def bench_blocks():
+    pk = SecretKey().public_key
+    entity = make_profile_entity(1)
+    data = next(iter(entity['blocks'].values()))['data']
+
+    def make_block():
+        block = Block()
+        block.by, block.to, block.data = pk, pk, data
+        return block
+
+    block = make_block()
+    report('blocks/message',
+           first=measure(lambda: make_block().message),
+           repeated=measure(lambda: block.message))
+    for n_blocks in (100, 2000):
+        blocks = Blocks(make_profile_entity(n_blocks)['blocks'])
+        report(f'blocks/render/{n_blocks}',
+               iterate=measure(lambda: list(blocks)),
+               jsonify=measure(lambda: jsonify(blocks)))
+    with tempfile.TemporaryDirectory() as path:
+        profiles = Profiles(LocalStorage(pathlib.Path(path)))
+        for n_blocks in (100, 2000):
+            profile = Profile()
+            for block in Blocks(make_profile_entity(n_blocks)['blocks']):
+                profile.blocks.add(block, verify=False)
+            profiles.put(profile)
+
+            def append():
+                profile = profiles.get(profile_id)
+                block = make_block()
+                block.signature = os.urandom(64)
+                profile.blocks.add(block, verify=False)
+                profiles.put(profile)
+
+            profile_id = profile.id
+            report(f'blocks/append/{n_blocks}', append=measure(append))
+
+
+@benchmark
+def bench_parse_blocks():
+    sk = SecretKey()
+    pk = sk.public_key
+    tz = datetime.timezone(datetime.timedelta(hours=9))
+    with tempfile.TemporaryDirectory() as path:
+        profiles = Profiles(LocalStorage(pathlib.Path(path)))
+        profile = Profile()
+        profile.key = pk
+        profiles.put(profile)
+        for n_blocks in (1, 10, 100, 1000):
+            blocks = {}
+            for i in range(n_blocks):
+                block = Block()
+                block.by, block.to = pk, pk
+                block.data = dict(
+                    skills={f'skill{i}': dict(level=i % 5)},
+                    signed=datetime.datetime(2020, 1, 1, tzinfo=tz))
+                signature = base58encode(sk.sign(block.message))
+                blocks[signature] = dict(by=pk.hash, to=pk.hash,
+                                         data=block.data)
+            report(f'profiles/parse_blocks/{n_blocks}',
+                   verify=measure(lambda: profiles.parse_blocks(blocks)),
+                   unverified=measure(
+                       lambda: profiles.parse_blocks(blocks, verify=False)))
+
+
+@benchmark
+def bench_import():
+    blocks = {base58encode(sig): dict(by='1' * 34, to='1' * 34, data=dict(
+        block['data'], signed=block['data']['signed'].isoformat()))
+              for sig, block in make_profile_entity(1000)['blocks'].items()}
+    text = yaml.dump(blocks, sort_keys=False)
+    lines = ''.join(json.dumps({k: v}) + '\n' for k, v in blocks.items())
+    report('import/yaml/1000',
+           safe_load=measure(lambda: yaml.safe_load(text)),
+           c_load=measure(lambda: yaml.load(text, Loader=YAMLLoader)),
+           stream=measure(lambda: list(iter_blocks(io.StringIO(text)))))
+    report('import/jsonl/1000',
+           stream=measure(lambda: list(iter_blocks(io.StringIO(lines),
+                                                   'jsonl'))))
+
+
+@benchmark
+def bench_export():
+    for n_blocks in (100, 2000):
+        entity = make_profile_entity(n_blocks)
+        profile = Profile(entity)
+        exporter = Exporter()
+        cached = Exporter(TTLCache())
+        legacy_yaml = dict(entity, blocks={
+            sig: dict(block) for sig, block in entity['blocks'].items()})
+        report(f'export/json/{n_blocks}',
+               jsonify=measure(lambda: jsonify(profile)),
+               render=measure(lambda: exporter.render(profile, 'owner')),
+               cached=measure(lambda: cached.render(profile, 'owner')))
+        report(f'export/yaml/{n_blocks}',
+               dump=measure(lambda: yaml.dump(_stringify_yaml(legacy_yaml))),
+               render=measure(lambda: exporter.render(profile, 'owner',
+                                                      'yaml')))
+
+
+def make_environ(method, path, body=b''):
+    return {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': '',
+            'CONTENT_TYPE': '', 'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body)}
+
+
+def legacy_dispatch(app, environ):
+    # Linear route walk of trustx 0.0.0, kept as the baseline
+    route_parts = environ['PATH_INFO'].split('/')
+    for route, f, options in app._handlers:
+        route_parts_ = route.split('/')
+        if len(route_parts_) != len(route_parts):
+            continue
+        route_args = {}
+        for a, b in zip(route_parts, route_parts_):
+            m = app.route_arg_pattern.match(b)
+            if m:
+                route_args[m.group(1)] = a
+            elif a != b:
+                break
+        else:
+            if environ['REQUEST_METHOD'] in options.get('methods', ['GET']):
+                return f(**route_args)
+
+
+@benchmark
+def bench_router():
+    for n_routes in (10, 100, 500):
+        app = WSGI()
+        for i in range(n_routes):
+            app.route(f'/plugins/p{i}/items/<id>')(lambda id: '')
+            app.route(f'/plugins/p{i}/items/<id>', methods=['PUT'])(
+                lambda id: '')
+        hit = f'/plugins/p{n_routes - 1}/items/42'
+        for name, path in (('hit', hit), ('miss', '/nothing/here')):
+            environ = make_environ('GET', path)
+            report(f'router/{name}/{n_routes * 2}',
+                   trie=measure(lambda: app(environ, lambda *_: None)),
+                   legacy=measure(lambda: legacy_dispatch(app, environ)))
+
+
+def legacy_form(environ):
+    # WSGI.Request.form of trustx 0.0.0, parsing the body on every access
+    import cgi
+    content_length = int(environ.get('CONTENT_LENGTH') or 0)
+    data = environ['wsgi.input'].read(content_length)
+    environ['wsgi.input'] = io.BytesIO(data)
+    form = cgi.FieldStorage(fp=io.BytesIO(data), environ=environ)
+    return {k: form[k].value for k in form}
+
+
+@benchmark
+def bench_request():
+    try:
+        import cgi
+    except ImportError:
+        # Removed in Python 3.13
+        cgi = None
+    boundary = 'boundary'
+    fields = dict(hint='1' * 80, password='p' * 8, name='user',
+                  hook='https://hooks.example.com/user')
+    multipart = b''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"'
+        f'\r\n\r\n{v}\r\n'.encode() for k, v in fields.items())
+    multipart += f'--{boundary}--\r\n'.encode()
+    bodies = {
+        'urlencoded': ('application/x-www-form-urlencoded',
+                       urllib.parse.urlencode(fields).encode()),
+        'multipart': (f'multipart/form-data; boundary={boundary}',
+                      multipart)}
+    for name, (content_type, body) in bodies.items():
+        def make():
+            environ = make_environ('POST', '/tokens', body)
+            environ['CONTENT_TYPE'] = content_type
+            return environ
+
+        def parse():
+            # Handlers read 3 to 4 fields per request
+            WSGI.request.environ = make()
+            for k in fields:
+                WSGI.request.form.get(k)
+
+        def legacy():
+            environ = make()
+            for k in fields:
+                legacy_form(environ).get(k)
+
+        values = dict(parse=measure(parse))
+        if cgi:
+            values['legacy'] = measure(legacy)
+        report(f'request/form/{name}', **values)
+
+
+class Client:
+    """
+    In-process HTTP client calling a WSGI application directly
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, url, body=b'', headers=()):
+        path, _, query = url.partition('?')
+        environ = make_environ(method, path, body)
+        environ['QUERY_STRING'] = query
+        for k, v in headers:
+            if k.lower() == 'content-type':
+                environ['CONTENT_TYPE'] = v
+            else:
+                environ['HTTP_' + k.upper().replace('-', '_')] = v
+        responses = []
+
+        def respond(status, headers, exc_info=None):
+            responses.append((int(status[:3]), dict(headers)))
+
+        content = b''.join(self.app(environ, respond))
+        return responses[-1] + (content,)
+
+    def form(self, method, url, **fields):
+        return self.request(
+            method, url, urllib.parse.urlencode(fields).encode(),
+            [('Content-Type', 'application/x-www-form-urlencoded')])
+
+
+@benchmark
+def bench_wsgi():
+    # The application of `python -m trustx.servers` on a temporary storage
+    sk = SecretKey()
+    names = (f'user{i}' for i in itertools.count())
+    client = Client(wsgi)
+    with tempfile.TemporaryDirectory() as path:
+        wsgi.storage = LocalStorage(pathlib.Path(path))
+        wsgi.session = HMACSessionFactory(b'secret',
+                                          cache=TTLCache(4096, ttl=300))
+        wsgi.profile_cache = TTLCache(4096, ttl=5)
+        wsgi.render_cache = TTLCache(1024, ttl=300)
+        try:
+            profile = Profile()
+            profile.name = next(names)
+            profile.key = sk.public_key
+            for block in Blocks(make_profile_entity(100)['blocks']):
+                profile.blocks.add(block, verify=False)
+            wsgi.profiles.put(profile)
+            token = wsgi.session(bytes.fromhex(profile.id)).token
+            me = f'/profiles/me?token={token}'
+            _, headers, _ = client.request('GET', me)
+            etag = headers['ETag']
+
+            def login():
+                _, _, nonce = client.form('POST', '/nonces',
+                                          key=str(sk.public_key))
+                nonce = json.loads(nonce)
+                signature = base58encode(sk.sign(nonce.encode()))
+                status, _, _ = client.form('POST', '/tokens', nonce=nonce,
+                                           signature=signature)
+                assert status == 200
+
+            def rename():
+                status, _, _ = client.form(
+                    'PUT', f'/profiles/me/name?token={token}',
+                    name=next(names))
+                assert status == 200
+
+            report('wsgi/profiles/get',
+                   json=measure(lambda: client.request('GET', me)),
+                   yaml=measure(lambda: client.request(
+                       'GET', me + '&format=yaml')),
+                   not_modified=measure(lambda: client.request(
+                       'GET', me, headers=[('If-None-Match', etag)])))
+            report('wsgi/profiles/list', get=measure(lambda: client.request(
+                'GET', f'/profiles?token={token}&limit=20')))
+            report('wsgi/tokens/nonce', login=measure(login))
+            report('wsgi/profiles/name', put=measure(rename))
+        finally:
+            for name in ('_storage', '_session', 'profile_cache',
+                         'render_cache'):
+                vars(wsgi).pop(name, None)
+
+
+@benchmark
+def bench_metrics():
+    app = WSGI()
+    app.route('/profiles/<id>')(lambda id: '')
+    environ = make_environ('GET', '/profiles/42')
+
+    def request():
+        app(environ, lambda *_: None)
+
+    with tempfile.TemporaryDirectory() as path:
+        storage = LocalStorage(pathlib.Path(path))
+        profiles = Profiles(storage)
+        profile = Profile()
+        profiles.put(profile)
+        disabled = dict(request=measure(request, 5),
+                        get=measure(lambda: profiles.get(profile.id), 5))
+        metrics.enable(Metrics())
+        try:
+            profiles = Profiles(InstrumentedStorage(storage))
+            enabled = dict(request=measure(request, 5),
+                           get=measure(lambda: profiles.get(profile.id), 5))
+        finally:
+            metrics.disable()
+    for name in disabled:
+        report(f'metrics/{name}', disabled=disabled[name],
+               enabled=enabled[name],
+               overhead=enabled[name] - disabled[name])
+
+
+@benchmark
+def bench_profiler():
+    app = WSGI()
+    app.route('/profiles/<id>')(lambda id: '')
+    environ = make_environ('GET', '/profiles/42')
+    with tempfile.TemporaryDirectory() as path:
+        # Nothing is slow enough to be written
+        profiled = Profiler(app, path, rate=0, threshold=1.0)
+        report('profiler/request',
+               plain=measure(lambda: app(environ, lambda *_: None)),
+               profiled=measure(lambda: profiled(environ, lambda *_: None)))
+
+
+def legacy_decode_from_7bit(data):
+    decoded = 0
+    n_consumed = 0
+    for index, byte in enumerate(data):
+        decoded |= (byte & 0x7f) << (7 * index)
+        n_consumed += 1
+        if byte & 0x80 == 0:
+            break
+    return decoded, n_consumed
+
+
+def legacy_splitb(data):
+    # Copying splitb() of trustx 0.0.0, kept as the baseline
+    while data:
+        length, n_consumed = legacy_decode_from_7bit(data)
+        s, e = n_consumed, n_consumed + length
+        yield data[s:e]
+        data = data[e:]
+
+
+def legacy_parse(factory, token):
+    # HMACSessionFactory.parse() of trustx 0.0.0, kept as the baseline
+    r = Session()
+    r.now = factory.now
+    r.token = token
+    try:
+        token = base58decode(r.token)
+        r.sign, expires, *data = legacy_splitb(token)
+        ts = int.from_bytes(expires, 'big')
+        r.expires = datetime.datetime.fromtimestamp(ts)
+        r.data = tuple(data)
+        message = expires + b''.join(r.data)
+        sign = hmac.new(factory.secret, message, hashfunc)
+        r.valid = r.sign == sign.digest()
+    except Exception:
+        pass
+    return r
+
+
+@benchmark
+def bench_sessions():
+    factory = HMACSessionFactory(b'secret')
+    fields = [os.urandom(32), os.urandom(4), b'\x02', os.urandom(16), b'pw']
+    for n_fields in (3, 5, 50):
+        items = (fields * 10)[:n_fields]
+        data = joinb(*items)
+        before = measure(lambda: list(legacy_splitb(data)))
+        after = measure(lambda: splitb(data))
+        report(f'sessions/splitb/{n_fields}', before=before, after=after,
+               speedup=f'{before / after:.1f}x')
+        report(f'sessions/joinb/{n_fields}',
+               join=measure(lambda: joinb(*items)))
+    profile_id = os.urandom(16)
+    report('sessions/issue', issue=measure(lambda: factory(profile_id)))
+    token = factory(profile_id).token
+    before = measure(lambda: legacy_parse(factory, token))
+    after = measure(lambda: factory.parse(token))
+    report('sessions/parse', before=before, after=after,
+           tokens_per_sec=f'{1 / before:.0f}->{1 / after:.0f}')
+
+
+def save(path):
+    results = dict(
+        trustx=__version__, python=platform.python_version(),
+        platform=platform.platform(),
+        created=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        results=RESULTS)
+    path.write_text(json.dumps(results, indent=2) + '\n')
+
+
+# Differences of timings, too small to compare as ratios
+UNCOMPARED = {'overhead'}
+
+
+def compare(baseline, tolerance):
+    """
+    Print the timings changed from the baseline by more than tolerance
+
+    Returns the number of timings slower than the baseline.
+    """
+    print(f'\ncompared with trustx {baseline["trustx"]} on Python'
+          f' {baseline["python"]}, {baseline["platform"]}')
+    n_compared = n_slower = n_faster = 0
+    for name, values in RESULTS.items():
+        old_values = baseline['results'].get(name, {})
+        for k, v in values.items():
+            old = old_values.get(k)
+            # Only timings are compared, the other values are not costs
+            if (k in UNCOMPARED or not isinstance(v, float)
+                    or not isinstance(old, float) or old <= 0 or v <= 0):
+                continue
+            n_compared += 1
+            ratio = v / old
+            if ratio > 1 + tolerance:
+                n_slower += 1
+                change = 'slower'
+            elif ratio < 1 / (1 + tolerance):
+                n_faster += 1
+                change = 'faster'
+            else:
+                continue
+            print(f'{name + "/" + k:<40} {format_time(old)} ->'
+                  f' {format_time(v)} {ratio:.2f}x {change}')
+    print(f'{n_compared} timings compared, {n_slower} slower,'
+          f' {n_faster} faster by more than {tolerance:.0%}')
+    return n_slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help=f'benchmarks to run: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--entities', type=int, nargs='+', default=ENTITIES,
+                        help='numbers of stored entities of storage')
+    parser.add_argument('--save', type=pathlib.Path,
+                        help='write the results as JSON')
+    parser.add_argument('--compare', type=pathlib.Path,
+                        help='compare the results with a saved JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='ratio of slowdown reported as a regression')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(unknown)}')
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    ENTITIES[:] = args.entities
+
+    warnings.simplefilter('ignore', DeprecationWarning)
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+    if args.save:
+        save(args.save)
+    if baseline and compare(baseline, args.tolerance):
+        sys.exit(1)
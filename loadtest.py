@@ -0,0 +1,125 @@
+"""
+Load test of the pre-fork server, run with `python loadtest.py`
+
+Starts `python -m trustx.servers wsgi` on a temporary storage for each
+number of workers and reports requests/sec seen by concurrent clients.
+The clients share the CPUs with the server, so scaling flattens out at
+about half of the cores.
+"""
+import argparse
+import datetime
+import http.client
+import multiprocessing
+import os
+import pathlib
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from trustx import SecretKey
+from trustx.profiles import Block, Profile, Profiles
+from trustx.sessions import HMACSessionFactory
+from trustx.storages import LocalStorage
+
+SECRET = 'loadtest'
+
+
+def seed(path, n_blocks):
+    profiles = Profiles(LocalStorage(path / 'storage'))
+    sk = SecretKey()
+    profile = Profile()
+    profile.name = 'loadtest'
+    profile.key = sk.public_key
+    tz = datetime.timezone(datetime.timedelta(hours=9))
+    for i in range(n_blocks):
+        block = Block()
+        block.by, block.to = sk.public_key, sk.public_key
+        block.data = dict(skills={f'skill{i}': dict(level=i % 5)},
+                          signed=datetime.datetime(2020, 1, 1, tzinfo=tz))
+        block.signature = os.urandom(64)
+        profile.blocks.add(block, verify=False)
+    profiles.put(profile)
+    session = HMACSessionFactory(SECRET.encode())(bytes.fromhex(profile.id))
+    return session.token
+
+
+def start_server(path, workers, threads):
+    env = dict(os.environ, TRUSTX_SESSION_SECRET=SECRET,
+               PYTHONPATH=str(pathlib.Path(__file__).resolve().parent))
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'trustx.servers', 'wsgi', '--port', '0',
+         '--workers', str(workers), '--threads', str(threads)],
+        cwd=path, env=env, stdout=subprocess.PIPE, text=True)
+    # Serving HTTP on port <port> with <workers> workers, ...
+    port = int(proc.stdout.readline().split()[4])
+    # Connections are refused until the workers listen
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc, port
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+
+def client(port, path, duration):
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        try:
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors += 1
+        except OSError:
+            errors += 1
+        finally:
+            conn.close()
+        latencies.append(time.monotonic() - started)
+    return latencies, errors
+
+
+def run(port, path, clients, duration):
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.starmap(client, [(port, path, duration)] * clients)
+    latencies = sorted(x for r, _ in results for x in r)
+    errors = sum(e for _, e in results)
+    return dict(
+        rps=len(latencies) / duration,
+        p50=latencies[len(latencies) // 2] * 1e3,
+        p99=latencies[int(len(latencies) * 0.99)] * 1e3,
+        errors=errors)
+
+
+if __name__ == '__main__':
+    n_cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, n_cpus} - {0}))
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=2 * n_cpus)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--blocks', type=int, default=100)
+    parser.add_argument('--path', default='/profiles/loadtest')
+    args = parser.parse_args()
+
+    print(f'{n_cpus} cpus, {args.clients} clients, {args.threads} threads'
+          f' per worker, GET {args.path}')
+    with tempfile.TemporaryDirectory() as path:
+        token = seed(pathlib.Path(path), args.blocks)
+        target = f'{args.path}?token={token}'
+        for workers in args.workers:
+            proc, port = start_server(path, workers, args.threads)
+            try:
+                r = run(port, target, args.clients, args.duration)
+            finally:
+                proc.terminate()
+                proc.wait()
+            print(f'workers={workers:<4} rps={r["rps"]:<9.1f}'
+                  f' p50={r["p50"]:.1f}ms p99={r["p99"]:.1f}ms'
+                  f' errors={r["errors"]}')
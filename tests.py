@@ -0,0 +1,1169 @@
+import asyncio
+import concurrent.futures
+import datetime
+import inspect
+import io
+import itertools
+import json
+import os
+import pickle
+import threading
+import time
+
+import pytest
+import yaml
+
+import trustx
+from trustx import (PublicKey, PublicKeyTable, SecretKey, TTLCache, sign_many,
+                    verify_many)
+from trustx.deliveries import Deliveries, StubReceiver
+from trustx.exports import Exporter
+from trustx.profilers import Profiler
+from trustx.profiles import Block, Blocks, Profile, Profiles, iter_blocks
+from trustx.servers import (
+    ASGI, WSGI, ASGIServer, HTTPError, LimitedInput, jsonify, parse_header,
+    parse_multipart, wsgi)
+from trustx.sessions import HMACSessionFactory, joinb, split, splitb
+from trustx.storages import CODECS, LocalStorage, LogStorage, SQLiteStorage
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+@pytest.fixture(scope='module')
+def secret_key():
+    return SecretKey()
+
+
+def test_verify_many_returns_failed_indices(secret_key):
+    pk = secret_key.public_key
+    messages = [f'message {i}'.encode() for i in range(40)]
+    items = [(pk, secret_key.sign(m), m) for m in messages]
+    items[3] = (pk, items[3][1], b'forged')
+    assert verify_many(items, processes=1) == [3]
+    assert verify_many(items, processes=2) == [3]
+
+
+def test_get_executor_shuts_down_replaced_pool():
+    old, n_workers = trustx._get_executor(2)
+    assert trustx._get_executor() == (old, 2)
+    new, n_workers = trustx._get_executor(3)
+    assert new is not old and n_workers == 3
+    with pytest.raises(RuntimeError):
+        old.submit(int)
+
+
+def test_get_executor_does_not_fork():
+    executor, n_workers = trustx._get_executor(2)
+    # Forked workers would copy the locks held by other server threads
+    assert executor._mp_context.get_start_method() != 'fork'
+    assert executor.submit(os.getpid).result() != os.getpid()
+
+
+def test_public_keys_are_interned(secret_key):
+    pk = secret_key.public_key
+    assert secret_key.public_key is pk
+    assert PublicKey(pk.encode()) is pk
+    assert PublicKey(str(pk)) is pk
+    assert PublicKey(pk.encode(), validate=False) is pk
+    assert pickle.loads(pickle.dumps(pk)) is pk
+    # The keyhash is computed once and shared through the interned key
+    assert PublicKey(pk.encode()).hash is pk.hash
+
+
+def test_public_key_table_evicts_least_recently_used():
+    table = PublicKeyTable(maxsize=2)
+    keys = [SecretKey().public_key for _ in range(3)]
+    for key in keys[:2]:
+        assert table.add(key) is key
+    assert table.get(keys[0].encode()) is keys[0]
+    table.add(keys[2])
+    assert len(table) == 2
+    assert table.get(keys[1].encode()) is None
+    assert table.get(keys[0].encode()) is keys[0]
+
+
+def test_public_keys_are_immutable(secret_key):
+    pk = secret_key.public_key
+    keyhash = pk.hash
+    with pytest.raises(AttributeError):
+        pk._bytes = b''
+    with pytest.raises(AttributeError):
+        pk._hash = 'forged'
+    with pytest.raises(AttributeError):
+        del pk._hash
+    with pytest.raises(AttributeError):
+        pk.name = 'user'
+    assert pk.hash == keyhash and PublicKey(pk.encode()) is pk
+
+
+def test_sign_many_keeps_input_order(secret_key):
+    pk = secret_key.public_key
+    messages = [f'message {i}'.encode() for i in range(20)]
+    for processes in (1, 2):
+        signatures = list(sign_many(secret_key, messages, processes,
+                                    chunk_size=4))
+        assert len(signatures) == len(messages)
+        assert all(pk.verify(s, data=m)
+                   for s, m in zip(signatures, messages))
+
+
+def test_verifying_key_cache_precomputes_once(secret_key):
+    cache = trustx.VerifyingKeyCache(precompute_after=1)
+    data = secret_key.public_key.encode()
+    barrier = threading.Barrier(8)
+
+    def get():
+        barrier.wait()
+        return cache.get(data)
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        vks = list(executor.map(lambda _: get(), range(8)))
+    assert all(vk is vks[0] for vk in vks)
+    stats = cache.stats()
+    assert stats['precomputes'] == 1
+    assert stats['hits'] + stats['misses'] == 8
+
+
+def test_sqlite_storage_closes_connections_of_other_threads(tmp_path):
+    storage = SQLiteStorage(tmp_path / 'storage.sqlite3')
+    storage.profiles.put(dict(id='a'))
+    thread = threading.Thread(target=lambda: storage.profiles.get('a'))
+    thread.start()
+    thread.join()
+    assert len(storage._connections) == 2
+    storage.close()
+    assert storage._connections == []
+    assert storage.profiles.get('a') == dict(id='a')
+    storage.close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork()')
+def test_sqlite_storage_close_leaves_parent_connections(tmp_path):
+    storage = SQLiteStorage(tmp_path / 'storage.sqlite3')
+    storage.profiles.put(dict(id='a'))
+    pid = os.fork()
+    if pid == 0:
+        storage.close()
+        os._exit(len(storage._connections))
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 1
+    assert storage.profiles.get('a') == dict(id='a')
+
+
+def test_local_storage_counts_concurrent_creates_once(tmp_path):
+    kind = LocalStorage(tmp_path).profiles
+    assert len(kind) == 0
+    barrier = threading.Barrier(8)
+
+    def put(i):
+        barrier.wait()
+        kind.put(dict(id='a', n=i))
+
+    for _ in range(10):
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(put, range(8)))
+    assert len(kind) == 1
+    kind.put(dict(id='b'))
+    kind.delete('a')
+    assert len(kind) == 1
+    assert [entity['id'] for entity in kind] == ['b']
+
+
+@pytest.mark.parametrize('entity', [
+    {'name': 'é', 'k': 'zz', 'z': 'zz'},
+    {'a': '', 'b': '', 'c': b'', 'd': 'x', 'e': 'x'},
+    {'s': 'すし', 't': ['すし', 'すし', b'\xe3\x81\x99'], 'u': 'す'},
+    {'nested': {'list': [1, [2, (3, 'abc')], {'abc': 'abc'}],
+                'set': {1, 2, 'ab'},
+                'none': None, 'bools': [True, False],
+                'numbers': [0, -1, 127, 128, -2 ** 70, 2.5]}},
+    {'naive': datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+     'aware': datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=JST),
+     'utc': datetime.datetime(2020, 1, 2, 3, 4, 5,
+                              tzinfo=datetime.timezone.utc),
+     'again': [datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+               datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=JST)],
+     'date': datetime.date(2020, 1, 2)},
+])
+def test_binary_codec_round_trip(entity):
+    codec = CODECS['binary']
+    decoded = codec.loads(codec.dumps(entity))
+    assert decoded == entity
+    assert repr(decoded) == repr(entity)
+
+
+EXPLOITED = []
+
+
+def _exploit():
+    EXPLOITED.append(True)
+
+
+class Exploit:
+    def __reduce__(self):
+        return _exploit, ()
+
+
+def test_binary_codec_refuses_other_classes():
+    codec = CODECS['binary']
+    data = b'TXE\x01' + pickle.dumps(dict(x=Exploit()), protocol=5)
+    with pytest.raises(ValueError, match='forbidden class'):
+        codec.loads(data)
+    assert not EXPLOITED
+    with pytest.raises(TypeError, match='cannot encode Exploit'):
+        codec.dumps(dict(x=Exploit()))
+    with pytest.raises(ValueError, match='unsupported binary entity'):
+        codec.loads(b'TXE\x02' + data[4:])
+    with pytest.raises(ValueError, match='malformed binary entity'):
+        codec.loads(b'TXE\x01d\x01s\x01ai\x02')
+
+
+@pytest.mark.parametrize('storage_class', [LocalStorage, LogStorage])
+def test_storages_refuse_unknown_pickles(tmp_path, storage_class):
+    storage = storage_class(tmp_path)
+    storage.profiles.put(dict(id='a'))
+    data = pickle.dumps(dict(id='b', x=Exploit()))
+    if storage_class is LocalStorage:
+        (tmp_path / 'profiles' / 'b.entity').write_bytes(data)
+        (tmp_path / 'profiles' / 'c.pickle').write_bytes(data)
+        ids = 'b', 'c'
+    else:
+        kind = storage.profiles
+        with kind._lock:
+            kind._index['b'] = kind._append(kind.PUT, 'b', data), len(data)
+        ids = 'b',
+    for id in ids:
+        with pytest.raises(ValueError):
+            storage.profiles.get(id)
+    with pytest.raises(ValueError):
+        list(storage.profiles)
+    assert storage.profiles.get('a') == dict(id='a')
+    assert EXPLOITED == []
+
+
+def test_sqlite_storage_refuses_unknown_pickles(tmp_path):
+    storage = SQLiteStorage(tmp_path / 'storage.sqlite3')
+    storage.profiles.put(dict(id='a'))
+    with storage.transaction() as conn:
+        conn.execute('INSERT INTO profiles VALUES (?, ?)',
+                     ('b', pickle.dumps(dict(id='b', x=Exploit()))))
+    with pytest.raises(ValueError):
+        storage.profiles.get('b')
+    assert EXPLOITED == []
+
+
+def test_local_storage_migrates_pickles(tmp_path):
+    legacy = LocalStorage(tmp_path, codec='pickle')
+    legacy.profiles.put(dict(id='a', name='user'))
+    assert legacy.profiles.get('a') == dict(id='a', name='user')
+    storage = LocalStorage(tmp_path)
+    with pytest.raises(ValueError):
+        storage.profiles.get('a')
+    assert storage.profiles.migrate() == 1
+    assert storage.profiles.get('a') == dict(id='a', name='user')
+    assert [path.name for path in (tmp_path / 'profiles').iterdir()] == [
+        'a.entity']
+
+
+@pytest.mark.parametrize('storage_class', [LocalStorage, LogStorage])
+def test_scan_fills_pages_when_entities_are_deleted(tmp_path, storage_class):
+    kind = storage_class(tmp_path).profiles
+    for id in 'abcdef':
+        kind.put(dict(id=id))
+    scan = kind.scan(None, 3)
+    assert next(scan)['id'] == 'a'
+    kind.delete('b')
+    assert [entity['id'] for entity in scan] == ['c', 'd']
+    assert [entity['id'] for entity in kind.scan('d', 3)] == ['e', 'f']
+    assert [entity['id'] for entity in kind.scan()] == list('acdef')
+
+
+def test_local_storage_scan_lists_migrating_ids_once(tmp_path):
+    kind = LocalStorage(tmp_path).profiles
+    for id in 'abcd':
+        kind.put(dict(id=id))
+    # Left by a migration from the pickle codec in progress
+    (tmp_path / 'profiles' / 'b.pickle').write_bytes(
+        pickle.dumps(dict(id='b')))
+    assert [entity['id'] for entity in kind.scan(None, 3)] == list('abc')
+    assert [entity['id'] for entity in kind.scan()] == list('abcd')
+
+
+def test_cached_profiles_are_copies(tmp_path):
+    profiles = Profiles(LocalStorage(tmp_path), cache=TTLCache())
+    profile = Profile()
+    profile.name = 'user'
+    profile.links = {'site': ['https://example.com']}
+    profiles.put(profile)
+    for _ in range(2):
+        profile = profiles.get(profile.id)
+        assert profile.links == {'site': ['https://example.com']}
+        profile.links['site'].append('https://example.org')
+        profile._block_segments.append([9, 1])
+    assert profiles.cache.stats()['hits'] == 1
+
+
+@pytest.mark.parametrize('line, message', [
+    ('{"sig": {"by": ["x"], "to": "y", "data": {}}}', 'by must be'),
+    ('{"sig": {"by": "x", "to": {"k": 1}, "data": {}}}', 'to must be'),
+    ('{"sig": {"by": "x", "to": "y"}}', 'missing required keys: data'),
+    ('{"sig": ["x"]}', 'block must be a mapping'),
+    ('{"sig": {"by": "x", "to": "y", "data": {}, "z": 1}}', 'invalid keys'),
+    ('{"sig": {"by": "x", "to": "y", "data": {}}}', 'not registered: x'),
+])
+def test_import_blocks_rejects_malformed_blocks(tmp_path, line, message):
+    profiles = Profiles(LocalStorage(tmp_path))
+    entries = iter_blocks(io.StringIO('{}\n' + line + '\n'), 'jsonl')
+    with pytest.raises(ValueError, match=f'^line 2: {message}'):
+        list(profiles.import_blocks(entries))
+
+
+def test_parse_blocks_rejects_non_string_signatures(tmp_path):
+    profiles = Profiles(LocalStorage(tmp_path))
+    with pytest.raises(ValueError, match='signature must be a string'):
+        profiles.parse_blocks({1: dict(by='x', to='y', data={})})
+
+
+@pytest.fixture
+def app(tmp_path):
+    wsgi.storage = LocalStorage(tmp_path)
+    wsgi.session = HMACSessionFactory(b'secret')
+    yield wsgi
+    del wsgi._storage, wsgi._session
+
+
+def call(app, method, url, body=b'', content_type='', **headers):
+    path, _, query = url.partition('?')
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+               'QUERY_STRING': query, 'CONTENT_TYPE': content_type,
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.input': io.BytesIO(body), **headers}
+    statuses = []
+    content = b''.join(app(environ, lambda s, h: statuses.append(s)))
+    return int(statuses[-1][:3]), content
+
+
+@pytest.fixture
+def token(app, secret_key):
+    profile = Profile()
+    profile.name = 'user'
+    profile.key = secret_key.public_key
+    app.profiles.put(profile)
+    return app.session(bytes.fromhex(profile.id)).token
+
+
+def test_put_blocks_answers_malformed_blocks_with_400(app, token):
+    line = b'{"sig": {"by": ["x"], "to": "y", "data": {}}}\n'
+    status, content = call(app, 'PUT', f'/profiles/me/blocks?token={token}',
+                           line, 'application/jsonl')
+    assert status == 400
+    assert json.loads(content) == dict(error='line 1: by must be a key hash')
+
+
+def test_missing_block_segments_raise(tmp_path):
+    storage = LocalStorage(tmp_path)
+    storage.profiles.put(dict(id='a', block_segments=[[0, 1]], revision=1))
+    profile = Profiles(storage).get('a')
+    with pytest.raises(LookupError, match='missing block segment: a-0'):
+        list(profile.blocks)
+
+
+def make_block(secret_key, data):
+    block = Block()
+    block.by = block.to = secret_key.public_key
+    block.data = data
+    block.signature = secret_key.sign(block.message)
+    return block
+
+
+def test_blocks_are_read_again_when_segments_are_merged(tmp_path,
+                                                        secret_key):
+    profiles = Profiles(LocalStorage(tmp_path))
+    profile = Profile()
+    profile.blocks.add(make_block(secret_key, {'n': 0}), verify=False)
+    profiles.put(profile)
+    stale = profiles.get(profile.id)
+    other = profiles.get(profile.id)
+    other.blocks.add(make_block(secret_key, {'n': 1}), verify=False)
+    profiles.put(other)
+    assert other._block_segments == [[1, 2]]
+    assert sorted(b.data['n'] for b in stale.blocks) == [0, 1]
+
+
+def test_local_storage_transactions_exclude_each_other(tmp_path):
+    storage = LocalStorage(tmp_path)
+    active = []
+    overlaps = []
+    barrier = threading.Barrier(8)
+
+    def transact(_):
+        barrier.wait()
+        for _ in range(20):
+            with storage.transaction():
+                active.append(1)
+                overlaps.append(len(active))
+                time.sleep(0.0001)
+                active.pop()
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(transact, range(8)))
+    assert max(overlaps) == 1
+    assert storage._tx_depth == 0
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork()')
+def test_local_storage_transactions_exclude_forked_children(tmp_path):
+    storage = LocalStorage(tmp_path / 'storage')
+    released = tmp_path / 'released'
+    with storage.transaction():
+        pid = os.fork()
+        if pid == 0:
+            with storage.transaction():
+                os._exit(0 if released.exists() else 1)
+        time.sleep(0.2)
+        released.touch()
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+
+def test_put_of_a_stale_profile_keeps_fields_of_other_writers(tmp_path):
+    profiles = Profiles(LocalStorage(tmp_path))
+    profile = Profile()
+    profile.name = 'user'
+    profiles.put(profile)
+    a = profiles.get(profile.id)
+    b = profiles.get(profile.id)
+    a.name = 'renamed'
+    a.hook = 'https://hooks.example.com/a'
+    profiles.put(a)
+    b.hook = 'https://hooks.example.com/b'
+    profiles.put(b)
+    assert (b.name, b.hook) == ('renamed', 'https://hooks.example.com/b')
+    stored = profiles.get(profile.id)
+    assert (stored.name, stored.hook) == (b.name, b.hook)
+    assert stored.revision == 3
+    assert profiles.get(name='renamed').id == profile.id
+    assert profiles.get(name='user') is None
+    assert profiles.get(hook='https://hooks.example.com/a') is None
+    assert profiles.get(hook='https://hooks.example.com/b').id == profile.id
+    b.name = 'user'
+    profiles.put(b)
+    assert profiles.get(name='renamed') is None
+    assert profiles.get(name='user').hook == 'https://hooks.example.com/b'
+
+
+def test_metrics_time_import_blocks_until_exhausted(app, token, secret_key):
+    from trustx import metrics
+    blocks = Blocks({})
+    blocks.add(make_block(secret_key, {'n': 0}), verify=False)
+    measurements = []
+    metrics.enable(lambda *measurement: measurements.append(measurement))
+    try:
+        status, _ = call(app, 'PUT', f'/profiles/me/blocks?token={token}',
+                         jsonify(blocks).encode() + b'\n',
+                         'application/jsonl')
+    finally:
+        metrics.disable()
+    assert status == 200
+    labels = (('operation', 'Profiles.import_blocks'),)
+    timed = [m for m in measurements if m[2] == labels]
+    assert len(timed) == 1
+    assert timed[0][0] == 'trustx_operation_duration_seconds'
+    assert inspect.isgeneratorfunction(Profiles.import_blocks)
+
+
+def test_routes_match_in_registration_order():
+    app = WSGI()
+
+    @app.route('/profiles/<name>')
+    def get_profile(name):
+        return f'profile {name}'
+
+    @app.route('/profiles/me')
+    def get_me():
+        return 'me'
+
+    @app.route('/profiles/<name>', methods=['PUT'])
+    def put_profile(name):
+        return f'put {name}', 200
+
+    @app.route('/profiles/<name>/blocks/<id>', cors=False)
+    def get_block(name, id):
+        return f'block {name} {id}'
+
+    assert call(app, 'GET', '/profiles/me') == (200, b'profile me')
+    assert call(app, 'GET', '/profiles/bob') == (200, b'profile bob')
+    assert call(app, 'PUT', '/profiles/bob') == (200, b'put bob')
+    assert call(app, 'GET', '/profiles/a/blocks/b') == (200, b'block a b')
+    assert call(app, 'POST', '/profiles/bob')[0] == 404
+    assert call(app, 'GET', '/profiles') == (404, b'')
+    assert call(app, 'GET', '/profiles/a/blocks') == (404, b'')
+    assert call(app, 'OPTIONS', '/profiles/bob') == (200, b'')
+    assert call(app, 'OPTIONS', '/profiles/a/blocks/b') == (404, b'')
+    assert [route for (_, _, _, _, _, route), _
+            in app.match('/profiles/me')] == ['/profiles/<name>',
+                                              '/profiles/me',
+                                              '/profiles/<name>']
+    # Nodes without a PUT handler are skipped, the others filtered later
+    assert [(f.__name__, args) for (_, f, *_), args
+            in app.match('/profiles/me', 'PUT')] == [
+                ('get_profile', ('me',)), ('put_profile', ('me',))]
+
+
+def _base58encode_reference(data):
+    number = int.from_bytes(data, 'big')
+    r = ''
+    while number:
+        number, digit = divmod(number, 58)
+        r = trustx.BASE58_CHARACTERS[digit] + r
+    return '1' * (len(data) - len(data.lstrip(b'\0'))) + r
+
+
+@pytest.mark.parametrize('data', [
+    b'', b'\0', b'\0\0\1', b'\1', b'\xff' * 7, b'\0' + b'\xff' * 64,
+    bytes(range(256)), os.urandom(33), os.urandom(65),
+])
+def test_base58_round_trip(data):
+    encoded = trustx.base58encode(data)
+    assert encoded == _base58encode_reference(data)
+    assert trustx.base58decode(encoded) == data
+    assert trustx.base58encode(data, returns=bytes) == encoded.encode()
+    assert trustx.base58decode(encoded.encode() + b'\n') == data
+    assert trustx.base58encode_many([data, data[::-1]]) == [
+        encoded, trustx.base58encode(data[::-1])]
+    assert trustx.base58decode_many([encoded, encoded]) == [data, data]
+
+
+@pytest.mark.parametrize('base58', ['0', 'O', 'I', 'l', '1a0', '11+'])
+def test_base58_rejects_invalid_characters(base58):
+    with pytest.raises(ValueError, match='Invalid character'):
+        trustx.base58decode(base58)
+    with pytest.raises(ValueError, match='Invalid character'):
+        trustx.base58decode_many(['1', base58])
+
+
+def test_appended_blocks_keep_logarithmic_segments(tmp_path, secret_key):
+    storage = LocalStorage(tmp_path)
+    profiles = Profiles(storage)
+    profile = Profile()
+    profiles.put(profile)
+    blocks = [make_block(secret_key, {'n': n}) for n in range(64)]
+    for n, block in enumerate(blocks, 1):
+        profile = profiles.get(profile.id)
+        profile.blocks.add(block, verify=False)
+        if n % 8 == 0:
+            profile.blocks.remove(blocks[n - 8].signature)
+        profiles.put(profile)
+        segments = storage.profiles.get(profile.id)['block_segments']
+        assert len(segments) <= n.bit_length()
+        assert sorted(e['id'] for e in storage.blocks) == sorted(
+            f'{profile.id}-{seq}' for seq, _ in segments)
+    removed = {blocks[n].signature for n in range(0, 64, 8)}
+    expected = {b.signature for b in blocks} - removed
+    profile = profiles.get(profile.id)
+    assert {b.signature for b in profile.blocks} == expected
+    assert [b.data['n'] for b in profile.blocks] == [
+        b.data['n'] for b in blocks if b.signature in expected]
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('text/plain', ('text/plain', {})),
+    ('Text/HTML; Charset=UTF-8', ('text/html', {'charset': 'UTF-8'})),
+    ('multipart/form-data; boundary="a;b=c"',
+     ('multipart/form-data', {'boundary': 'a;b=c'})),
+    ('form-data; name="a\\"b"; filename=x.txt',
+     ('form-data', {'name': 'a"b', 'filename': 'x.txt'})),
+    ('', ('', {})),
+])
+def test_parse_header(value, expected):
+    assert parse_header(value) == expected
+
+
+def test_parse_multipart():
+    body = (b'preamble\r\n'
+            b'--xyz  \r\n'
+            b'Content-Disposition: form-data; name="a"\r\n\r\n'
+            b'1\r\n'
+            b'--xyz\r\n'
+            b'Content-Disposition: form-data; name="b"\r\n'
+            b'Content-Type: text/plain; charset=shift_jis\r\n\r\n'
+            + '日本'.encode('shift_jis') + b'\r\n'
+            b'--xyz\r\n'
+            b'Content-Disposition: form-data; name="f"; filename="f.bin"\r\n'
+            b'\r\n'
+            b'\0\r\n--x\r\n'
+            b'--xyz\r\n'
+            b'Content-Disposition: form-data\r\n\r\n'
+            b'unnamed\r\n'
+            b'--xyz--\r\n'
+            b'epilogue')
+    assert parse_multipart(body, 'xyz') == [
+        ('a', '1'), ('b', '日本'), ('f', b'\0\r\n--x')]
+    with pytest.raises(ValueError, match='malformed multipart body'):
+        parse_multipart(b'--xyz\r\nContent-Disposition: form-data', 'xyz')
+
+
+def test_request_parses_bodies_once():
+    request = WSGI.Request()
+    body = b'b=2&c=3'
+    stream = io.BytesIO(body)
+    request.environ = {'REQUEST_METHOD': 'POST', 'QUERY_STRING': 'a=1&b=1',
+                       'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                       'CONTENT_LENGTH': str(len(body)),
+                       'wsgi.input': stream}
+    assert request.form == {'a': '1', 'b': '2', 'c': '3'}
+    assert request.form is request.form
+    assert request.data == body
+    assert stream.tell() == len(body)
+    assert request.environ['wsgi.input'].read() == body
+
+
+@pytest.mark.parametrize('content_type, body, form', [
+    ('application/json; charset=utf-8', b'{"a": "x", "b": "2"}',
+     {'a': 'x', 'b': '2', 'q': '1'}),
+    ('application/json', b'[1]', {'q': '1'}),
+    ('multipart/form-data; boundary=z',
+     b'--z\r\nContent-Disposition: form-data; name="a"\r\n\r\nx\r\n--z--',
+     {'a': 'x', 'q': '1'}),
+    ('text/plain', b'a=x', {'q': '1'}),
+])
+def test_request_forms(content_type, body, form):
+    request = WSGI.Request()
+    request.environ = {'REQUEST_METHOD': 'PUT', 'QUERY_STRING': 'q=1',
+                       'CONTENT_TYPE': content_type,
+                       'CONTENT_LENGTH': str(len(body)),
+                       'wsgi.input': io.BytesIO(body)}
+    assert request.form == form
+
+
+@pytest.mark.parametrize('content_type, body, status', [
+    ('application/json', b'{', 400),
+    ('application/json', b'{"name": 5}', 400),
+    ('application/json', b'{"blocks": {"sig": {}}}', 400),
+    ('multipart/form-data', b'', 400),
+    ('multipart/form-data; boundary=z', b'--z\r\nx', 400),
+    ('application/x-www-form-urlencoded', b'a' * ((1 << 20) + 1), 413),
+])
+def test_request_rejects_bodies(content_type, body, status):
+    request = WSGI.Request()
+    request.environ = {'REQUEST_METHOD': 'POST', 'QUERY_STRING': '',
+                       'CONTENT_TYPE': content_type,
+                       'CONTENT_LENGTH': str(len(body)),
+                       'wsgi.input': io.BytesIO(body)}
+    with pytest.raises(HTTPError) as e:
+        request.form
+    assert e.value.status == status
+
+
+def test_limited_input_stops_at_its_length():
+    stream = io.BytesIO(b'ab\ncd\nef\n')
+    limited = LimitedInput(stream, 7)
+    assert limited.readline() == b'ab\n'
+    assert limited.read(1) == b'c'
+    assert list(limited) == [b'd\n', b'e']
+    assert limited.read() == limited.readline() == b''
+    assert stream.read() == b'f\n'
+
+
+def _blocks_document(blocks, format):
+    if format == 'yaml':
+        return yaml.safe_dump(blocks, sort_keys=False).encode()
+    return b''.join(json.dumps({k: v}).encode() + b'\n'
+                    for k, v in blocks.items())
+
+
+@pytest.mark.parametrize('format', ['yaml', 'jsonl'])
+def test_import_blocks_verifies_streamed_chunks(tmp_path, secret_key,
+                                                format):
+    profiles = Profiles(LocalStorage(tmp_path))
+    profile = Profile()
+    profile.key = secret_key.public_key
+    profiles.put(profile)
+    blocks = Blocks({})
+    for n in range(5):
+        blocks.add(make_block(secret_key, {'n': n}), verify=False)
+    signed = json.loads(jsonify(blocks))
+    body = _blocks_document(signed, format)
+    # Trailing bytes beyond the content length are never read
+    entries = iter_blocks(LimitedInput(io.BytesIO(body + b'{'), len(body)),
+                          format)
+    assert [b.data for b in profiles.import_blocks(entries)] == [
+        {'n': n} for n in range(5)]
+
+    signature = list(signed)[3]
+    signed[signature] = dict(signed[signature], data={'n': -1})
+    body = _blocks_document(signed, format)
+    line = body[:body.index(signature.encode())].count(b'\n') + 1
+    consumed = []
+    entries = (consumed.append(entry) or entry
+               for entry in iter_blocks(io.BytesIO(body), format))
+    imported = profiles.import_blocks(entries, chunk_size=2)
+    assert [b.data for b in itertools.islice(imported, 2)] == [
+        {'n': 0}, {'n': 1}]
+    assert len(consumed) == 2
+    with pytest.raises(ValueError,
+                       match=f'^line {line}: invalid block: {signature}$'):
+        list(imported)
+
+
+def test_request_without_content_type_is_urlencoded():
+    request = WSGI.Request()
+    request.environ = {'REQUEST_METHOD': 'POST', 'QUERY_STRING': '',
+                       'CONTENT_LENGTH': '3',
+                       'wsgi.input': io.BytesIO(b'a=1')}
+    assert request.content_type == ''
+    assert request.form == {'a': '1'}
+
+
+def test_put_blocks_as_form_fields(app, token, secret_key):
+    blocks = Blocks({})
+    blocks.add(make_block(secret_key, {'n': 0}), verify=False)
+    url = f'/profiles/me/blocks?token={token}'
+    body = json.dumps(dict(blocks=json.loads(jsonify(blocks)))).encode()
+    assert call(app, 'PUT', url, body, 'application/json')[0] == 400
+    body = json.dumps(dict(blocks=jsonify(blocks))).encode()
+    status, content = call(app, 'PUT', url, body, 'application/json')
+    assert status == 200
+    assert json.loads(content) == json.loads(jsonify(blocks))
+    blocks.add(make_block(secret_key, {'n': 1}), verify=False)
+    body = (b'--z\r\nContent-Disposition: form-data; name="blocks";'
+            b' filename="blocks.yaml"\r\n\r\n'
+            + jsonify(blocks).encode() + b'\r\n--z--\r\n')
+    status, content = call(app, 'PUT', url, body,
+                           'multipart/form-data; boundary=z')
+    assert status == 200
+    assert len(app.profiles.get(name='user').blocks) == 2
+
+
+@pytest.mark.parametrize('storage_class', [LocalStorage, LogStorage])
+def test_put_profile_reads_its_new_blocks(tmp_path, monkeypatch, secret_key,
+                                          storage_class):
+    options = dict(sync_interval=3600) if storage_class is LogStorage else {}
+    storage = storage_class(tmp_path, **options)
+    profiles = Profiles(storage)
+    profile = Profile()
+    profiles.put(profile)
+    calls = []
+    if storage_class is LogStorage:
+        sync, put = storage.blocks.sync, storage.profiles.put
+        monkeypatch.setattr(storage.blocks, 'sync',
+                            lambda: calls.append('sync') or sync())
+        monkeypatch.setattr(storage.profiles, 'put',
+                            lambda entity: calls.append('put') or put(entity))
+    for n in range(1, 5):
+        profile.blocks.add(make_block(secret_key, {'n': n}), verify=False)
+        profiles.put(profile)
+        assert len(profile.blocks) == n
+        assert len(profiles.get(profile.id).blocks) == n
+    if storage_class is LogStorage:
+        # Segments are synced before the profile refers to them
+        assert calls == ['sync', 'put'] * 4
+
+
+@pytest.mark.parametrize('fields', [
+    [], [b''], [b'a', b'', b'bc'], [b'x' * 127, b'y' * 128, b'z' * 70000],
+])
+def test_splitb_inverts_joinb(fields):
+    data = joinb(*fields)
+    assert splitb(data) == fields
+    views = split(data)
+    assert all(isinstance(view, memoryview) for view in views)
+    assert [bytes(view) for view in views] == fields
+
+
+def test_sessions_parse_tokens():
+    now = datetime.datetime(2020, 1, 1)
+    factory = HMACSessionFactory(b'secret', now=lambda: now)
+    session = factory(b'id', b'x' * 200)
+    parsed = factory.parse(session.token)
+    assert parsed
+    assert parsed.data == (b'id', b'x' * 200)
+    assert parsed.expires == now + datetime.timedelta(days=1)
+    assert not HMACSessionFactory(b'other', now=lambda: now).parse(
+        session.token)
+    assert not factory.parse(session.token[:-2])
+    assert not factory.parse('0')
+
+
+def test_ttl_cache_expires_and_evicts():
+    clock = [0]
+    cache = TTLCache(maxsize=2, ttl=10, clock=lambda: clock[0])
+    cache.put('a', 1)
+    cache.put('b', 2, ttl=5)
+    cache.put('c', 3, ttl=0)
+    cache.put('d', 4, ttl=-1)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, 2, None)
+    # A longer ttl is capped by the cache's
+    cache.put('b', 2, ttl=20)
+    clock[0] = 10
+    assert cache.get('a') is None and cache.get('b', 'x') == 'x'
+    assert len(cache) == 0
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert (cache.get('b'), cache.get('a'), cache.get('c')) == (None, 1, 3)
+    assert cache.pop('a') == 1 and cache.pop('a', 'x') == 'x'
+    assert cache.stats() == dict(size=1, maxsize=2, hits=5, misses=4,
+                                 evictions=1, expirations=2)
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_sessions_are_cached_until_they_expire():
+    now = [datetime.datetime(2020, 1, 1)]
+    clock = [0]
+    cache = TTLCache(ttl=60, clock=lambda: clock[0])
+    factory = HMACSessionFactory(b'secret', now=lambda: now[0], cache=cache)
+    token = factory(b'id').token
+    session = factory.parse(token)
+    assert session and factory.parse(token) is session
+    assert (cache.hits, cache.misses, len(cache)) == (1, 1, 1)
+    # Tampered and bytes tokens are verified and never cached
+    tampered = token[:-1] + ('1' if token[-1] != '1' else '2')
+    assert not factory.parse(tampered)
+    assert factory.parse(token.encode()) is not session
+    assert (cache.hits, cache.misses, len(cache)) == (1, 2, 1)
+    clock[0] = 60
+    parsed = factory.parse(token)
+    assert parsed is not session and parsed == session
+    assert cache.expirations == 1
+    # Entries expire with their session when it ends before the cache ttl
+    short = factory(b'id', life=datetime.timedelta(seconds=10)).token
+    assert factory.parse(short) and factory.parse(short)
+    clock[0] += 10
+    now[0] += datetime.timedelta(seconds=10)
+    assert not factory.parse(short)
+    assert len(cache) == 1 and cache.expirations == 2
+
+
+def test_names_are_claimed_once(app):
+    tokens = []
+    for n in range(8):
+        profile = Profile()
+        profile.name = f'user{n}'
+        app.profiles.put(profile)
+        tokens.append(app.session(bytes.fromhex(profile.id)).token)
+    barrier = threading.Barrier(len(tokens))
+
+    def rename(token):
+        barrier.wait()
+        return call(app, 'PUT', f'/profiles/me/name?token={token}',
+                    b'name=taken', 'application/x-www-form-urlencoded')[0]
+
+    with concurrent.futures.ThreadPoolExecutor(len(tokens)) as executor:
+        statuses = list(executor.map(rename, tokens))
+    assert sorted(statuses) == [200] + [409] * 7
+    winner = tokens[statuses.index(200)]
+    assert app.profiles.get(name='taken').id == (
+        app.session.parse(winner).data[0].hex())
+    assert sum(p.name == 'taken' for p in app.profiles.scan()) == 1
+
+
+def asgi_call(app, method, url, chunks=(b'',), headers=()):
+    path, _, query = url.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query.encode(),
+             'headers': [(k.encode(), v.encode()) for k, v in headers]}
+    messages = [{'type': 'http.request', 'body': chunk,
+                 'more_body': i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    content = b''.join(message.get('body', b'') for message in sent[1:])
+    # Also the number of messages the application left unread
+    return sent[0]['status'], content, len(messages)
+
+
+@pytest.fixture
+def asgi_app(app, monkeypatch):
+    monkeypatch.setattr(WSGI.Request, 'max_content_length', 64)
+    r = ASGI(app)
+    yield r
+    r.executor.shutdown()
+
+
+def test_asgi_serves_routes(asgi_app, token):
+    status, content, _ = asgi_call(asgi_app, 'GET',
+                                   f'/profiles/user?token={token}')
+    assert status == 200
+    assert json.loads(content)['name'] == 'user'
+    url = f'/profiles/me/name?token={token}'
+    headers = [('content-type', 'application/x-www-form-urlencoded')]
+    status, _, _ = asgi_call(asgi_app, 'PUT', url, [b'name=', b'renamed'],
+                             headers)
+    assert status == 200
+    url = f'/profiles/renamed?token={token}'
+    assert asgi_call(asgi_app, 'GET', url)[0] == 200
+
+
+def test_asgi_limits_buffered_bodies(asgi_app, token):
+    url = f'/profiles/me/name?token={token}'
+    chunks = [b'x' * 30] * 5
+    assert asgi_call(asgi_app, 'PUT', url, chunks)[::2] == (413, 2)
+    headers = [('content-length', '150')]
+    assert asgi_call(asgi_app, 'PUT', url, chunks, headers)[::2] == (413, 5)
+    headers = [('content-length', 'x')]
+    assert asgi_call(asgi_app, 'PUT', url, chunks, headers)[::2] == (400, 5)
+
+
+def test_asgi_streams_blocks(asgi_app, token, secret_key):
+    blocks = Blocks({})
+    for n in range(3):
+        blocks.add(make_block(secret_key, {'n': n}), verify=False)
+    body = _blocks_document(json.loads(jsonify(blocks)), 'jsonl')
+    assert len(body) > WSGI.Request.max_content_length
+    chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+    headers = [('content-type', 'application/jsonl'),
+               ('content-length', str(len(body)))]
+    status, content, unread = asgi_call(
+        asgi_app, 'PUT', f'/profiles/me/blocks?token={token}', chunks,
+        headers)
+    assert (status, unread) == (200, 0)
+    assert len(json.loads(content)) == 3
+    # Without a Content-Length bodies are buffered and limited
+    status, _, _ = asgi_call(asgi_app, 'PUT',
+                             f'/profiles/me/blocks?token={token}', chunks,
+                             headers[:1])
+    assert status == 413
+
+
+def test_asgi_server(asgi_app, token):
+    async def request(reader, writer, head, body=b''):
+        writer.write(head.encode() + b'\r\n\r\n' + body)
+        fields = (await reader.readuntil(b'\r\n\r\n')).decode().split('\r\n')
+        headers = dict(line.lower().split(': ', 1) for line in fields[1:]
+                       if line)
+        content = await reader.readexactly(int(headers['content-length']))
+        return int(fields[0].split()[1]), headers['connection'], content
+
+    async def main():
+        server = await ASGIServer(asgi_app, '127.0.0.1', 0).start()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                           server.port)
+            get = f'GET /profiles/user?token={token} HTTP/1.1\r\nHost: x'
+            status, connection, content = await request(reader, writer, get)
+            assert (status, connection) == (200, 'keep-alive')
+            assert json.loads(content)['name'] == 'user'
+            body = b'name=' + b'x' * 100
+            put = (f'PUT /profiles/me/name?token={token} HTTP/1.1\r\n'
+                   f'Content-Length: {len(body)}')
+            status, connection, _ = await request(reader, writer, put, body)
+            # The unread rest of the body ends the connection
+            assert (status, connection) == (413, 'close')
+            assert await reader.read() == b''
+            writer.close()
+            reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                           server.port)
+            writer.write(b'GET / HTTP/1.1\r\nContent-Length: -1\r\n\r\n')
+            assert await reader.read() == b''
+            writer.close()
+        finally:
+            server.close()
+
+    asyncio.run(main())
+
+
+@pytest.fixture
+def deliveries():
+    r = Deliveries(max_workers=2, timeout=2, retries=2, backoff=0)
+    yield r
+    r.close()
+
+
+def test_deliveries_retry_server_errors(deliveries):
+    with StubReceiver([500, 429]) as receiver:
+        assert deliveries.post(receiver.url, json={'text': 'password'})
+        assert receiver.messages == [{'text': 'password'}] * 3
+        path, headers, _ = receiver.received[0]
+        assert headers['Content-Type'] == 'application/json'
+        assert headers['User-Agent'].startswith('TrustX/')
+    stats = deliveries.stats()
+    assert (stats['submitted'], stats['delivered'], stats['failed'],
+            stats['retried'], stats['queue_depth']) == (1, 1, 0, 2, 0)
+
+
+def test_deliveries_fail_after_retries(deliveries):
+    with StubReceiver([503] * 3) as receiver:
+        assert not deliveries.post(receiver.url, json={})
+        assert len(receiver.received) == 3
+    # Client errors other than 429 are not retried
+    with StubReceiver([404]) as receiver:
+        assert not deliveries.post(receiver.url, data=b'x')
+        assert [body for _, _, body in receiver.received] == [b'x']
+    stats = deliveries.stats()
+    assert (stats['submitted'], stats['delivered'], stats['failed'],
+            stats['retried']) == (2, 0, 2, 2)
+    assert sum(stats['latency_buckets'].values()) == 2
+    assert stats['latency_sum'] > 0
+
+
+def test_deliveries_without_waiting(deliveries):
+    deliveries.wait = False
+    with StubReceiver(delay=0.2) as receiver:
+        started = time.monotonic()
+        assert deliveries.post(receiver.url, json={})
+        assert time.monotonic() - started < 0.2
+        assert deliveries.stats()['queue_depth'] == 1
+        deliveries.close()
+        assert len(receiver.received) == 1
+    stats = deliveries.stats()
+    assert (stats['queue_depth'], stats['delivered']) == (0, 1)
+    assert stats['latency_sum'] >= 0.2
+
+
+def test_deliveries_reject_beyond_the_queue():
+    deliveries = Deliveries(max_workers=1, max_queue=1, backoff=0)
+    with StubReceiver(delay=0.2) as receiver:
+        first = deliveries.submit(receiver.url, json={})
+        assert deliveries.submit(receiver.url, json={}).result() is False
+        assert first.result() is True
+        deliveries.close()
+    stats = deliveries.stats()
+    assert (stats['submitted'], stats['delivered'],
+            stats['rejected']) == (1, 1, 1)
+
+
+def test_deliveries_reuse_connections(deliveries):
+    with StubReceiver() as receiver:
+        for n in range(3):
+            assert deliveries.post(receiver.url + f'hooks?n={n}', json={})
+        assert [path for path, _, _ in receiver.received] == [
+            '/hooks?n=0', '/hooks?n=1', '/hooks?n=2']
+        idle, = deliveries.pool._idle.values()
+        assert len(idle) == 1
+
+
+def test_password_hooks_are_delivered(app, deliveries, monkeypatch):
+    monkeypatch.setattr(app, 'deliveries', deliveries)
+    with StubReceiver([500]) as receiver:
+        status, hint = call(app, 'POST', '/passwords',
+                            f'hook={receiver.url}'.encode(),
+                            'application/x-www-form-urlencoded')
+        assert status == 200 and json.loads(hint)
+        first, second = receiver.messages
+        assert first == second and len(second['text']) == 8
+    with StubReceiver([400]) as receiver:
+        status, _ = call(app, 'POST', '/passwords',
+                         f'hook={receiver.url}'.encode(),
+                         'application/x-www-form-urlencoded')
+        assert status == 400
+
+
+@pytest.fixture
+def exported(tmp_path, secret_key):
+    profiles = Profiles(LocalStorage(tmp_path))
+    profile = Profile()
+    profile.name = 'user'
+    profile.key = secret_key.public_key
+    profile.blocks.add(make_block(secret_key, {'text': '日本'}), verify=False)
+    profiles.put(profile)
+    return profiles, profile
+
+
+def test_exporter_etags_follow_revisions(exported):
+    profiles, profile = exported
+    exporter = Exporter()
+    etag = exporter.etag(profile, 'public', 'json')
+    assert etag == f'"{profile.id}-{profile.revision}-public-json"'
+    assert len({etag, exporter.etag(profile, 'owner', 'json'),
+                exporter.etag(profile, 'public', 'yaml')}) == 3
+    profile.name = 'renamed'
+    profiles.put(profile)
+    assert exporter.etag(profile, 'public', 'json') != etag
+    assert exporter.etag(profiles.get(profile.id), 'public', 'json') == \
+        exporter.etag(profile, 'public', 'json')
+
+
+def test_exporter_renders_json_and_yaml(exported):
+    _, profile = exported
+    exporter = Exporter()
+    owner = exporter.render(profile, 'owner', 'json')
+    assert json.loads(owner) == json.loads(jsonify(profile))
+    assert yaml.safe_load(exporter.render(profile, 'owner', 'yaml')) == \
+        json.loads(owner)
+    data = exporter.render(profile, 'public', 'yaml')
+    assert '日本'.encode() in data
+    public = yaml.safe_load(data)
+    assert list(public) == ['name', 'id', 'blocks']
+    assert public == json.loads(exporter.render(profile, 'public', 'json'))
+    _, block = public['blocks'].popitem()
+    assert block == {'by': profile.key.hash, 'to': profile.key.hash,
+                     'data': {'text': '日本'}}
+
+
+def test_exporter_caches_renderings_per_revision(exported):
+    profiles, profile = exported
+    exporter = Exporter(cache=TTLCache())
+    data = exporter.render(profile, 'owner', 'json')
+    assert exporter.render(profile, 'owner', 'json') is data
+    assert exporter.render(profile, 'owner', 'yaml') is not data
+    assert (exporter.cache.hits, len(exporter.cache)) == (1, 2)
+    profile.name = 'renamed'
+    profiles.put(profile)
+    assert json.loads(exporter.render(profile, 'owner', 'json'))['name'] == \
+        'renamed'
+    assert len(exporter.cache) == 3
+
+
+def test_get_profile_answers_matching_etags_with_304(app, token):
+    profile = app.profiles.get(name='user')
+    url = f'/profiles/user?token={token}'
+    etag = app.exporter.etag(profile, 'owner', 'json')
+    status, content = call(app, 'GET', url)
+    assert status == 200 and json.loads(content)['name'] == 'user'
+    for if_none_match in (etag, 'W/' + etag, f'"other", {etag}', '*'):
+        assert call(app, 'GET', url, HTTP_IF_NONE_MATCH=if_none_match) == \
+            (304, b'')
+    assert call(app, 'GET', url, HTTP_IF_NONE_MATCH='"other"')[0] == 200
+    status, content = call(app, 'GET', url, HTTP_IF_NONE_MATCH=etag,
+                           HTTP_ACCEPT='application/yaml')
+    assert status == 200 and yaml.safe_load(content)['name'] == 'user'
+    assert call(app, 'GET', url + '&format=xml')[0] == 400
+    # A new revision changes the ETag
+    status, _ = call(app, 'PUT', f'/profiles/me/name?token={token}',
+                     b'name=renamed', 'application/x-www-form-urlencoded')
+    assert status == 200
+    url = f'/profiles/renamed?token={token}'
+    status, content = call(app, 'GET', url, HTTP_IF_NONE_MATCH=etag)
+    assert status == 200 and json.loads(content)['name'] == 'renamed'
+
+
+def test_profiler_writes_slow_requests(tmp_path):
+    app = WSGI()
+
+    @app.route('/slow/<n>', methods=['PUT'])
+    def slow(n):
+        deadline = time.perf_counter() + 0.1
+        while time.perf_counter() < deadline:
+            pass
+        return n
+
+    @app.route('/fast')
+    def fast():
+        return 'fast'
+
+    profiler = Profiler(app, tmp_path, rate=0, threshold=0.05,
+                        interval=0.001)
+    for _ in range(5):
+        assert call(profiler, 'GET', '/fast') == (200, b'fast')
+    assert list(tmp_path.iterdir()) == []
+    assert call(profiler, 'PUT', '/slow/1', b'x' * 2000) == (200, b'1')
+    profile, = tmp_path.iterdir()
+    assert profile.name.endswith('.collapsed')
+    assert '-PUT-slow_n-2000B-' in profile.name
+    stacks = [line.rsplit(' ', 1) for line in profile.read_text().splitlines()]
+    assert sum(int(count) for _, count in stacks) >= 10
+    for stack, _ in stacks:
+        assert stack.startswith('PUT /slow/<n>;size<=16KiB;')
+    line = slow.__code__.co_firstlineno
+    label = f'slow ({__file__}:{line})'
+    assert any(stack.split(';')[-1] == label for stack, _ in stacks)
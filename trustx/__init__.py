@@ -1,23 +1,240 @@
+import collections
+import concurrent.futures
+import functools
 import hashlib
+import itertools
+import multiprocessing
+import os
+import threading
+import time
 
-import base58 as b58
 import ecdsa
+from ecdsa.ellipticcurve import PointJacobi
+
+from .metrics import emit, hooks
 
 __version__ = '0.0.0'
 
 CURVE = ecdsa.SECP256k1
 hashfunc = hashlib.sha256
 
-BASE58_CHARACTERS = b58.BITCOIN_ALPHABET.decode()
+BASE58_CHARACTERS = \
+    '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+# Base58 digits per big integer division, 58 ** 10 still fits in 63 bits
+BASE58_CHUNK = 10
+
+# Batches smaller than this are verified in-process, a pool costs more
+BATCH_POOL_THRESHOLD = 32
+
+# Signers verified at least this many times get precomputed tables
+PRECOMPUTE_THRESHOLD = 4
+
+
+@functools.lru_cache()
+def _base58_tables(alphabet):
+    # Digit pairs for encoding, and a translation of characters to digits
+    # where 255 marks characters outside the alphabet
+    pairs = [bytes((a, b)) for a in alphabet for b in alphabet]
+    divisors = [len(pairs) ** i for i in reversed(range(BASE58_CHUNK // 2))]
+    digits = bytearray(b'\xff' * 256)
+    for i, c in enumerate(alphabet):
+        digits[c] = i
+    return pairs, divisors, bytes(digits)
+
+
+def _base58encode(data, alphabet, pairs, divisors):
+    if isinstance(data, str):
+        data = data.encode('ascii')
+    n = len(data)
+    data = data.lstrip(b'\0')
+    number = int.from_bytes(data, 'big')
+    chunks = []
+    chunk_base = 58 ** BASE58_CHUNK
+    while number:
+        number, chunk = divmod(number, chunk_base)
+        chunks.append(chunk)
+    base = len(pairs)
+    encoded = b''.join([pairs[chunk // d % base]
+                        for chunk in reversed(chunks) for d in divisors])
+    return alphabet[:1] * (n - len(data)) + encoded.lstrip(alphabet[:1])
+
+
+def _base58decode(base58, alphabet, digits):
+    base58 = base58.rstrip()
+    if isinstance(base58, str):
+        base58 = base58.encode('ascii')
+    n = len(base58)
+    base58 = base58.lstrip(alphabet[:1])
+    decoded = base58.translate(digits)
+    if b'\xff' in decoded:
+        c = base58[decoded.index(b'\xff')]
+        raise ValueError(f'Invalid character {chr(c)!r}')
+    number = 0
+    i = 0
+    step = len(decoded) % BASE58_CHUNK or BASE58_CHUNK
+    while i < len(decoded):
+        chunk = 0
+        for digit in decoded[i:i + step]:
+            chunk = chunk * 58 + digit
+        number = number * 58 ** step + chunk
+        i += step
+        step = BASE58_CHUNK
+    return (b'\0' * (n - len(base58))
+            + number.to_bytes((number.bit_length() + 7) // 8, 'big'))
 
 
 def base58encode(data, alphabet=BASE58_CHARACTERS.encode(), returns=str):
-    base58 = b58.b58encode(data, alphabet)
+    pairs, divisors, _ = _base58_tables(alphabet)
+    base58 = _base58encode(data, alphabet, pairs, divisors)
     return base58.decode() if returns == str else base58
 
 
 def base58decode(base58, alphabet=BASE58_CHARACTERS.encode()):
-    return b58.b58decode(base58, alphabet)
+    _, _, digits = _base58_tables(alphabet)
+    return _base58decode(base58, alphabet, digits)
+
+
+def base58encode_many(items, alphabet=BASE58_CHARACTERS.encode(),
+                      returns=str):
+    pairs, divisors, _ = _base58_tables(alphabet)
+    r = [_base58encode(data, alphabet, pairs, divisors) for data in items]
+    return [x.decode() for x in r] if returns == str else r
+
+
+def base58decode_many(items, alphabet=BASE58_CHARACTERS.encode()):
+    _, _, digits = _base58_tables(alphabet)
+    return [_base58decode(base58, alphabet, digits) for base58 in items]
+
+
+def _decode_verifying_key(data):
+    # from_string() drops the curve order, which precompute() requires
+    point = PointJacobi.from_bytes(CURVE.curve, data, order=CURVE.order)
+    return ecdsa.VerifyingKey.from_public_point(point, CURVE, hashfunc)
+
+
+class VerifyingKeyCache:
+    """
+    Bounded LRU cache of VerifyingKey keyed by compressed public key bytes
+    """
+
+    def __init__(self, maxsize=512, precompute_after=PRECOMPUTE_THRESHOLD):
+        self.maxsize = maxsize
+        self.precompute_after = precompute_after
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.precomputes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, data, precompute=False):
+        with self._lock:
+            entry = self._entries.get(data)
+            if entry:
+                self.hits += 1
+                self._entries.move_to_end(data)
+                entry[1] += 1
+            else:
+                self.misses += 1
+        if not entry:
+            entry = self.put(data, _decode_verifying_key(data))
+        vk, n_uses, precomputed = entry
+        if precomputed is False and (precompute
+                                     or n_uses >= self.precompute_after):
+            with self._lock:
+                # One thread precomputes, the others verify without tables
+                claimed = entry[2] is False
+                if claimed:
+                    entry[2] = None
+            if claimed:
+                vk.precompute()
+                with self._lock:
+                    entry[2] = True
+                    self.precomputes += 1
+        return vk
+
+    def put(self, data, vk):
+        with self._lock:
+            entry = self._entries.setdefault(data, [vk, 1, False])
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(size=len(self), maxsize=self.maxsize, hits=self.hits,
+                    misses=self.misses, evictions=self.evictions,
+                    precomputes=self.precomputes)
+
+
+verifying_keys = VerifyingKeyCache()
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after ttl seconds
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                value, deadline = entry
+                if deadline > self.clock():
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value, self.clock() + ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry else default
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(size=len(self), maxsize=self.maxsize, hits=self.hits,
+                    misses=self.misses, evictions=self.evictions,
+                    expirations=self.expirations)
 
 
 class SecretKey:
@@ -54,39 +271,233 @@ class SecretKey:
         return self._sk.sign(data)
 
 
+class PublicKeyTable:
+    """
+    Process-wide interning table of PublicKey by compressed bytes
+
+    Keys are shared so that their memoized keyhash is computed once.
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, data):
+        with self._lock:
+            key = self._keys.get(data)
+            if key:
+                self._keys.move_to_end(data)
+            return key
+
+    def add(self, key):
+        with self._lock:
+            key = self._keys.setdefault(key.encode(), key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+            return key
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+public_keys = PublicKeyTable()
+
+
 class PublicKey:
-    def __init__(self, source):
+    __slots__ = ('_bytes', '_hash')
+
+    def __new__(cls, source, validate=True):
+        # validate=False defers decoding the point to the first verify(),
+        # for compressed bytes that were validated before being stored
+        if isinstance(source, str):
+            source = base58decode(source)
+        if isinstance(source, (bytearray, bytes)) and len(source) != 33:
+            # Other point encodings are normalized to the compressed cache key
+            source = _decode_verifying_key(bytes(source))
         if isinstance(source, (bytearray, bytes)):
-            self._vk = ecdsa.VerifyingKey.from_string(source, CURVE, hashfunc)
-        elif isinstance(source, str):
-            s = base58decode(source)
-            self._vk = ecdsa.VerifyingKey.from_string(s, CURVE, hashfunc)
+            data = bytes(source)
+            key = public_keys.get(data)
+            if key:
+                return key
+            if validate:
+                verifying_keys.get(data)
         else:
-            self._vk = source
+            data = source.to_string('compressed')
+            key = public_keys.get(data)
+            if key:
+                return key
+            verifying_keys.put(data, source)
+        key = super().__new__(cls)
+        object.__setattr__(key, '_bytes', data)
+        return public_keys.add(key)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"'{self.__class__.__name__}' is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"'{self.__class__.__name__}' is immutable")
+
+    def __reduce__(self):
+        return self.__class__, (self._bytes,)
 
     @property
     def hash(self):
+        try:
+            return self._hash
+        except AttributeError:
+            pass
         rip = hashlib.new('ripemd160', hashfunc(self.encode()).digest())
         keyhash = b'\0' + rip.digest()
         checksum = hashfunc(hashfunc(keyhash).digest()).digest()[:4]
-        return base58encode(keyhash + checksum)
+        object.__setattr__(self, '_hash', base58encode(keyhash + checksum))
+        return self._hash
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return self.__dict__ == other.__dict__
+            return self._bytes == other._bytes
         return False
 
     def __hash__(self):
-        return hash(self.encode())
+        return hash(self._bytes)
 
     def __str__(self):
         return base58encode(self.encode())
 
     def encode(self):
-        return self._vk.to_string('compressed')
+        return self._bytes
 
     def verify(self, signature, *, data):
         try:
-            return self._vk.verify(signature, data)
+            r = verifying_keys.get(self._bytes).verify(signature, data)
+        except ecdsa.BadSignatureError:
+            r = False
+        if hooks:
+            emit('trustx_signatures_verified_total', 1,
+                 _VERIFIED_LABELS[bool(r)])
+        return r
+
+
+_VERIFIED_LABELS = {True: (('result', 'valid'),),
+                    False: (('result', 'invalid'),)}
+
+
+def _emit_verified(n_items, failed):
+    emit('trustx_signatures_verified_total', n_items - len(failed),
+         _VERIFIED_LABELS[True])
+    emit('trustx_signatures_verified_total', len(failed),
+         _VERIFIED_LABELS[False])
+
+
+def _verify_group(data, entries):
+    vk = verifying_keys.get(data, len(entries) >= PRECOMPUTE_THRESHOLD)
+    failed = []
+    for index, signature, message in entries:
+        try:
+            vk.verify(signature, message)
         except ecdsa.BadSignatureError:
-            return False
+            failed.append(index)
+    return failed
+
+
+def _pool_context():
+    # Forked workers of a threaded server would inherit locks held by its
+    # other threads, forkserver and spawn start them from a clean process
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        'forkserver' if 'forkserver' in methods else 'spawn')
+
+
+_executor = None
+_executor_pid = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(processes=None):
+    """
+    Return the shared process pool and its number of workers
+    """
+    global _executor, _executor_pid, _executor_workers
+    with _executor_lock:
+        if (_executor is None or _executor_pid != os.getpid()
+                or processes and processes != _executor_workers):
+            # A pool inherited by a forked child belongs to the parent
+            if _executor is not None and _executor_pid == os.getpid():
+                _executor.shutdown(wait=False)
+            _executor_workers = processes or os.cpu_count() or 1
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                _executor_workers, mp_context=_pool_context())
+            _executor_pid = os.getpid()
+        return _executor, _executor_workers
+
+
+def verify_many(items, processes=None):
+    """
+    Verify (PublicKey, signature, message) items, return the failed indices
+    """
+    groups = {}
+    n_items = 0
+    for index, (key, signature, message) in enumerate(items):
+        groups.setdefault(key.encode(), []).append((index, signature, message))
+        n_items += 1
+    if processes == 1 or n_items < BATCH_POOL_THRESHOLD:
+        failed = sorted(i for data, entries in groups.items()
+                        for i in _verify_group(data, entries))
+    else:
+        executor, n_workers = _get_executor(processes)
+        chunk_size = max(PRECOMPUTE_THRESHOLD, -(-n_items // n_workers))
+        futures = [executor.submit(_verify_group, data,
+                                   entries[i:i + chunk_size])
+                   for data, entries in groups.items()
+                   for i in range(0, len(entries), chunk_size)]
+        failed = sorted(i for f in futures for i in f.result())
+    if hooks:
+        _emit_verified(n_items, failed)
+    return failed
+
+
+_signer = None
+
+
+def _init_signer(data):
+    global _signer
+    _signer = ecdsa.SigningKey.from_string(data, CURVE, hashfunc)
+    # The first signature builds the generator tables of this worker
+    _signer.sign(b'')
+
+
+def _sign_group(messages):
+    return [_signer.sign(message) for message in messages]
+
+
+def sign_many(key, messages, processes=None, chunk_size=64):
+    """
+    Sign messages with a SecretKey, yielding signatures in input order
+
+    Messages are read lazily and signed in chunks on a process pool whose
+    workers load the key once, unless they fit in one chunk.
+    """
+    messages = iter(messages)
+    chunk = list(itertools.islice(messages, chunk_size))
+    if processes == 1 or len(chunk) < chunk_size:
+        while chunk:
+            yield from (key.sign(message) for message in chunk)
+            chunk = list(itertools.islice(messages, chunk_size))
+        return
+    n_workers = processes or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(
+            n_workers, mp_context=_pool_context(), initializer=_init_signer,
+            initargs=(key.encode(),)) as executor:
+        pending = collections.deque()
+        while chunk:
+            pending.append(executor.submit(_sign_group, chunk))
+            if len(pending) >= 2 * n_workers:
+                yield from pending.popleft().result()
+            chunk = list(itertools.islice(messages, chunk_size))
+        while pending:
+            yield from pending.popleft().result()
@@ -1,9 +1,27 @@
 import argparse
 import datetime
+import itertools
+import json
 import pathlib
 import sys
+import time
+
+from . import (PublicKey, SecretKey, base58decode, base58encode, sign_many,
+               verify_many)
+
+# Files verified per verify_many() call in batch mode
+VERIFY_CHUNK_SIZE = 1024
+
+
+def iter_files(path):
+    return (x for x in sorted(path.iterdir()) if x.is_file())
+
+
+def report(action, n, elapsed):
+    rate = n / elapsed if elapsed else 0
+    print(f'{action} {n} files in {elapsed:.2f}s ({rate:.0f} files/s)',
+          file=sys.stderr)
 
-from . import PublicKey, SecretKey, base58encode
 
 parser = argparse.ArgumentParser()
 subparsers = parser.add_subparsers(dest='command', required=True)
@@ -15,13 +33,19 @@ subparser.add_argument('--public-key', type=pathlib.Path)
 subparser = subparsers.add_parser('concat')
 subparser.add_argument('data', type=pathlib.Path, nargs='+')
 
-subparser = subparsers.add_parser('sign')
+subparser = subparsers.add_parser(
+    'sign', help='sign a file, or every file of a directory writing '
+                 'JSON lines of path and signature')
 subparser.add_argument('--secret-key', type=pathlib.Path, required=True)
+subparser.add_argument('--processes', type=int)
 subparser.add_argument('data', type=pathlib.Path, nargs='?')
 
-subparser = subparsers.add_parser('verify')
+subparser = subparsers.add_parser(
+    'verify', help='verify a signature of a file, or the JSON lines '
+                   'written by sign for a directory')
 subparser.add_argument('--public-key', type=pathlib.Path, required=True)
 subparser.add_argument('--data', type=pathlib.Path, required=True)
+subparser.add_argument('--processes', type=int)
 subparser.add_argument('signature', type=pathlib.Path, nargs='?')
 
 subparser = subparsers.add_parser('hash')
@@ -54,18 +78,56 @@ if args.command == 'gen':
 if args.command == 'concat':
     sys.stdout.buffer.write(b''.join(x.read_bytes() for x in args.data))
 
-if args.command == 'sign':
+if args.command == 'sign' and args.data and args.data.is_dir():
+    sk = SecretKey(args.secret_key.read_bytes())
+    files = list(iter_files(args.data))
+    started = time.perf_counter()
+    signatures = sign_many(sk, (x.read_bytes() for x in files),
+                           args.processes)
+    for n_signed, (path, sig) in enumerate(zip(files, signatures), 1):
+        print(json.dumps(dict(path=str(path), signature=base58encode(sig))),
+              flush=n_signed % 1024 == 0)
+    report('Signed', len(files), time.perf_counter() - started)
+
+elif args.command == 'sign':
     sk = SecretKey(args.secret_key.read_bytes())
     data = args.data.read_bytes() if args.data else sys.stdin.buffer.read()
     sys.stdout.buffer.write(sk.sign(data))
 
-if args.command == 'verify':
+if args.command == 'verify' and args.data.is_dir():
+    pk = PublicKey(args.public_key.read_bytes())
+    started = time.perf_counter()
+    n_verified = 0
+    n_failed = 0
+    stream = args.signature.open('rb') if args.signature else sys.stdin.buffer
+    lines = (json.loads(line) for line in stream if line.strip())
+    while True:
+        chunk = list(itertools.islice(lines, VERIFY_CHUNK_SIZE))
+        if not chunk:
+            break
+        paths = [x['path'] for x in chunk]
+        failed = verify_many([
+            (pk, base58decode(x['signature']),
+             (args.data / pathlib.Path(x['path']).name).read_bytes())
+            for x in chunk], args.processes)
+        for i in failed:
+            print('Error: Invalid signature', paths[i])
+        n_verified += len(chunk)
+        n_failed += len(failed)
+    report('Verified', n_verified, time.perf_counter() - started)
+    if n_failed:
+        exit(1)
+    print('OK')
+
+elif args.command == 'verify':
     pk = PublicKey(args.public_key.read_bytes())
     if args.signature:
         sig = args.signature.read_bytes()
     else:
         sig = sys.stdin.buffer.read()
-    pk.verify(sig, data=args.data.read_bytes())
+    if not pk.verify(sig, data=args.data.read_bytes()):
+        print('Error: Invalid signature', file=sys.stderr)
+        exit(1)
     print('OK')
 
 if args.command == 'hash':
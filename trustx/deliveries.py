@@ -0,0 +1,233 @@
+import bisect
+import concurrent.futures
+import http.client
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+from . import __version__
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections pooled per scheme, host and port
+    """
+
+    def __init__(self, maxsize=4, timeout=5):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, host, port):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port,
+                                               timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def acquire(self, scheme, host, port):
+        with self._lock:
+            idle = self._idle.get((scheme, host, port))
+            if idle:
+                return idle.pop(), True
+        return self._connect(scheme, host, port), False
+
+    def release(self, scheme, host, port, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host, port), [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        parts = urllib.parse.urlsplit(url)
+        key = parts.scheme, parts.hostname, parts.port
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        while True:
+            conn, reused = self.acquire(*key)
+            try:
+                conn.request(method, target, body, headers or {})
+                resp = conn.getresponse()
+                resp.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError,
+                    ConnectionResetError):
+                conn.close()
+                if reused:
+                    # The server closed an idle keep-alive connection
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self.release(*key, conn)
+            return resp.status
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+
+class Deliveries:
+    """
+    Queued webhook delivery on a bounded worker pool with retries
+    """
+
+    LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, max_workers=4, max_queue=1024, timeout=5, retries=3,
+                 backoff=0.5, wait=True):
+        self.max_queue = max_queue
+        self.retries = retries
+        self.backoff = backoff
+        self.wait = wait
+        self.pool = ConnectionPool(maxsize=max_workers, timeout=timeout)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix='trustx-delivery')
+        self.queue_depth = 0
+        self.submitted = 0
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self._lock = threading.Lock()
+
+    def submit(self, url, **kwargs):
+        headers = {'User-Agent': 'TrustX/' + __version__}
+        if 'json' in kwargs:
+            body = json.dumps(kwargs['json']).encode()
+            headers['Content-Type'] = 'application/json'
+        else:
+            body = kwargs.get('data')
+        with self._lock:
+            if self.queue_depth >= self.max_queue:
+                self.rejected += 1
+                future = concurrent.futures.Future()
+                future.set_result(False)
+                return future
+            self.queue_depth += 1
+            self.submitted += 1
+        return self.executor.submit(self._deliver, url, body, headers,
+                                    time.monotonic())
+
+    def post(self, url, **kwargs):
+        """
+        Deliver like servers.post(), without waiting unless configured to
+        """
+        future = self.submit(url, **kwargs)
+        return future.result() if self.wait else True
+
+    def _deliver(self, url, body, headers, queued):
+        ok = False
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    with self._lock:
+                        self.retried += 1
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    status = self.pool.request('POST', url, body, headers)
+                except (OSError, http.client.HTTPException):
+                    continue
+                if status < 400:
+                    ok = True
+                    break
+                if status < 500 and status != 429:
+                    break
+        finally:
+            latency = time.monotonic() - queued
+            i = bisect.bisect_left(self.LATENCY_BUCKETS, latency)
+            with self._lock:
+                self.queue_depth -= 1
+                if ok:
+                    self.delivered += 1
+                else:
+                    self.failed += 1
+                self.latency_sum += latency
+                self.latency_buckets[i] += 1
+        return ok
+
+    def stats(self):
+        with self._lock:
+            return dict(queue_depth=self.queue_depth,
+                        submitted=self.submitted, delivered=self.delivered,
+                        failed=self.failed, retried=self.retried,
+                        rejected=self.rejected, latency_sum=self.latency_sum,
+                        latency_buckets=dict(zip(
+                            self.LATENCY_BUCKETS + (float('inf'),),
+                            self.latency_buckets)))
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        self.pool.close()
+
+
+class StubReceiver:
+    """
+    Local HTTP server recording the hooks it receives, for tests
+
+    Responds with the statuses in order, then 200, after delay seconds.
+    """
+
+    def __init__(self, statuses=(), delay=0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.received = []
+        receiver = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                if receiver.delay:
+                    time.sleep(receiver.delay)
+                with receiver._lock:
+                    receiver.received.append((self.path, dict(self.headers),
+                                              body))
+                    status = (receiver.statuses.pop(0) if receiver.statuses
+                              else 200)
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self.server.daemon_threads = True
+        # Polled often so that leaving the context does not wait 0.5s
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        kwargs=dict(poll_interval=0.01),
+                                        daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}/'
+
+    @property
+    def messages(self):
+        return [json.loads(body) for _, _, body in self.received]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,129 @@
+import datetime
+import json
+
+import yaml
+
+from . import PublicKey, base58encode, base58encode_many
+from .profiles import Blocks
+
+# The libyaml emitter when PyYAML was built with it
+YAMLDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+FORMATS = {'json': 'application/json', 'yaml': 'application/yaml'}
+
+# Profile fields rendered per view, every public field when None
+VIEWS = {'owner': None, 'public': ('id', 'name')}
+
+_MAP_TAG = 'tag:yaml.org,2002:map'
+
+
+def _keyhashes():
+    # Keyhashes of stored key bytes, memoized for one rendering
+    hashes = {}
+
+    def keyhash(data):
+        try:
+            return hashes[data]
+        except KeyError:
+            r = hashes[data] = PublicKey(data, validate=False).hash
+            return r
+    return keyhash
+
+
+def _default(value):
+    if isinstance(value, bytes):
+        return base58encode(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, PublicKey):
+        return value.hash
+    raise TypeError(f'{value.__class__.__name__} is not JSON serializable')
+
+
+# Same separators as servers.jsonify(), the C encoder is used when possible
+_encode_json = json.JSONEncoder(default=_default).encode
+
+
+def render_json(fields, blocks):
+    parts = ['{']
+    for name, value in fields:
+        parts += [_encode_json(name), ': ', _encode_json(value), ', ']
+    parts.append('"blocks": {')
+    values = blocks.values
+    keyhash = _keyhashes()
+    separator = ''
+    for sig, block_ in zip(base58encode_many(list(values)), values.values()):
+        # Base58 signatures and keyhashes never need escaping
+        parts += [separator, '"', sig, '": {"by": "', keyhash(block_['by']),
+                  '", "to": "', keyhash(block_['to']), '", "data": ',
+                  _encode_json(block_['data']), '}']
+        separator = ', '
+    parts.append('}}')
+    return ''.join(parts).encode()
+
+
+class _ExportDumper(YAMLDumper):
+    def ignore_aliases(self, data):
+        return True
+
+
+def _represent_blocks(dumper, blocks):
+    values = blocks.values
+    keyhash = _keyhashes()
+    node = yaml.MappingNode(_MAP_TAG, [])
+    for sig, block_ in zip(base58encode_many(list(values)), values.values()):
+        node.value.append((dumper.represent_str(sig), yaml.MappingNode(
+            _MAP_TAG, [
+                (dumper.represent_str('by'),
+                 dumper.represent_str(keyhash(block_['by']))),
+                (dumper.represent_str('to'),
+                 dumper.represent_str(keyhash(block_['to']))),
+                (dumper.represent_str('data'),
+                 dumper.represent_data(block_['data']))])))
+    return node
+
+
+_ExportDumper.add_representer(Blocks, _represent_blocks)
+_ExportDumper.add_representer(
+    bytes, lambda dumper, value: dumper.represent_str(base58encode(value)))
+_ExportDumper.add_representer(
+    PublicKey, lambda dumper, value: dumper.represent_str(value.hash))
+
+
+def render_yaml(fields, blocks):
+    return yaml.dump(dict(fields, blocks=blocks), Dumper=_ExportDumper,
+                     sort_keys=False, allow_unicode=True, encoding='utf-8')
+
+
+RENDERERS = {'json': render_json, 'yaml': render_yaml}
+
+
+class Exporter:
+    """
+    Render profiles to JSON or YAML, cached per profile revision
+
+    Renderings are identified by an ETag of the profile id, revision, view
+    and format, which are known before anything is rendered.
+    """
+
+    def __init__(self, cache=None):
+        # Optional TTLCache of rendered bytes by ETag
+        self.cache = cache
+
+    def etag(self, profile, view='public', format='json'):
+        return f'"{profile.id}-{profile.revision}-{view}-{format}"'
+
+    def render(self, profile, view='public', format='json'):
+        etag = self.etag(profile, view, format)
+        if self.cache is not None:
+            data = self.cache.get(etag)
+            if data is not None:
+                return data
+        names = VIEWS[view]
+        fields = [(k, v) for k, v in vars(profile).items()
+                  if not k.startswith('_') and k != 'blocks'
+                  and (names is None or k in names)]
+        data = RENDERERS[format](fields, profile.blocks)
+        if self.cache is not None:
+            self.cache.put(etag, data)
+        return data
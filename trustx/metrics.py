@@ -0,0 +1,289 @@
+"""
+Instrumentation hooks and Prometheus metrics
+
+Measurements are passed to the callables in `hooks` as (name, value,
+labels), where labels is a tuple of (key, value) pairs.  Nothing is
+measured while `hooks` is empty.
+"""
+import bisect
+import functools
+import importlib
+import inspect
+import math
+import threading
+import time
+
+# Callables receiving every measurement, see the module docstring
+hooks = []
+
+
+def emit(name, value, labels=()):
+    for hook in hooks:
+        hook(name, value, labels)
+
+
+# Operations timed while enabled, as trustx_operation_duration_seconds
+OPERATIONS = (
+    ('trustx.profiles', 'Profiles.get'),
+    ('trustx.profiles', 'Profiles.import_blocks'),
+    ('trustx.sessions', 'HMACSessionFactory.parse'),
+    ('trustx.servers', 'post'),
+)
+
+_originals = []
+
+
+def _timed(f, operation):
+    labels = (('operation', operation),)
+
+    if inspect.isgeneratorfunction(f):
+        # Generators are timed until exhausted, including their consumers
+        @functools.wraps(f)
+        def timed_generator(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return (yield from f(*args, **kwargs))
+            finally:
+                emit('trustx_operation_duration_seconds',
+                     time.perf_counter() - start, labels)
+        return timed_generator
+
+    @functools.wraps(f)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            emit('trustx_operation_duration_seconds',
+                 time.perf_counter() - start, labels)
+    return timed
+
+
+def enable(hook):
+    """
+    Add a hook and time OPERATIONS, which are left untouched until then
+    """
+    if not _originals:
+        for module_name, path in OPERATIONS:
+            owner = importlib.import_module(module_name)
+            *owner_path, name = path.split('.')
+            for attr in owner_path:
+                owner = getattr(owner, attr)
+            f = vars(owner)[name]
+            _originals.append((owner, name, f))
+            setattr(owner, name, _timed(f, path))
+    hooks.append(hook)
+    return hook
+
+
+def disable():
+    hooks.clear()
+    while _originals:
+        owner, name, f = _originals.pop()
+        setattr(owner, name, f)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = (f'{k}="{_escape(v)}"' for k, v in labels)
+    return '{' + ','.join(pairs) + '}'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class Metrics:
+    """
+    Hook keeping counters and histograms in the Prometheus text format
+
+    Measurements named *_seconds are observed by histograms, the others
+    are added to counters.  Gauges are read from collectors when rendered.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        # Per labels, counts of each bucket and +Inf, then the sum
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def __call__(self, name, value, labels=()):
+        key = name, labels
+        if name.endswith('_seconds'):
+            i = bisect.bisect_left(self.buckets, value)
+            with self._lock:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = [0] * (len(self.buckets) + 1) + [0.0]
+                    self._histograms[key] = histogram
+                histogram[i] += 1
+                histogram[-1] += value
+        else:
+            with self._lock:
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_collector(self, collector):
+        """
+        Add a callable returning (name, labels, value) gauges when rendered
+        """
+        self._collectors.append(collector)
+        return collector
+
+    def add_stats(self, prefix, stats, **labels):
+        """
+        Collect the numbers of a stats() method as gauges named prefix_key
+        """
+        labels = tuple(labels.items())
+
+        def collect():
+            for k, v in stats().items():
+                if isinstance(v, (int, float)):
+                    yield f'{prefix}_{k}', labels, v
+        return self.add_collector(collect)
+
+    def add_cache(self, name, cache):
+        """
+        Collect the stats() of a cache, with its hit ratio
+        """
+        labels = (('cache', name),)
+
+        def collect():
+            stats = cache.stats()
+            for k, v in stats.items():
+                yield f'trustx_cache_{k}', labels, v
+            lookups = stats['hits'] + stats['misses']
+            yield ('trustx_cache_hit_ratio', labels,
+                   stats['hits'] / lookups if lookups else 0.0)
+        return self.add_collector(collect)
+
+    def samples(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        return counters, histograms
+
+    def render(self):
+        counters, histograms = self.samples()
+        lines = []
+        typed = set()
+
+        def declare(name, type_):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {type_}')
+
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, 'counter')
+            lines.append(f'{name}{_format_labels(labels)}'
+                         f' {_format_value(value)}')
+        for (name, labels), histogram in sorted(histograms.items()):
+            declare(name, 'histogram')
+            count = 0
+            for le, n in zip(self.buckets + (math.inf,), histogram):
+                count += n
+                bucket_labels = labels + (('le', _format_value(le)),)
+                lines.append(f'{name}_bucket{_format_labels(bucket_labels)}'
+                             f' {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)}'
+                         f' {_format_value(histogram[-1])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        gauges = sorted((name, labels, value)
+                        for collector in self._collectors
+                        for name, labels, value in collector())
+        for name, labels, value in gauges:
+            declare(name, 'gauge')
+            lines.append(f'{name}{_format_labels(labels)}'
+                         f' {_format_value(value)}')
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class InstrumentedKind:
+    """
+    Kind counting its operations as trustx_storage_operations_total
+    """
+
+    def __init__(self, kind, name, labels):
+        self.kind = kind
+        self.name = name
+        self.labels = labels
+
+    def __getattr__(self, name):
+        return getattr(self.kind, name)
+
+    def _count(self, operation):
+        emit('trustx_storage_operations_total', 1, self.labels[operation])
+
+    def __iter__(self):
+        self._count('iter')
+        return iter(self.kind)
+
+    def __len__(self):
+        return len(self.kind)
+
+    def __contains__(self, id):
+        self._count('get')
+        return id in self.kind
+
+    def get(self, id):
+        self._count('get')
+        return self.kind.get(id)
+
+    def put(self, entity):
+        self._count('put')
+        return self.kind.put(entity)
+
+    def delete(self, id):
+        self._count('delete')
+        return self.kind.delete(id)
+
+    def scan(self, start_after=None, limit=None):
+        self._count('scan')
+        return self.kind.scan(start_after, limit)
+
+
+class InstrumentedStorage:
+    """
+    Storage whose kinds count their operations per kind
+    """
+
+    OPERATIONS = ('iter', 'get', 'put', 'delete', 'scan')
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._kinds = {}
+
+    def __getattr__(self, name):
+        kind = self._kinds.get(name.replace('_', '-'))
+        if kind is not None and kind.kind is self.storage[kind.name]:
+            return kind
+        if (name.startswith('_') or hasattr(type(self.storage), name)
+                or name in vars(self.storage)):
+            return getattr(self.storage, name)
+        return self[name.replace('_', '-')]
+
+    def __getitem__(self, key):
+        kind = self.storage[key]
+        r = self._kinds.get(key)
+        # Kinds may be created again, e.g. by SQLiteStorage in transactions
+        if r is None or r.kind is not kind:
+            labels = {op: (('kind', key), ('operation', op))
+                      for op in self.OPERATIONS}
+            r = self._kinds[key] = InstrumentedKind(kind, key, labels)
+        return r
@@ -0,0 +1,139 @@
+import itertools
+import os
+import pathlib
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+
+from .metrics import emit, hooks
+
+# Upper bounds of the request size classes tagged on profiles
+SIZE_CLASSES = ((1 << 10, '1KiB'), (1 << 14, '16KiB'), (1 << 18, '256KiB'),
+                (1 << 22, '4MiB'), (1 << 26, '64MiB'))
+
+
+def size_class(size):
+    for limit, name in SIZE_CLASSES:
+        if size <= limit:
+            return f'size<={name}'
+    return f'size>{SIZE_CLASSES[-1][1]}'
+
+
+class Profiler:
+    """
+    WSGI middleware writing stack samples of requests as collapsed stacks
+
+    A sampler thread of each process samples the stacks of the threads
+    calling the application every interval seconds.  The samples of a
+    request are written when it is among the rate fraction of requests
+    picked at random, or when it took threshold seconds or more, and are
+    discarded otherwise.  Requests shorter than the interval are rarely
+    sampled at all and leave no profile.  Each profile is one file of
+    `frame;frame count` lines, as read by flamegraph.pl and speedscope,
+    under root frames of the route and the request size class.
+    """
+
+    def __init__(self, app, directory, rate=0.01, threshold=1.0,
+                 interval=0.005):
+        self.app = app
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.rate = rate
+        self.threshold = threshold
+        self.interval = interval
+        self._labels = {}
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # The sampler thread and a held lock do not survive fork()
+            os.register_at_fork(after_in_child=self._reset)
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._active = {}
+        self._sampler = None
+        self._seq = itertools.count()
+
+    def _start(self):
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(
+                    target=self._sample, name='trustx-profiler',
+                    daemon=True)
+                self._sampler.start()
+
+    def _sample(self):
+        root = Profiler.__call__.__code__
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None and frame.f_code is not root:
+                        stack.append(frame.f_code)
+                        frame = frame.f_back
+                    key = tuple(stack)
+                    samples[key] = samples.get(key, 0) + 1
+
+    def __call__(self, environ, respond):
+        sampled = random.random() < self.rate
+        if not sampled and self.threshold is None:
+            return self.app(environ, respond)
+        if self._sampler is None:
+            self._start()
+        thread_id = threading.get_ident()
+        samples = {}
+        with self._lock:
+            self._active[thread_id] = samples
+        start = time.perf_counter()
+        try:
+            return self.app(environ, respond)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                del self._active[thread_id]
+            slow = self.threshold is not None and elapsed >= self.threshold
+            if samples and (sampled or slow):
+                self._write(environ, elapsed, samples)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            where = f'{code.co_filename}:{code.co_firstlineno}'
+            label = f'{code.co_name} ({where})'.replace(';', ':')
+            self._labels[code] = label
+        return label
+
+    def _write(self, environ, elapsed, samples):
+        method = environ.get('REQUEST_METHOD', '')
+        route = environ.get('trustx.route') or environ.get('PATH_INFO', '')
+        try:
+            size = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            size = 0
+        roots = f'{method} {route}'.replace(';', ':'), size_class(size)
+        lines = []
+        for stack, count in samples.items():
+            frames = itertools.chain(roots, map(self._label, reversed(stack)))
+            lines.append(f"{';'.join(frames)} {count}\n")
+        slug = re.sub(r'[^0-9A-Za-z]+', '_', route).strip('_')
+        name = (f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+                f'-{next(self._seq)}-{method}-{slug}-{size}B'
+                f'-{elapsed * 1000:.0f}ms.collapsed')
+        try:
+            with (self.directory / name).open('x') as f:
+                f.writelines(lines)
+        except OSError:
+            traceback.print_exc()
+            return
+        if hooks:
+            emit('trustx_profiles_written_total', 1)
@@ -1,10 +1,17 @@
+import contextlib
+import copy
 import datetime
+import functools
 import hashlib
+import itertools
 import json
+import sys
+import uuid
 
 import yaml
 
-from . import PublicKey, base58decode, base58encode
+from . import (PublicKey, base58decode, base58decode_many, base58encode,
+               verify_many)
 
 
 def _stringify(value, target=json):
@@ -37,43 +44,144 @@ def _stringify_yaml(data, target=yaml):
     return _stringify(data, yaml)
 
 
+# The libyaml loader when PyYAML was built with it
+YAMLLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Blocks verified per verify_many() call while importing
+VERIFY_CHUNK_SIZE = 1024
+
+
+# Canonical JSON of block messages, built once instead of per json.dumps()
+_canonical_json = json.JSONEncoder(default=_stringify, separators=(',', ':'),
+                                   sort_keys=True).encode
+
+
 class Block:
+    __slots__ = ('_by', '_to', '_data', 'signature', '_message')
+
+    def __init__(self, by=None, to=None, data=None, signature=None):
+        # by and to may be stored key bytes, decoded on first access
+        self._by = by
+        self._to = to
+        self._data = data
+        self.signature = signature
+        self._message = None
+
+    @property
+    def by(self):
+        if isinstance(self._by, bytes):
+            self._by = PublicKey(self._by, validate=False)
+        return self._by
+
+    @by.setter
+    def by(self, value):
+        self._by = value
+        self._message = None
+
+    @property
+    def to(self):
+        if isinstance(self._to, bytes):
+            self._to = PublicKey(self._to, validate=False)
+        return self._to
+
+    @to.setter
+    def to(self, value):
+        self._to = value
+        self._message = None
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._message = None
+
     @classmethod
     def serialize(self, data):
-        return json.dumps(data, default=_stringify, separators=(',', ':'),
-                          sort_keys=True).encode('utf-8')
+        return _canonical_json(data).encode('utf-8')
+
+    @property
+    def message(self):
+        """
+        Canonical bytes signed by the block, serialized once per block
+
+        Reassigning by, to or data resets it; mutate data in place only
+        before the first use.
+        """
+        if self._message is None:
+            self._message = self.serialize(dict(by=self.by, to=self.to,
+                                                data=self.data))
+        return self._message
 
     def verify(self):
-        data = dict(by=self.by, to=self.to, data=self.data)
-        return self.by.verify(self.signature, data=self.serialize(data))
+        return self.by.verify(self.signature, data=self.message)
 
 
 class Blocks:
-    def __init__(self, values):
-        self.__dict__ = values
+    """
+    View over the stored blocks of a profile, by signature
+
+    Blocks are built on iteration without decoding their keys, which are
+    interned and shared by every block signed by or for them. Given load,
+    the stored blocks are only read once something reads the view, adding
+    and removing just records the changes for Profiles.put() to append.
+    """
+
+    __slots__ = ('_values', '_changes', '_load')
+
+    def __init__(self, values, changes=None, load=None):
+        self._values = values
+        self._changes = changes
+        self._load = load
+
+    @property
+    def values(self):
+        if self._values is None:
+            values = self._load() if self._load else {}
+            for sig, block_ in (self._changes or {}).items():
+                if block_ is None:
+                    values.pop(sig, None)
+                else:
+                    values[sig] = block_
+            self._values = values
+        return self._values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, signature):
+        return signature in self.values
+
+    def __getitem__(self, signature):
+        block_ = self.values[signature]
+        return Block(block_['by'], block_['to'], block_['data'], signature)
 
     def __iter__(self):
-        for sig, block_ in self.__dict__.items():
-            block = Block()
-            block.by = PublicKey(block_['by'])
-            block.to = PublicKey(block_['to'])
-            block.data = block_['data']
-            block.signature = sig
-            yield block
+        for sig, block_ in self.values.items():
+            yield Block(block_['by'], block_['to'], block_['data'], sig)
 
     def add(self, value, verify=True):
         if verify and not value.verify():
             raise ValueError('invalid block')
-        self.__dict__[value.signature] = dict(by=value.by.encode(),
-                                              to=value.to.encode(),
-                                              data=value.data)
-
-    def update(self, values):
+        block_ = dict(by=value.by.encode(), to=value.to.encode(),
+                      data=value.data)
+        if self._values is not None:
+            self._values[value.signature] = block_
+        if self._changes is not None:
+            self._changes[value.signature] = block_
+
+    def update(self, values, verify=True):
         for value in values:
-            self.add(value)
+            self.add(value, verify=verify)
 
     def remove(self, signature):
-        del self.__dict__[signature]
+        if signature not in self.values:
+            raise KeyError(signature)
+        del self.values[signature]
+        if self._changes is not None:
+            self._changes[signature] = None
 
 
 class Profile:
@@ -83,6 +191,7 @@ class Profile:
         if key:
             self._key = key
         self._changes = {}
+        self._blocks_changes = {}
 
     def __bool__(self):
         return bool(self.__dict__)
@@ -104,19 +213,143 @@ class Profile:
         self.__dict__['key'] = value.hash
         self._key = value
 
+    @property
+    def revision(self):
+        # Incremented by every Profiles.put()
+        return self._revision or 0
+
     @property
     def blocks(self):
-        if 'blocks' not in self.__dict__:
-            self.__dict__['blocks'] = {}
-        return Blocks(self.__dict__['blocks'])
+        return Blocks(self.__dict__.get('blocks'), self._blocks_changes,
+                      self._read_blocks)
+
+    def _read_blocks(self):
+        blocks = self._load_blocks() if self._load_blocks else {}
+        self.__dict__['blocks'] = blocks
+        return blocks
+
+
+def _chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _compose_yaml(loader, anchors):
+    # Composer.compose_node() over loader events, which the libyaml loader
+    # does not expose, so that one entry at a time is held as nodes
+    event = loader.get_event()
+    if isinstance(event, yaml.AliasEvent):
+        if event.anchor not in anchors:
+            raise yaml.composer.ComposerError(
+                None, None, f'found undefined alias {event.anchor!r}',
+                event.start_mark)
+        return anchors[event.anchor]
+    if isinstance(event, yaml.ScalarEvent):
+        node_class = yaml.ScalarNode
+    elif isinstance(event, yaml.SequenceStartEvent):
+        node_class = yaml.SequenceNode
+    else:
+        node_class = yaml.MappingNode
+    tag = event.tag
+    if tag is None or tag == '!':
+        value = event.value if node_class is yaml.ScalarNode else None
+        tag = loader.resolve(node_class, value, event.implicit)
+    if node_class is yaml.ScalarNode:
+        node = yaml.ScalarNode(tag, event.value, event.start_mark,
+                               event.end_mark, style=event.style)
+    else:
+        node = node_class(tag, [], event.start_mark, None,
+                          flow_style=event.flow_style)
+    if event.anchor:
+        anchors[event.anchor] = node
+    if node_class is yaml.SequenceNode:
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(_compose_yaml(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+    elif node_class is yaml.MappingNode:
+        while not loader.check_event(yaml.MappingEndEvent):
+            node.value.append((_compose_yaml(loader, anchors),
+                               _compose_yaml(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+    return node
+
+
+def _iter_yaml_blocks(stream):
+    loader = YAMLLoader(stream)
+    try:
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            return
+        loader.get_event()
+        anchors = {}
+        if not loader.check_event(yaml.MappingStartEvent):
+            node = _compose_yaml(loader, anchors)
+            if loader.construct_document(node) is None:
+                return
+            line = node.start_mark.line + 1
+            raise ValueError(f'line {line}: expected a mapping of blocks')
+        loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose_yaml(loader, anchors)
+            value = _compose_yaml(loader, anchors)
+            yield (f'line {key.start_mark.line + 1}',
+                   loader.construct_document(key),
+                   loader.construct_document(value))
+        loader.get_event()
+        loader.get_event()
+        if not loader.check_event(yaml.StreamEndEvent):
+            line = loader.peek_event().start_mark.line + 1
+            raise ValueError(f'line {line}: expected a single document')
+    except yaml.YAMLError as e:
+        raise ValueError(str(e)) from None
+    finally:
+        loader.dispose()
+
+
+def _iter_jsonl_blocks(stream):
+    for lineno, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f'line {lineno}: {e}') from None
+        if not isinstance(entry, dict):
+            raise ValueError(f'line {lineno}: expected an object of blocks')
+        for signature, block_ in entry.items():
+            yield f'line {lineno}', signature, block_
+
+
+def iter_blocks(stream, format='yaml'):
+    """
+    Iterate (position, signature, block) of a blocks document
+
+    The yaml format is the {signature: block} mapping signed by the CLI,
+    parsed one entry at a time. The jsonl format has one such mapping per
+    line. Either way the document is never held in memory as a whole.
+    """
+    if format == 'yaml':
+        return _iter_yaml_blocks(stream)
+    if format == 'jsonl':
+        return _iter_jsonl_blocks(stream)
+    raise ValueError(f'unknown blocks format: {format}')
 
 
 class Profiles:
     _BLOCK_REQUIRED_KEYS = set('by to data'.split())
     _BLOCK_OPTIONAL_KEYS = set()
 
-    def __init__(self, storage):
+    # Reads of the segment list before a missing segment is an error
+    SEGMENT_READ_ATTEMPTS = 3
+
+    def __init__(self, storage, cache=None):
         self.storage = storage
+        # Optional TTLCache of profile entities by id, cleared by put()
+        self.cache = cache
 
     def __len__(self):
         return len(self.storage.profiles)
@@ -137,117 +370,424 @@ class Profiles:
             idx = self.storage.hooks.get(hook_id)
         if idx:
             id = idx['profile_id']
+        if id and self.cache is not None:
+            cached = self.cache.get(id)
+            if cached:
+                return self._profile(*cached)
         if id:
             entity = self.storage.profiles.get(id)
             if entity:
-                if 'key' in entity:
-                    if not idx_key:
-                        idx_key = self.storage.keys.get(entity['key'])
-                    pk = PublicKey(idx_key['bytes'])
+                key = self._load_key(entity, idx_key)
+                if self.cache is not None:
+                    self.cache.put(id, (entity, key))
+                return self._profile(entity, key)
+
+    def _profile(self, entity, key):
+        # Handlers modify profiles in place, keep the cached entity intact
+        entity = copy.deepcopy(entity)
+        segments = entity.pop('block_segments', [])
+        revision = entity.pop('revision', 0)
+        profile = Profile(entity, key)
+        profile._block_segments = segments
+        profile._revision = revision
+        if 'blocks' in entity:
+            # Blocks stored inline by older versions move to a segment on
+            # the next put()
+            profile._blocks_changes = dict(entity['blocks'])
+        elif segments:
+            profile._load_blocks = functools.partial(
+                self._read_segments, entity['id'], segments)
+        return profile
+
+    def _load_key(self, entity, idx_key=None):
+        if 'key' in entity:
+            if not idx_key:
+                idx_key = self.storage.keys.get(entity['key'])
+            return PublicKey(idx_key['bytes'])
+
+    def _load(self, entity, idx_key=None):
+        return self._profile(entity, self._load_key(entity, idx_key))
+
+    def _read_segments(self, profile_id, segments):
+        for attempt in range(self.SEGMENT_READ_ATTEMPTS):
+            if attempt == self.SEGMENT_READ_ATTEMPTS - 1:
+                # put() merges segments in a transaction, wait for them
+                context = self.storage.transaction()
+            else:
+                context = contextlib.nullcontext()
+            with context:
+                if attempt:
+                    # Merged away by a concurrent put(), read them again
+                    entity = self.storage.profiles.get(profile_id) or {}
+                    segments = entity.get('block_segments', [])
+                blocks = {}
+                for seq, _ in segments:
+                    segment_id = f'{profile_id}-{seq}'
+                    segment = self.storage.blocks.get(segment_id)
+                    if segment is None:
+                        break
+                    for sig in segment.get('removed', ()):
+                        blocks.pop(sig, None)
+                    blocks.update(segment['blocks'])
                 else:
-                    pk = None
-                return Profile(entity, pk)
+                    return blocks
+        # Lost rather than merged, e.g. by a crash before an fsync
+        raise LookupError(f'missing block segment: {segment_id}')
+
+    def _append_blocks(self, profile_id, segments, changes):
+        """
+        Write changed blocks as a new segment of the profile's block log
+
+        Trailing segments no larger than the new one are merged into it, so
+        a profile keeps O(log n) segments to read and appending k blocks
+        writes amortized O(k log n) blocks, never the whole profile.
+        Returns the new segment list and the sequence numbers merged away.
+        """
+        blocks = {sig: b for sig, b in changes.items() if b is not None}
+        removed = {sig for sig, b in changes.items() if b is None}
+        segments = list(segments)
+        seq = segments[-1][0] + 1 if segments else 0
+        merged = []
+        while segments and segments[-1][1] <= len(blocks) + len(removed):
+            old_seq, _ = segments.pop()
+            old = self.storage.blocks.get(f'{profile_id}-{old_seq}')
+            old_blocks = {sig: b for sig, b in old['blocks'].items()
+                          if sig not in removed}
+            old_blocks.update(blocks)
+            blocks = old_blocks
+            removed = (removed | set(old.get('removed', ()))) - blocks.keys()
+            merged.append(old_seq)
+        segment = dict(id=f'{profile_id}-{seq}', blocks=blocks)
+        if removed and segments:
+            segment['removed'] = sorted(removed)
+        self.storage.blocks.put(segment)
+        segments.append([seq, len(blocks) + len(segment.get('removed', ()))])
+        return segments, merged
+
+    def scan(self, start_after=None, limit=None):
+        for entity in self.storage.profiles.scan(start_after, limit):
+            yield self._load(entity)
 
     def put(self, profile):
-        entity = {k: v for k, v in vars(profile).items()
-                  if not k.startswith('_')}
-        self.storage.profiles.put(entity)
-        profile.id = entity['id']
-
-        if 'name' in profile._changes:
-            old, new = profile._changes['name'], profile.name
-            if old:
-                self.storage.profile_names.delete(old)
-            self.storage.profile_names.put(dict(id=new, profile_id=profile.id))
-
-        if 'key' in profile._changes:
-            old, new = profile._changes['key'], profile.key
-            if old:
-                self.storage.keys.delete(old.hash)
-            self.storage.keys.put(dict(id=new.hash, bytes=new.encode(),
-                                       profile_id=profile.id))
-
-        if 'hook' in profile._changes:
-            old, new = profile._changes['hook'], profile.hook
-            if old:
-                old_id = hashlib.sha1(old.encode()).hexdigest()
-                self.storage.hooks.delete(old_id)
-            new_id = hashlib.sha1(new.encode()).hexdigest()
-            self.storage.hooks.put(dict(id=new_id, profile_id=profile.id))
+        """
+        Store a profile with its changed blocks and its indices
+
+        If another thread or process put the profile since it was read,
+        the changed blocks are appended to the stored ones, and the fields
+        changed on this profile are set over the stored fields.  The other
+        fields keep their stored values, which the profile is updated with.
+        """
+        with self.storage.transaction():
+            entity = {k: v for k, v in vars(profile).items()
+                      if not k.startswith('_') and k != 'blocks'}
+            if 'id' not in entity:
+                entity['id'] = uuid.uuid4().hex
+                stored = None
+            else:
+                stored = self.storage.profiles.get(entity['id'])
+            segments = profile._block_segments or []
+            revision = profile.revision
+            if stored and stored.get('revision', 0) != revision:
+                segments = stored.get('block_segments', [])
+                revision = stored.get('revision', 0)
+                changed = {k: entity[k] for k in profile._changes
+                           if k in entity}
+                entity = {k: v for k, v in stored.items()
+                          if k not in ('block_segments', 'revision',
+                                       'blocks')}
+                entity.update(changed)
+            merged = []
+            if profile._blocks_changes:
+                segments, merged = self._append_blocks(
+                    entity['id'], segments, profile._blocks_changes)
+                # The new segment must not be lost once the profile refers
+                # to it, e.g. by LogStorage deferring fsync
+                sync = getattr(self.storage.blocks, 'sync', None)
+                if sync:
+                    sync()
+            if segments:
+                entity['block_segments'] = segments
+            entity['revision'] = revision + 1
+            self.storage.profiles.put(entity)
+            for seq in merged:
+                self.storage.blocks.delete(f"{entity['id']}-{seq}")
+
+            # Indices are updated from the stored values, which may have
+            # been changed by another writer
+            old = stored or {}
+            if 'name' in profile._changes:
+                if old.get('name'):
+                    self.storage.profile_names.delete(old['name'])
+                self.storage.profile_names.put(dict(id=entity['name'],
+                                                    profile_id=entity['id']))
+
+            if 'key' in profile._changes:
+                if old.get('key'):
+                    self.storage.keys.delete(old['key'])
+                self.storage.keys.put(dict(id=profile.key.hash,
+                                           bytes=profile.key.encode(),
+                                           profile_id=entity['id']))
+
+            if 'hook' in profile._changes:
+                if old.get('hook'):
+                    old_id = hashlib.sha1(old['hook'].encode()).hexdigest()
+                    self.storage.hooks.delete(old_id)
+                new_id = hashlib.sha1(entity['hook'].encode()).hexdigest()
+                self.storage.hooks.put(dict(id=new_id,
+                                            profile_id=entity['id']))
+
+            if entity.get('key') != vars(profile).get('key'):
+                # Set by the other writer
+                profile._key = self._load_key(entity)
+            fields = {k: v for k, v in entity.items()
+                      if k not in ('block_segments', 'revision')}
+            vars(profile).update(fields)
+            profile._block_segments = segments
+            profile._blocks_changes = {}
+            # Blocks read before are stale once other segments were merged
+            vars(profile).pop('blocks', None)
+            profile._load_blocks = (
+                functools.partial(self._read_segments, entity['id'],
+                                  segments) if segments else None)
+            profile._revision = entity['revision']
+            profile._changes = {}
+
+        if self.cache is not None:
+            self.cache.pop(profile.id)
 
     def parse_blocks(self, blocks, verify=True):
         r = Blocks({})
+        entries = ((None, sig, block_) for sig, block_ in blocks.items())
+        r.update(self.import_blocks(entries, verify=verify), verify=False)
+        return r
+
+    def import_blocks(self, entries, verify=True,
+                      chunk_size=VERIFY_CHUNK_SIZE):
+        """
+        Validate and verify (position, signature, block) entries lazily
+
+        Blocks are yielded chunk by chunk once verified, errors raise
+        ValueError prefixed with the position of the offending block.
+        """
+        for chunk in _chunked(self._parse_entries(entries), chunk_size):
+            if verify:
+                failed = verify_many([(block.by, block.signature,
+                                       block.message)
+                                      for _, block in chunk])
+                if failed:
+                    position, block = chunk[failed[0]]
+                    signature = base58encode(block.signature)
+                    raise ValueError(_at(position,
+                                         f'invalid block: {signature}'))
+            for _, block in chunk:
+                yield block
+
+    def _parse_entries(self, entries):
         required_keys = self._BLOCK_REQUIRED_KEYS
         valid_keys = required_keys | self._BLOCK_OPTIONAL_KEYS
-        for signature, block_ in blocks.items():
+        keys = {}
+        for position, signature, block_ in entries:
+            if not isinstance(block_, dict):
+                raise ValueError(_at(position, 'block must be a mapping'))
             included = block_.keys() & required_keys
             if included != required_keys:
-                keys = ', '.join(required_keys - included)
-                raise ValueError(f"missing required keys: {keys}")
+                missing = ', '.join(required_keys - included)
+                raise ValueError(_at(position,
+                                     f'missing required keys: {missing}'))
             invalid_keys = block_.keys() - valid_keys
             if invalid_keys:
-                keys = ', '.join(invalid_keys)
-                raise ValueError(f"invalid keys: {keys}")
+                invalid = ', '.join(invalid_keys)
+                raise ValueError(_at(position, f'invalid keys: {invalid}'))
+            if len(keys) > 1024:
+                keys.clear()
+            if not isinstance(signature, str):
+                raise ValueError(_at(position, 'signature must be a string'))
+            for name in ('by', 'to'):
+                if not isinstance(block_[name], str):
+                    raise ValueError(_at(position,
+                                         f'{name} must be a key hash'))
             block = Block()
-            by = self.storage.keys.get(block_['by'])
-            if not by:
-                raise ValueError(f"not registered: {block_['by']}")
-            to = self.storage.keys.get(block_['to'])
-            if not to:
-                raise ValueError(f"not registered: {block_['to']}")
-            block.by = PublicKey(by['bytes'])
-            block.to = PublicKey(to['bytes'])
+            for name in ('by', 'to'):
+                keyhash = block_[name]
+                if keyhash not in keys:
+                    idx = self.storage.keys.get(keyhash)
+                    if not idx:
+                        raise ValueError(_at(position,
+                                             f'not registered: {keyhash}'))
+                    keys[keyhash] = PublicKey(idx['bytes'], validate=False)
+                setattr(block, name, keys[keyhash])
             block.data = block_['data']
-            signed = block.data.get('signed')
-            if isinstance(signed, str):
-                block.data['signed'] = datetime.datetime.fromisoformat(signed)
-            block.signature = base58decode(signature)
-            r.add(block, verify)
-        return r
+            signed = (block.data.get('signed')
+                      if isinstance(block.data, dict) else None)
+            try:
+                if isinstance(signed, str):
+                    block.data['signed'] = \
+                        datetime.datetime.fromisoformat(signed)
+                block.signature = base58decode(signature)
+            except ValueError as e:
+                raise ValueError(_at(position, str(e))) from None
+            yield position, block
+
+
+def _at(position, message):
+    return f'{position}: {message}' if position else message
+
+
+def _format_signed(sig, block, output):
+    blocks = {sig: block}
+    if output == 'yaml':
+        return yaml.dump(_stringify_yaml(blocks), sort_keys=False).strip()
+    if output == 'jsonl':
+        return json.dumps(blocks, default=_stringify)
+    return json.dumps(blocks, default=_stringify, indent=4)
+
+
+def _iter_unsigned(path):
+    # (position, block) of a directory of block files or a JSON-lines stream
+    if path and path.is_dir():
+        for file in sorted(path.iterdir()):
+            if file.suffix in ('.yaml', '.yml', '.json'):
+                try:
+                    block = yaml.load(file.read_bytes(), Loader=YAMLLoader)
+                except yaml.YAMLError as e:
+                    raise ValueError(f'{file}: {e}') from None
+                yield str(file), block
+        return
+    stream = path.open('rb') if path else sys.stdin.buffer
+    for lineno, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield f'line {lineno}', json.loads(line)
+            except ValueError as e:
+                raise ValueError(f'line {lineno}: {e}') from None
+
+
+def _iter_signed(path, format):
+    # (position, signature, block) of blocks documents in a file, stdin or
+    # every *.yaml, *.yml, *.json and *.jsonl file of a directory
+    if path and path.is_dir():
+        for file in sorted(path.iterdir()):
+            if file.suffix in ('.yaml', '.yml', '.json', '.jsonl'):
+                with file.open('rb') as f:
+                    format = 'jsonl' if file.suffix == '.jsonl' else 'yaml'
+                    for position, sig, block in iter_blocks(f, format):
+                        yield f'{file}: {position}', sig, block
+        return
+    if not format:
+        format = 'jsonl' if path and path.suffix == '.jsonl' else 'yaml'
+    with (path.open('rb') if path else sys.stdin.buffer) as f:
+        yield from iter_blocks(f, format)
+
+
+def _report(action, n, elapsed):
+    rate = n / elapsed if elapsed else 0
+    print(f'{action} {n} blocks in {elapsed:.2f}s ({rate:.0f} blocks/s)',
+          file=sys.stderr)
 
 
 if __name__ == '__main__':
     import argparse
+    import collections
     import pathlib
-    import sys
-    from . import SecretKey
+    import time
+    from . import SecretKey, sign_many
 
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest='command', required=True)
 
-    subparser = subparsers.add_parser('sign')
+    subparser = subparsers.add_parser(
+        'sign', help='sign a block, or a batch of them given a directory of '
+                     'block files or --format jsonl with a block per line')
     subparser.add_argument('--secret-key', type=pathlib.Path, required=True)
-    subparser.add_argument('--output', type=str, default='yaml')
+    subparser.add_argument('--output', type=str, default='yaml',
+                           choices=['yaml', 'json', 'jsonl'])
+    subparser.add_argument('--format', type=str, choices=['yaml', 'jsonl'],
+                           help='default: jsonl for *.jsonl files, else yaml')
+    subparser.add_argument('--processes', type=int)
     subparser.add_argument('data', type=pathlib.Path, nargs='?')
 
-    subparser = subparsers.add_parser('verify')
+    subparser = subparsers.add_parser(
+        'verify', help='verify a blocks document, or every one of a '
+                       'directory')
     subparser.add_argument('--public-key', type=pathlib.Path, required=True)
+    subparser.add_argument('--format', type=str, choices=['yaml', 'jsonl'],
+                           help='default: jsonl for *.jsonl files, else yaml')
+    subparser.add_argument('--processes', type=int)
     subparser.add_argument('data', type=pathlib.Path, nargs='?')
 
     args = parser.parse_args()
 
     if args.command == 'sign':
         sk = SecretKey(args.secret_key.read_bytes())
+        format = args.format
+        if not format and args.data and args.data.suffix == '.jsonl':
+            format = 'jsonl'
+        batch = format == 'jsonl' or args.data and args.data.is_dir()
+        if batch and args.output == 'json':
+            parser.error('--output json takes a single block, use jsonl')
+
+    if args.command == 'sign' and not batch:
         data = args.data.read_bytes() if args.data else sys.stdin.buffer.read()
-        block = yaml.safe_load(data)
+        block = yaml.load(data, Loader=YAMLLoader)
         if block['by'] != sk.public_key.hash:
             print('Error: Invalid signer, fix the "by" in file.',
                   file=sys.stderr)
             exit(1)
         sig = base58encode(sk.sign(Block.serialize(block)))
-        blocks = {sig: block}
-        if args.output == 'yaml':
-            out = yaml.dump(_stringify_yaml(blocks), sort_keys=False).strip()
-        else:
-            out = json.dumps(blocks, default=_stringify, indent=4)
-        print(out)
+        print(_format_signed(sig, block, args.output))
+
+    if args.command == 'sign' and batch:
+        signer = sk.public_key.hash
+        pending = collections.deque()
+        errors = []
+
+        def messages():
+            for position, block in _iter_unsigned(args.data):
+                if not isinstance(block, dict) or block.get('by') != signer:
+                    print(f'Error: {position}: Invalid signer',
+                          file=sys.stderr)
+                    errors.append(position)
+                    continue
+                pending.append(block)
+                yield Block.serialize(block)
+
+        started = time.perf_counter()
+        n_signed = 0
+        try:
+            for sig in sign_many(sk, messages(), args.processes):
+                block = pending.popleft()
+                print(_format_signed(base58encode(sig), block, args.output),
+                      flush=n_signed % 1024 == 0)
+                n_signed += 1
+        except ValueError as e:
+            print('Error:', e, file=sys.stderr)
+            exit(1)
+        _report('Signed', n_signed, time.perf_counter() - started)
+        if errors:
+            exit(1)
 
     if args.command == 'verify':
         pk = PublicKey(args.public_key.read_bytes())
-        data = args.data.read_bytes() if args.data else sys.stdin.buffer.read()
-        blocks = yaml.safe_load(data)
-        for i, (sig, block) in enumerate(blocks.items()):
-            if not pk.verify(base58decode(sig), data=Block.serialize(block)):
-                print('Error: Invalid signature', sig)
-                exit(1)
+        started = time.perf_counter()
+        n_verified = 0
+        n_failed = 0
+        try:
+            entries = _iter_signed(args.data, args.format)
+            for chunk in _chunked(entries, VERIFY_CHUNK_SIZE):
+                sigs = [sig for _, sig, _ in chunk]
+                failed = verify_many([
+                    (pk, sig, Block.serialize(block))
+                    for sig, (_, _, block) in zip(base58decode_many(sigs),
+                                                  chunk)],
+                    args.processes)
+                for i in failed:
+                    print('Error: Invalid signature', sigs[i])
+                n_verified += len(chunk)
+                n_failed += len(failed)
+        except ValueError as e:
+            print('Error:', e, file=sys.stderr)
+            exit(1)
+        _report('Verified', n_verified, time.perf_counter() - started)
+        if n_failed:
+            exit(1)
         print('OK')
@@ -0,0 +1,272 @@
+import concurrent.futures
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+import wsgiref.simple_server
+
+
+class RequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        if self.server.access_log:
+            super().log_message(*args)
+
+
+class WorkerServer(wsgiref.simple_server.WSGIServer):
+    """
+    WSGI server of one worker process, handling requests on a thread pool
+
+    The socket is either bound by the worker with SO_REUSEPORT, so the
+    kernel balances connections between workers, or inherited from the
+    master.
+    """
+
+    request_queue_size = 1024
+
+    def __init__(self, address, app, threads=1, sock=None, reuse_port=False,
+                 access_log=False):
+        self.reuse_port = reuse_port
+        self.access_log = access_log
+        self.executor = None
+        if threads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                threads, thread_name_prefix='trustx-worker')
+        super().__init__(address, RequestHandler,
+                         bind_and_activate=sock is None)
+        if sock is not None:
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+            self.server_name = socket.getfqdn(self.server_address[0])
+            self.server_port = self.server_address[1]
+            self.setup_environ()
+        self.set_app(app)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        if self.executor is None:
+            return super().process_request(request, client_address)
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        if self.executor is not None:
+            # Requests already accepted are answered before the worker exits
+            self.executor.shutdown(wait=True)
+
+
+class PreforkServer:
+    """
+    Pre-fork WSGI server, worker processes share nothing but the port
+
+    Each worker calls setup(app) after it is forked, so storages,
+    connection pools and caches are never shared between processes.
+    SIGTERM and SIGINT stop the workers gracefully, SIGHUP replaces them
+    with new workers once the old ones are draining.  Workers that do not
+    finish their requests within graceful_timeout seconds are killed.
+    """
+
+    def __init__(self, app, host='', port=8000, workers=None, threads=1,
+                 setup=None, teardown=None, graceful_timeout=30,
+                 reuse_port=None, access_log=False):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('PreforkServer requires os.fork()')
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.setup = setup
+        self.teardown = teardown
+        self.graceful_timeout = graceful_timeout
+        if reuse_port is None:
+            # Only Linux balances connections between SO_REUSEPORT sockets
+            reuse_port = (sys.platform.startswith('linux')
+                          and hasattr(socket, 'SO_REUSEPORT'))
+        self.reuse_port = reuse_port
+        self.access_log = access_log
+        self.socket = None
+        self._active = {}
+        self._draining = {}
+        self._signals = []
+        self._respawn_after = 0
+
+    def bind(self):
+        """
+        Bind the port in the master, resolving port 0 before forking
+
+        With SO_REUSEPORT the master socket never listens, so the kernel
+        never queues connections on it.
+        """
+        sock = socket.socket(socket.AF_INET6 if ':' in self.host
+                             else socket.AF_INET)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        if not self.reuse_port:
+            sock.listen(WorkerServer.request_queue_size)
+        self.port = sock.getsockname()[1]
+        self.socket = sock
+        return self
+
+    def serve_forever(self):
+        if self.socket is None:
+            self.bind()
+        r, w = os.pipe()
+        os.set_blocking(r, False)
+        os.set_blocking(w, False)
+        old_wakeup_fd = signal.set_wakeup_fd(w)
+        handled = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                   signal.SIGCHLD)
+        old_handlers = {signum: signal.signal(signum, self._signal)
+                        for signum in handled}
+        try:
+            while True:
+                self._reap()
+                signals, self._signals = self._signals, []
+                if signal.SIGTERM in signals or signal.SIGINT in signals:
+                    break
+                if signal.SIGHUP in signals:
+                    self.reload()
+                self._maintain()
+                self._kill_overdue()
+                select.select([r], [], [], 1.0)
+                try:
+                    while os.read(r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+        finally:
+            self.stop()
+            signal.set_wakeup_fd(old_wakeup_fd)
+            for signum, handler in old_handlers.items():
+                signal.signal(signum, handler)
+            os.close(r)
+            os.close(w)
+
+    def _signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def reload(self):
+        """
+        Start new workers, then drain the old ones
+        """
+        old = list(self._active)
+        self._active.clear()
+        self._maintain(force=True)
+        for pid in old:
+            self._drain(pid)
+
+    def stop(self):
+        for pid in list(self._active):
+            self._drain(pid)
+        while self._draining:
+            self._reap()
+            self._kill_overdue()
+            time.sleep(0.05)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def _drain(self, pid):
+        self._active.pop(pid, None)
+        self._draining[pid] = time.monotonic() + self.graceful_timeout
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self._draining.items()):
+            if now > deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self._draining.pop(pid, None)
+            started = self._active.pop(pid, None)
+            if started is not None:
+                print(f'Worker {pid} exited with status {status}',
+                      file=sys.stderr)
+                if time.monotonic() - started < 1:
+                    # Crashing on start, do not fork in a tight loop
+                    self._respawn_after = time.monotonic() + 1
+
+    def _maintain(self, force=False):
+        if not force and time.monotonic() < self._respawn_after:
+            return
+        while len(self._active) < self.workers:
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker()
+            self._active[pid] = time.monotonic()
+
+    def _run_worker(self):
+        code = 0
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # Ctrl-C reaches the whole process group, the master drains
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            if self.setup:
+                self.setup(self.app)
+            storage = getattr(self.app, 'storage', None)
+            if self.workers > 1 and not getattr(storage, 'multiprocess',
+                                                True):
+                raise RuntimeError(f'{storage.__class__.__name__} can not'
+                                   ' be shared by worker processes')
+            if self.reuse_port:
+                self.socket.close()
+                server = WorkerServer((self.host, self.port), self.app,
+                                      self.threads, reuse_port=True,
+                                      access_log=self.access_log)
+            else:
+                server = WorkerServer((self.host, self.port), self.app,
+                                      self.threads, sock=self.socket,
+                                      access_log=self.access_log)
+
+            def drain(signum, frame):
+                # shutdown() waits for serve_forever() of this very thread
+                threading.Thread(target=server.shutdown).start()
+
+            signal.signal(signal.SIGTERM, drain)
+            server.serve_forever()
+            server.server_close()
+            if self.teardown:
+                self.teardown(self.app)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
@@ -1,36 +1,128 @@
 import argparse
-import cgi
+import asyncio
+import concurrent.futures
 import datetime
 import enum
 import html
 import io
 import json
+import pathlib
 import random
 import re
 import threading
+import time
+import traceback
 import urllib.error
 import urllib.parse
 import urllib.request
 
-import yaml
-
-from . import (BASE58_CHARACTERS, PublicKey, __version__, base58decode,
-               base58encode)
-from .profiles import Blocks, Profile, Profiles
+from . import (BASE58_CHARACTERS, PublicKey, TTLCache, __version__,
+               base58decode, base58encode, base58encode_many)
+from .exports import FORMATS, Exporter
+from .metrics import Metrics, emit, hooks
+from .profiles import Blocks, Profile, Profiles, iter_blocks
 from .sessions import HMACSessionFactory, encode_datetime, joinb, splitb
 
 
+class HTTPError(Exception):
+    def __init__(self, status, *args, **kwargs):
+        self.status = status
+        super().__init__(*args, **kwargs)
+
+
+class LimitedInput:
+    """
+    Read at most length bytes of a WSGI input stream
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        r = self.stream.read(size)
+        self.remaining -= len(r)
+        return r
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        r = self.stream.readline(size)
+        self.remaining -= len(r)
+        return r
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+_header_param_pattern = re.compile(
+    r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+
+def parse_header(value):
+    """
+    Split a header such as Content-Type into its value and parameters
+    """
+    params = {}
+    for k, v in _header_param_pattern.findall(value):
+        v = v.strip()
+        if len(v) >= 2 and v[0] == v[-1] == '"':
+            v = re.sub(r'\\(.)', r'\1', v[1:-1])
+        params[k.lower()] = v
+    return value.split(';', 1)[0].strip().lower(), params
+
+
+def parse_multipart(body, boundary, charset='utf-8'):
+    """
+    Parse a multipart/form-data body into (name, value) pairs
+
+    Values of file parts are bytes, the others are decoded strings.
+    """
+    fields = []
+    delimiter = b'\r\n--' + boundary.encode('latin-1')
+    for part in (b'\r\n' + body).split(delimiter)[1:]:
+        if part.startswith(b'--'):
+            break
+        # Transport padding may follow the delimiter up to its line break
+        head, sep, value = part.partition(b'\r\n\r\n')
+        if not sep:
+            raise ValueError('malformed multipart body')
+        headers = {}
+        for line in head.split(b'\r\n')[1:]:
+            k, _, v = line.decode('latin-1').partition(':')
+            headers[k.strip().lower()] = v.strip()
+        _, params = parse_header(headers.get('content-disposition', ''))
+        if 'name' not in params:
+            continue
+        if 'filename' in params:
+            fields.append((params['name'], value))
+        else:
+            _, type_params = parse_header(headers.get('content-type', ''))
+            encoding = type_params.get('charset', charset)
+            fields.append((params['name'], value.decode(encoding, 'replace')))
+    return fields
+
+
 class WSGI:
     statuses = {int(x.split(maxsplit=1)[0]): x.split(maxsplit=1)[1]
                 for x in """
 200 OK
 302 Found
+304 Not Modified
 400 Bad Request
 401 Unauthorized
 403 Forbidden
 404 Not Found
 405 Method Not Allowed
 409 Conflict
+413 Payload Too Large
+500 Internal Server Error
 """.strip().splitlines()}
 
     default_headers = [('Access-Control-Allow-Origin', '*')]
@@ -40,8 +132,21 @@ class WSGI:
     route_arg_pattern = re.compile('<([^>]+)>')
 
     class Request:
+        """
+        Request of the current thread, parsed at most once per request
+
+        Parsed values are kept in the WSGI environ, which lives exactly as
+        long as the request.
+        """
+
         _tl = threading.local()
 
+        # Bodies read into memory, larger ones are answered with 413
+        max_content_length = 1 << 20
+
+        # Bodies read as a stream, such as imported blocks
+        max_stream_length = 1 << 30
+
         @property
         def environ(self):
             return self._tl.environ
@@ -56,58 +161,188 @@ class WSGI:
 
         @property
         def content_type(self):
-            return self.environ['CONTENT_TYPE']
+            return self.environ.get('CONTENT_TYPE', '')
+
+        @property
+        def content_length(self):
+            try:
+                return int(self.environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                raise HTTPError(400)
+
+        @property
+        def stream(self):
+            length = self.content_length
+            if length > self.max_stream_length:
+                raise HTTPError(413)
+            return LimitedInput(self.environ['wsgi.input'], length)
 
         @property
         def data(self):
-            content_length = int(self.environ.get('CONTENT_LENGTH') or 0)
-            r = self.environ['wsgi.input'].read(content_length)
-            self.environ['wsgi.input'] = io.BytesIO(r)
-            self.environ['wsgi.input'].seek(0)
+            environ = self.environ
+            r = environ.get('trustx.body')
+            if r is None:
+                length = self.content_length
+                if length > self.max_content_length:
+                    raise HTTPError(413)
+                r = environ['trustx.body'] = environ['wsgi.input'].read(length)
+                environ['wsgi.input'] = io.BytesIO(r)
             return r
 
+        @property
+        def json(self):
+            environ = self.environ
+            if 'trustx.json' not in environ:
+                data = self.data
+                try:
+                    environ['trustx.json'] = json.loads(data) if data else None
+                except ValueError:
+                    raise HTTPError(400)
+            return environ['trustx.json']
+
         @property
         def form(self):
-            fp = io.BytesIO(self.data)
-            form = cgi.FieldStorage(fp=fp, environ=self.environ)
-            return {k: form[k].value for k in form}
+            """
+            Fields of the query string updated by those of the body
+
+            Bodies are urlencoded, multipart or a JSON object.
+            """
+            environ = self.environ
+            r = environ.get('trustx.form')
+            if r is None:
+                r = dict(urllib.parse.parse_qsl(
+                    environ.get('QUERY_STRING', '')))
+                if self.method not in ('GET', 'HEAD'):
+                    r.update(self._parse_body())
+                environ['trustx.form'] = r
+            return r
+
+        def _parse_body(self):
+            mimetype, params = parse_header(self.content_type)
+            if mimetype == 'multipart/form-data':
+                try:
+                    return parse_multipart(self.data, params['boundary'])
+                except (KeyError, ValueError):
+                    raise HTTPError(400)
+            if mimetype == 'application/json':
+                body = self.json
+                if not isinstance(body, dict):
+                    return ()
+                # Fields are strings as in the other formats
+                if not all(isinstance(v, str) for v in body.values()):
+                    raise HTTPError(400)
+                return body.items()
+            if mimetype in ('', 'application/x-www-form-urlencoded'):
+                return urllib.parse.parse_qsl(
+                    self.data.decode('utf-8', 'replace'), errors='replace')
+            return ()
 
         @property
         def args(self):
-            args = urllib.parse.parse_qs(self.environ['QUERY_STRING'])
-            return {k: html.escape(v[-1]) for k, v in args.items()}
+            environ = self.environ
+            r = environ.get('trustx.args')
+            if r is None:
+                args = urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+                r = environ['trustx.args'] = {
+                    k: html.escape(v[-1]) for k, v in args.items()}
+            return r
 
     request = Request()
 
+    # Optional deliveries.Deliveries for hooks, post() is used without it
+    deliveries = None
+
+    # Optional TTLCache shared by the Profiles of every request
+    profile_cache = None
+
+    # Optional TTLCache of rendered profiles by ETag
+    render_cache = None
+
+    # Optional metrics.Metrics served on /metrics
+    metrics = None
+
+    class RouteNode:
+        __slots__ = ('children', 'param', 'handlers', 'methods')
+
+        def __init__(self):
+            self.children = {}
+            self.param = None
+            self.handlers = []
+            self.methods = set()
+
     def __init__(self):
         self._handlers = []
+        self._routes = self.RouteNode()
 
     def _respond(self, respond, status, headers=None):
         respond(f'{status} {self.statuses[status]}',
                 self.default_headers + (headers or []))
 
+    def _compile(self, route, f, options):
+        node = self._routes
+        arg_names = []
+        for part in route.split('/'):
+            m = self.route_arg_pattern.match(part)
+            if m:
+                if node.param is None:
+                    node.param = self.RouteNode()
+                node = node.param
+                arg_names.append(m.group(1))
+            else:
+                node = node.children.setdefault(part, self.RouteNode())
+        methods = frozenset(options.get('methods', ['GET']))
+        order = len(self._handlers)
+        node.handlers.append((order, f, options, methods, tuple(arg_names),
+                              route))
+        node.methods |= methods
+
+    def _match(self, node, parts, index, args, method, matches):
+        if index == len(parts):
+            # Only OPTIONS is answered by handlers of other methods
+            if method in node.methods or method in (None, 'OPTIONS'):
+                matches.extend((handler, args) for handler in node.handlers)
+            return
+        child = node.children.get(parts[index])
+        if child:
+            self._match(child, parts, index + 1, args, method, matches)
+        if node.param:
+            self._match(node.param, parts, index + 1, args + (parts[index],),
+                        method, matches)
+
+    def match(self, path, method=None):
+        """
+        Find (handler, route args) candidates for path in registration order
+        """
+        matches = []
+        self._match(self._routes, path.split('/'), 0, (), method, matches)
+        if len(matches) > 1:
+            matches.sort(key=lambda x: x[0][0])
+        return matches
+
     def __call__(self, environ, respond):
+        if not hooks:
+            return self._call(environ, respond)
+        start = time.perf_counter()
+        statuses = []
+
+        def respond_(status, headers, *args):
+            statuses.append(status[:3])
+            return respond(status, headers, *args)
+
+        try:
+            return self._call(environ, respond_)
+        finally:
+            labels = (('route', environ.get('trustx.route', '')),
+                      ('method', environ['REQUEST_METHOD']),
+                      ('status', statuses[-1] if statuses else '500'))
+            emit('trustx_request_duration_seconds',
+                 time.perf_counter() - start, labels)
+
+    def _call(self, environ, respond):
         self.request.environ = environ
-        route_parts = environ['PATH_INFO'].split('/')
-        n_route_parts = len(route_parts)
-        for route, f, options in self._handlers:
-            route_parts_ = route.split('/')
-            if len(route_parts_) != n_route_parts:
-                continue
-            route_part_matches = []
-            route_args = {}
-            for a, b in zip(route_parts, route_parts_):
-                m = self.route_arg_pattern.match(b)
-                if m:
-                    route_args[m.group(1)] = a
-                    route_part_match = True
-                else:
-                    route_part_match = a == b
-                route_part_matches.append(route_part_match)
-            if not all(route_part_matches):
-                continue
-            method = environ['REQUEST_METHOD'].upper()
-            handler_methods = options.get('methods', ['GET'])
+        method = environ['REQUEST_METHOD'].upper()
+        for handler, arg_values in self.match(environ['PATH_INFO'], method):
+            _, f, options, handler_methods, arg_names, route = handler
             if method not in handler_methods:
                 if method == 'OPTIONS' and options.get('cors', True):
                     allow_methods = ', '.join(self.cors_allow_methods)
@@ -119,19 +354,32 @@ class WSGI:
                     return []
                 continue
 
-            resp = f(**dict(route_args))
+            environ['trustx.route'] = route
+            try:
+                resp = f(**dict(zip(arg_names, arg_values)))
+            except HTTPError as e:
+                resp = '', e.status
             if isinstance(resp, (list, tuple)):
                 content, status = resp[:2]
                 headers = resp[2] if len(resp) >= 3 else []
             else:
                 content, status, headers = resp, 200, []
             self._respond(respond, status, headers)
+            if isinstance(content, bytes):
+                return [content]
             return [(content or '').encode()]
         self._respond(respond, 404)
         return []
 
     def route(self, route, **options):
+        """
+        Register a handler, options are methods, cors and stream
+
+        Handlers of stream=True routes may read request.stream, so the
+        ASGI adapter passes their bodies through instead of buffering.
+        """
         def decorator(f):
+            self._compile(route, f, options)
             self._handlers.append((route, f, options))
             return f
         return decorator
@@ -147,6 +395,14 @@ class WSGI:
     def storage(self, value):
         self._storage = value
 
+    @property
+    def profiles(self):
+        return Profiles(self.storage, cache=self.profile_cache)
+
+    @property
+    def exporter(self):
+        return Exporter(cache=self.render_cache)
+
     @property
     def session(self):
         if hasattr(self, '_session'):
@@ -164,8 +420,7 @@ wsgi = WSGI()
 
 class BlockWithoutSignature:
     def __init__(self, block):
-        self.__dict__ = {k: v for k, v in vars(block).items()
-                         if k != 'signature'}
+        self.__dict__ = dict(by=block.by, to=block.to, data=block.data)
 
 
 def jvars(obj):
@@ -184,8 +439,10 @@ def stringify(value):
         r.update(blocks=value.blocks)
         return r
     if isinstance(value, Blocks):
-        return {base58encode(block.signature): BlockWithoutSignature(block)
-                for block in value}
+        blocks = list(value)
+        signatures = base58encode_many([b.signature for b in blocks])
+        return {signature: BlockWithoutSignature(block)
+                for signature, block in zip(signatures, blocks)}
     try:
         value = jvars(value)
     except TypeError:
@@ -197,7 +454,7 @@ def jsonify(obj):
     return json.dumps(obj, default=stringify)
 
 
-def post(url, **kwargs):
+def _post_request(url, kwargs):
     headers = {'User-Agent': 'TrustX/' + __version__}
     if 'json' in kwargs:
         data = json.dumps(kwargs['json']).encode()
@@ -206,7 +463,11 @@ def post(url, **kwargs):
         data = kwargs['data']
     else:
         data = None
-    req = urllib.request.Request(url, data, headers, method='POST')
+    return urllib.request.Request(url, data, headers, method='POST')
+
+
+def post(url, **kwargs):
+    req = _post_request(url, kwargs)
     try:
         with urllib.request.urlopen(req) as _:
             return True
@@ -215,9 +476,15 @@ def post(url, **kwargs):
     return False
 
 
+def deliver_hook(url, **kwargs):
+    if wsgi.deliveries:
+        return wsgi.deliveries.post(url, **kwargs)
+    return post(url, **kwargs)
+
+
 @wsgi.route('/')
 def index():
-    profile = Profiles(wsgi.storage).get(name='osnk')
+    profile = wsgi.profiles.get(name='osnk')
     print(profile.blocks)
     return jsonify(profile)
 
@@ -256,7 +523,7 @@ def post_password():
             profile_query = dict(hook=hook)
     if not profile_query:
         return '', 400
-    profiles = Profiles(wsgi.storage)
+    profiles = wsgi.profiles
     profile = profiles.get(**profile_query)
     if profile:
         hook = profile.hook
@@ -271,7 +538,7 @@ def post_password():
     session = wsgi.session(hint_type, hint_data, password.encode(), life=SHORT)
     expires = encode_datetime(session.expires)
     hint = base58encode(joinb(session.sign, expires, hint_type, hint_data))
-    if post(hook, json={'text': password}):
+    if deliver_hook(hook, json={'text': password}):
         return jsonify(hint)
     return '', 400
 
@@ -310,7 +577,7 @@ def post_token():
         key = PublicKey(nonce_session.data[0])
         if not key.verify(signature, data=nonce.encode()):
             return '', 403
-        profile_id = bytes.fromhex(Profiles(wsgi.storage).get(key=key).id)
+        profile_id = bytes.fromhex(wsgi.profiles.get(key=key).id)
     return jsonify(wsgi.session(profile_id, life=LONG).token)
 
 
@@ -340,35 +607,29 @@ def post_profile():
     if not wsgi.session.parse(base58encode(token)):
         return '', 403
     hook = hint_data.decode()
-    profiles = Profiles(wsgi.storage)
-    other = profiles.get(hook=hook)
-    if other:
-        return '', 409
-    other = profiles.get(name=name)
-    if other:
-        return '', 409
-    me = Profile()
-    me.name = name
-    me.hook = hook
-    profiles.put(me)
+    profiles = wsgi.profiles
+    # Checked and claimed at once, also against other worker processes
+    with profiles.storage.transaction():
+        if profiles.get(hook=hook) or profiles.get(name=name):
+            return '', 409
+        me = Profile()
+        me.name = name
+        me.hook = hook
+        profiles.put(me)
     token = wsgi.session(bytes.fromhex(me.id), life=LONG).token
     return jsonify(ProfileWithToken(me, token))
 
 
-class HTTPError(Exception):
-    def __init__(self, status, *args, **kwargs):
-        self.status = status
-        super().__init__(*args, **kwargs)
-
-
 def get_profile_from_token():
-    token = wsgi.request.args.get('token', wsgi.request.form.get('token'))
+    token = wsgi.request.args.get('token')
+    if not token:
+        token = wsgi.request.form.get('token')
     if not token:
         raise HTTPError(400)
     session = wsgi.session.parse(token)
     if not session:
         raise HTTPError(403)
-    return Profiles(wsgi.storage).get(id=session.data[0].hex())
+    return wsgi.profiles.get(id=session.data[0].hex())
 
 
 def is_mine(profile, name_or_keyhash):
@@ -376,10 +637,29 @@ def is_mine(profile, name_or_keyhash):
     return name_or_keyhash in id_
 
 
-class OtherProfile:
+class ProfileSummary:
     def __init__(self, profile):
         self.__dict__ = {k: v for k, v in vars(profile).items()
-                         if k in ('id', 'name', 'blocks')}
+                         if k in ('id', 'name')}
+
+
+@wsgi.route('/profiles')
+def get_profiles():
+    try:
+        get_profile_from_token()
+    except HTTPError as e:
+        return '', e.status
+    cursor = wsgi.request.args.get('cursor') or None
+    try:
+        limit = int(wsgi.request.args.get('limit', 20))
+    except ValueError:
+        return '', 400
+    if not 0 < limit <= 100:
+        return '', 400
+    profiles = [ProfileSummary(profile) for profile
+                in wsgi.profiles.scan(cursor, limit)]
+    next_cursor = profiles[-1].id if len(profiles) == limit else None
+    return jsonify(dict(profiles=profiles, cursor=next_cursor))
 
 
 @wsgi.route('/profiles/<name_or_keyhash>')
@@ -388,14 +668,31 @@ def get_profile(name_or_keyhash):
         me = get_profile_from_token()
     except HTTPError as e:
         return '', e.status
+    format = wsgi.request.args.get('format')
+    if not format:
+        accept = wsgi.request.environ.get('HTTP_ACCEPT', '')
+        format = 'yaml' if 'yaml' in accept else 'json'
+    if format not in FORMATS:
+        return '', 400
     if is_mine(me, name_or_keyhash):
-        return jsonify(me)
-    profiles = Profiles(wsgi.storage)
-    other = profiles.get(name=name_or_keyhash)
-    if not other:
-        other = profiles.get(keyhash=name_or_keyhash)
-    if other:
-        return jsonify(OtherProfile(other))
+        profile, view = me, 'owner'
+    else:
+        profiles = wsgi.profiles
+        profile = profiles.get(name=name_or_keyhash)
+        if not profile:
+            profile = profiles.get(keyhash=name_or_keyhash)
+        if not profile:
+            return
+        view = 'public'
+    exporter = wsgi.exporter
+    etag = exporter.etag(profile, view, format)
+    headers = [('ETag', etag), ('Vary', 'Accept')]
+    if_none_match = wsgi.request.environ.get('HTTP_IF_NONE_MATCH', '')
+    tags = [x.strip() for x in if_none_match.split(',')]
+    if '*' in tags or etag in tags or 'W/' + etag in tags:
+        return '', 304, headers
+    return (exporter.render(profile, view, format), 200,
+            headers + [('Content-Type', FORMATS[format])])
 
 
 @wsgi.route('/profiles/<name_or_keyhash>/key', methods=['PUT'])
@@ -418,12 +715,12 @@ def put_profile_key(name_or_keyhash):
     key = PublicKey(nonce_session.data[0])
     if not key.verify(signature, data=nonce.encode()):
         return '', 403
-    profiles = Profiles(wsgi.storage)
-    other = profiles.get(key=key)
-    if other:
-        return '', 409
-    me.key = key
-    profiles.put(me)
+    profiles = wsgi.profiles
+    with profiles.storage.transaction():
+        if profiles.get(key=key):
+            return '', 409
+        me.key = key
+        profiles.put(me)
     return jsonify(me)
 
 
@@ -438,12 +735,12 @@ def put_profile_name(name_or_keyhash):
     name = wsgi.request.form.get('name')
     if not name:
         return '', 400
-    profiles = Profiles(wsgi.storage)
-    other = profiles.get(name=name)
-    if other:
-        return '', 409
-    me.name = name
-    profiles.put(me)
+    profiles = wsgi.profiles
+    with profiles.storage.transaction():
+        if profiles.get(name=name):
+            return '', 409
+        me.name = name
+        profiles.put(me)
     return jsonify(me)
 
 
@@ -466,17 +763,29 @@ def put_profile_hook(name_or_keyhash):
     if not wsgi.session.parse(base58encode(token)):
         return '', 403
     hook = hint_data.decode()
-    profiles = Profiles(wsgi.storage)
-    other = profiles.get(hook=hook)
-    if other:
-        return '', 409
-    me.hook = hook
-    profiles.put(me)
+    profiles = wsgi.profiles
+    with profiles.storage.transaction():
+        if profiles.get(hook=hook):
+            return '', 409
+        me.hook = hook
+        profiles.put(me)
     return jsonify(me)
 
 
-@wsgi.route('/profiles/<name_or_keyhash>/blocks', methods=['PUT'])
+# Request bodies imported as a stream of blocks, with the token in the query
+BLOCKS_CONTENT_TYPES = {'application/yaml': 'yaml',
+                        'application/x-yaml': 'yaml',
+                        'application/jsonl': 'jsonl',
+                        'application/x-ndjson': 'jsonl'}
+
+
+@wsgi.route('/profiles/<name_or_keyhash>/blocks', methods=['PUT'],
+            stream=True)
 def put_profile_blocks(name_or_keyhash):
+    content_type = wsgi.request.content_type.split(';')[0].strip()
+    format = BLOCKS_CONTENT_TYPES.get(content_type)
+    if format and not wsgi.request.args.get('token'):
+        return '', 400
     try:
         me = get_profile_from_token()
     except HTTPError as e:
@@ -485,35 +794,389 @@ def put_profile_blocks(name_or_keyhash):
         return '', 403
     if not me.key:
         return '', 403
-    blocks = wsgi.request.form.get('blocks')
-    if not blocks:
-        return '', 400
-    profiles = Profiles(wsgi.storage)
+    if format:
+        entries = iter_blocks(wsgi.request.stream, format)
+    else:
+        blocks = wsgi.request.form.get('blocks')
+        if not blocks:
+            return '', 400
+        # Files of multipart bodies are bytes
+        stream = (io.BytesIO(blocks) if isinstance(blocks, bytes)
+                  else io.StringIO(blocks))
+        entries = iter_blocks(stream)
+    profiles = wsgi.profiles
+    blocks = Blocks({})
     try:
-        blocks = profiles.parse_blocks(yaml.safe_load(blocks))
-    except ValueError:
-        return '', 400
-    me.blocks.update(blocks)
+        # import_blocks() verifies them already
+        blocks.update(profiles.import_blocks(entries), verify=False)
+    except ValueError as e:
+        return jsonify(dict(error=str(e))), 400
+    me.blocks.update(blocks, verify=False)
     profiles.put(me)
     return jsonify(blocks)
 
 
+@wsgi.route('/metrics')
+def get_metrics():
+    """
+    Metrics in the Prometheus text format, without authentication
+
+    Anyone reaching the server can read them, so restrict /metrics by
+    the network or a reverse proxy where that matters.
+    """
+    if wsgi.metrics is None:
+        return '', 404
+    return (wsgi.metrics.render(), 200,
+            [('Content-Type', Metrics.CONTENT_TYPE)])
+
+
+class ReceivedInput:
+    """
+    WSGI input reading the body of an ASGI request from a handler thread
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self._buffer = bytearray()
+        self._more_body = True
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self.receive(),
+                                                   self.loop).result()
+        if message['type'] != 'http.request':
+            self._more_body = False
+            return
+        self._buffer += message.get('body', b'')
+        self._more_body = message.get('more_body', False)
+
+    def _take(self, size):
+        r = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return r
+
+    def read(self, size=-1):
+        while self._more_body and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        return self._take(len(self._buffer) if size < 0 else size)
+
+    def readline(self, size=-1):
+        while (self._more_body and b'\n' not in self._buffer
+               and (size < 0 or len(self._buffer) < size)):
+            self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        return self._take(end if size < 0 else min(end, size))
+
+
+class ASGI:
+    """
+    ASGI application serving the routes and handlers of a WSGI application
+
+    Handlers run in an executor so signature verification, storage I/O
+    and hook delivery never block the event loop.  Bodies are read into
+    memory up to max_content_length, except those of stream=True routes
+    with a Content-Length, which handlers read as they are received.
+    """
+
+    def __init__(self, app, executor=None):
+        self.app = app
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            raise ValueError(f"unsupported scope type {scope['type']}")
+        length = None
+        for k, v in scope.get('headers', []):
+            if k.lower() == b'content-length':
+                length = int(v) if v.isdigit() else -1
+        if length == -1:
+            return await self._respond_empty(send, 400)
+        request = self.app.request
+        stream = length is not None and any(
+            handler[2].get('stream') for handler, _
+            in self.app.match(scope['path'], scope['method'].upper()))
+        limit = (request.max_stream_length if stream
+                 else request.max_content_length)
+        if length is not None and length > limit:
+            return await self._respond_empty(send, 413)
+        loop = asyncio.get_running_loop()
+        if stream:
+            body = ReceivedInput(receive, loop)
+        else:
+            chunks = []
+            length = 0
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] != 'http.request':
+                    return
+                chunks.append(message.get('body', b''))
+                length += len(chunks[-1])
+                if length > limit:
+                    return await self._respond_empty(send, 413)
+                more_body = message.get('more_body', False)
+            body = io.BytesIO(b''.join(chunks))
+        environ = self.environ(scope, body, length)
+        status, headers, content = await loop.run_in_executor(
+            self.executor, self._call_wsgi, environ)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(k.lower().encode('latin-1'),
+                                 v.encode('latin-1')) for k, v in headers]})
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def _respond_empty(self, send, status):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def environ(self, scope, body, length):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'CONTENT_TYPE': '',
+            'CONTENT_LENGTH': str(length),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': io.StringIO(),
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for k, v in scope.get('headers', []):
+            k, v = k.decode('latin-1'), v.decode('latin-1')
+            if k == 'content-type':
+                environ['CONTENT_TYPE'] = v
+            elif k != 'content-length':
+                k = 'HTTP_' + k.upper().replace('-', '_')
+                environ[k] = f'{environ[k]},{v}' if k in environ else v
+        return environ
+
+    def _call_wsgi(self, environ):
+        response = []
+
+        def respond(status, headers):
+            response[:] = int(status.split(maxsplit=1)[0]), headers
+
+        content = b''.join(self.app(environ, respond))
+        return (*response, content)
+
+
+asgi = ASGI(wsgi)
+
+
+class ASGIServer:
+    """
+    Minimal asyncio HTTP/1.1 server for ASGI applications, mainly for tests
+    """
+
+    # Bytes of the request body passed to the application per message
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, app, host='', port=8000):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host,
+                                                 self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if not self.server:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        self.server.close()
+
+    async def _serve(self, reader, writer):
+        try:
+            while await self._serve_request(reader, writer):
+                pass
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError, ValueError):
+            # Malformed or oversized heads close the connection
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_request(self, reader, writer):
+        head = await reader.readuntil(b'\r\n\r\n')
+        request_line, *header_lines = head.decode('latin-1').split('\r\n')
+        method, target, version = request_line.split()
+        headers = []
+        for line in header_lines:
+            if line:
+                k, v = line.split(':', 1)
+                headers.append((k.strip().lower().encode('latin-1'),
+                                v.strip().encode('latin-1')))
+        fields = dict(headers)
+        remaining = int(fields.get(b'content-length', 0))
+        if remaining < 0:
+            raise ValueError('negative Content-Length')
+        path, _, query = target.partition('?')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': version.split('/')[1],
+            'method': method.upper(),
+            'scheme': 'http',
+            'path': urllib.parse.unquote(path),
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': headers,
+            'client': writer.get_extra_info('peername')[:2],
+            'server': writer.get_extra_info('sockname')[:2],
+        }
+        received = False
+        response = {}
+
+        async def receive():
+            # The body is read as the application asks for it
+            nonlocal received, remaining
+            if received:
+                return {'type': 'http.disconnect'}
+            body = b''
+            if remaining:
+                body = await reader.read(min(remaining, self.CHUNK_SIZE))
+                if not body:
+                    received = True
+                    return {'type': 'http.disconnect'}
+                remaining -= len(body)
+            received = not remaining
+            return {'type': 'http.request', 'body': body,
+                    'more_body': bool(remaining)}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response.update(status=message['status'],
+                                headers=message.get('headers', []), body=[])
+            elif message['type'] == 'http.response.body':
+                response['body'].append(message.get('body', b''))
+
+        try:
+            await self.app(scope, receive, send)
+        except Exception:
+            traceback.print_exc()
+            response.update(status=500, headers=[], body=[])
+        content = b''.join(response['body'])
+        status = response['status']
+        # Unread body bytes would be taken for the next request
+        keep_alive = (fields.get(b'connection', b'').lower() != b'close'
+                      and not remaining)
+        lines = [f'HTTP/1.1 {status} {WSGI.statuses.get(status, "")}'.encode()]
+        lines += [k + b': ' + v for k, v in response['headers']
+                  if k not in (b'content-length', b'connection')]
+        lines.append(f'Content-Length: {len(content)}'.encode())
+        lines.append(b'Connection: ' + (b'keep-alive' if keep_alive
+                                        else b'close'))
+        writer.write(b'\r\n'.join(lines) + b'\r\n\r\n' + content)
+        await writer.drain()
+        return keep_alive
+
+
+def setup_from_environ(app=wsgi):
+    import os
+    from . import metrics, verifying_keys
+    from .deliveries import Deliveries
+    from .storages import LocalStorage
+    app.storage = LocalStorage()
+    secret = os.environ['TRUSTX_SESSION_SECRET'].encode('utf-8')
+    app.session = HMACSessionFactory(secret, cache=TTLCache(4096, ttl=300))
+    app.profile_cache = TTLCache(4096, ttl=5)
+    app.render_cache = TTLCache(1024, ttl=300)
+    app.deliveries = Deliveries(
+        wait=os.environ.get('TRUSTX_HOOK_WAIT', '1') != '0')
+    if os.environ.get('TRUSTX_METRICS', '0') != '0':
+        app.metrics = metrics.enable(Metrics())
+        app.storage = metrics.InstrumentedStorage(app.storage)
+        app.metrics.add_cache('sessions', app.session.cache)
+        app.metrics.add_cache('profiles', app.profile_cache)
+        app.metrics.add_cache('renders', app.render_cache)
+        app.metrics.add_cache('verifying_keys', verifying_keys)
+        app.metrics.add_stats('trustx_deliveries', app.deliveries.stats)
+
+
+def teardown(app=wsgi):
+    if app.deliveries:
+        app.deliveries.close()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest='type', required=True)
     subparser = subparsers.add_parser('wsgi')
-    subparser.add_argument('--port', default=8000)
+    subparser.add_argument('--host', default='')
+    subparser.add_argument('--port', type=int, default=8000)
+    subparser.add_argument('--workers', type=int,
+                           help='pre-forked worker processes')
+    subparser.add_argument('--threads', type=int, default=1,
+                           help='request threads per worker')
+    subparser.add_argument('--graceful-timeout', type=float, default=30)
+    subparser.add_argument('--access-log', action='store_true')
+    subparser.add_argument('--profile-dir', type=pathlib.Path,
+                           help='write sampled stack profiles here')
+    subparser.add_argument('--profile-rate', type=float, default=0.01,
+                           help='fraction of requests profiled')
+    subparser.add_argument('--profile-threshold', type=float, default=1.0,
+                           help='profile requests taking this many seconds')
+    subparser = subparsers.add_parser('asgi')
+    subparser.add_argument('--port', type=int, default=8000)
     args = parser.parse_args()
-    if args.type == 'wsgi':
-        import os
+    app = wsgi
+    if getattr(args, 'profile_dir', None):
+        from .profilers import Profiler
+        app = Profiler(wsgi, args.profile_dir, rate=args.profile_rate,
+                       threshold=args.profile_threshold)
+    if args.type == 'wsgi' and (args.workers or args.threads > 1):
+        from .runners import PreforkServer
+        server = PreforkServer(app, args.host, args.port, args.workers,
+                               args.threads,
+                               setup=lambda _: setup_from_environ(wsgi),
+                               teardown=lambda _: teardown(wsgi),
+                               graceful_timeout=args.graceful_timeout,
+                               access_log=args.access_log).bind()
+        print(f'Serving HTTP on port {server.port} with {server.workers}'
+              f' workers, control-C to stop', flush=True)
+        server.serve_forever()
+        print('Shutting down.')
+    elif args.type == 'wsgi':
         import wsgiref.simple_server
-        from .storages import LocalStorage
-        wsgi.storage = LocalStorage()
-        secret = os.environ['TRUSTX_SESSION_SECRET'].encode('utf-8')
-        wsgi.session = HMACSessionFactory(secret)
-        with wsgiref.simple_server.make_server('', args.port, wsgi) as httpd:
+        setup_from_environ()
+        with wsgiref.simple_server.make_server(args.host, args.port,
+                                               app) as httpd:
             print(f'Serving HTTP on port {args.port}, control-C to stop')
             try:
                 httpd.serve_forever()
             except KeyboardInterrupt:
                 print('Shutting down.')
+    if args.type == 'asgi':
+        setup_from_environ()
+        print(f'Serving HTTP on port {args.port}, control-C to stop')
+        try:
+            asyncio.run(ASGIServer(asgi, port=args.port).serve_forever())
+        except KeyboardInterrupt:
+            print('Shutting down.')
@@ -4,12 +4,17 @@ import hmac
 from . import base58decode, base58encode, hashfunc
 
 
+_SMALL_7BIT = [bytes((i,)) for i in range(0x80)]
+
+
 def encode_to_7bit(value):
     """
     Encode unsigned int to 7-bit str data
     """
-    data = []
     number = abs(value)
+    if number < 0x80:
+        return _SMALL_7BIT[number]
+    data = []
     while number >= 0x80:
         data.append((number | 0x80) & 0xff)
         number >>= 7
@@ -17,14 +22,18 @@ def encode_to_7bit(value):
     return bytes(data)
 
 
-def decode_from_7bit(data):
+def decode_from_7bit(data, offset=0):
     """
     Decode 7-bit encoded int from str data
     """
+    end = len(data)
+    if offset < end and data[offset] < 0x80:
+        return data[offset], 1
     decoded = 0
     n_consumed = 0
-    for index, byte in enumerate(data):
-        decoded |= (byte & 0x7f) << (7 * index)
+    for index in range(offset, end):
+        byte = data[index]
+        decoded |= (byte & 0x7f) << (7 * n_consumed)
         n_consumed += 1
         if byte & 0x80 == 0:
             break
@@ -32,15 +41,37 @@ def decode_from_7bit(data):
 
 
 def joinb(*args):
-    return b''.join(encode_to_7bit(len(x)) + x for x in args)
+    parts = []
+    for x in args:
+        parts.append(encode_to_7bit(len(x)))
+        parts.append(x)
+    return b''.join(parts)
 
 
 def splitb(data):
-    while data:
-        length, n_consumed = decode_from_7bit(data)
-        s, e = n_consumed, n_consumed + length
-        yield data[s:e]
-        data = data[e:]
+    """
+    Split joinb() data in one pass into fields sliced from data
+    """
+    fields = []
+    end = len(data)
+    offset = 0
+    while offset < end:
+        length = data[offset]
+        if length < 0x80:
+            offset += 1
+        else:
+            length, n_consumed = decode_from_7bit(data, offset)
+            offset += n_consumed
+        fields.append(data[offset:offset + length])
+        offset += length
+    return fields
+
+
+def split(data):
+    """
+    Split joinb() data into memoryview fields without copying
+    """
+    return splitb(memoryview(data))
 
 
 def encode_datetime(value):
@@ -52,10 +83,20 @@ def decode_datetime(data):
 
 
 class HMACSessionFactory:
-    def __init__(self, secret, now=None, life=None):
+    def __init__(self, secret, now=None, life=None, cache=None):
         self.secret = secret
         self.now = now if now else datetime.datetime.now
         self.life = life if life else datetime.timedelta(days=1)
+        # Optional TTLCache of verified sessions by token digest
+        self.cache = cache
+        self._hmac = hmac.new(secret, digestmod=hashfunc)
+
+    def _sign(self, *parts):
+        # Copying the keyed HMAC skips deriving the key pads per token
+        h = self._hmac.copy()
+        for part in parts:
+            h.update(part)
+        return h.digest()
 
     def __call__(self, *data, life=None):
         r = Session()
@@ -64,25 +105,34 @@ class HMACSessionFactory:
         r.expires = self.now() + (life or self.life)
         expires = encode_datetime(self.now() + (life or self.life))
         r.expires = decode_datetime(expires)
-        message = expires + b''.join(r.data)
-        r.sign = hmac.new(self.secret, message, hashfunc).digest()
+        r.sign = self._sign(expires, *r.data)
         r.valid = True
         r.token = base58encode(joinb(r.sign, expires, *r.data))
         return r
 
     def parse(self, token):
+        if self.cache is None or not isinstance(token, str):
+            return self._parse(token)
+        digest = hashfunc(token.encode()).digest()
+        r = self.cache.get(digest)
+        if r:
+            return r
+        r = self._parse(token)
+        if r:
+            life = (r.expires - self.now()).total_seconds()
+            self.cache.put(digest, r, life)
+        return r
+
+    def _parse(self, token):
         r = Session()
         r.now = self.now
         r.token = token
         try:
-            token = base58decode(r.token)
-            r.sign, expires, *data = splitb(token)
+            r.sign, expires, *data = splitb(base58decode(r.token))
             ts = int.from_bytes(expires, 'big')
             r.expires = datetime.datetime.fromtimestamp(ts)
             r.data = tuple(data)
-            message = expires + b''.join(r.data)
-            sign = hmac.new(self.secret, message, hashfunc)
-            r.valid = r.sign == sign.digest()
+            r.valid = hmac.compare_digest(r.sign, self._sign(expires, *data))
         except Exception:
             pass
         return r
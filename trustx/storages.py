@@ -1,67 +1,791 @@
+import atexit
+import bisect
+import contextlib
+import datetime
+import heapq
+import io
+import os
 import pathlib
 import pickle
+import sqlite3
+import struct
+import threading
+import time
 import uuid
+import weakref
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class PickleCodec:
+    name = 'pickle'
+    suffix = '.pickle'
+
+    def dumps(self, entity):
+        return pickle.dumps(entity)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class _EntityPickler(pickle.Pickler):
+    def reducer_override(self, value):
+        # Called for values other than plain builtins, such as datetimes
+        cls = value.__class__
+        if cls is datetime.datetime and value.tzinfo is not None \
+                and value.tzinfo.__class__ is not datetime.timezone:
+            # Other tzinfo such as zoneinfo are stored as their offset
+            value = value.replace(
+                tzinfo=datetime.timezone(value.utcoffset()))
+            return value.__reduce_ex__(BinaryCodec.PROTOCOL)
+        classes = BinaryCodec.CLASSES.values()
+        if cls in classes or cls is bytearray \
+                or cls is type and value in classes:
+            return NotImplemented
+        raise TypeError(f'cannot encode {cls.__name__}')
+
+
+class _EntityUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        cls = BinaryCodec.CLASSES.get((module, name))
+        if cls is None:
+            raise pickle.UnpicklingError(f'forbidden class {module}.{name}')
+        return cls
+
+
+class BinaryCodec:
+    """
+    Entities as pickles of plain data behind a versioned header
+
+    Pickles are decoded by the C unpickler, but only the classes in
+    CLASSES are looked up, so loading runs none of the writer's code.
+    Values other than builtin containers and scalars and those classes
+    raise TypeError when dumped.
+    """
+
+    name = 'binary'
+    suffix = '.entity'
+    MAGIC = b'TXE'
+    VERSION = 1
+    PROTOCOL = 5
+
+    CLASSES = {('datetime', cls.__name__): cls for cls in (
+        datetime.datetime, datetime.date, datetime.timezone,
+        datetime.timedelta)}
+
+    _HEADER = MAGIC + bytes((VERSION,))
+    # Pickles start with the PROTO opcode and their protocol
+    _PAYLOAD = b'\x80' + bytes((PROTOCOL,))
+
+    def dumps(self, entity):
+        f = io.BytesIO()
+        f.write(self._HEADER)
+        _EntityPickler(f, self.PROTOCOL).dump(entity)
+        return f.getvalue()
+
+    def loads(self, data):
+        if data[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError('not a binary entity')
+        version = data[len(self.MAGIC)]
+        if version != self.VERSION:
+            raise ValueError(f'unsupported binary entity version {version}')
+        f = io.BytesIO(data)
+        f.seek(len(self._HEADER))
+        if f.read(len(self._PAYLOAD)) != self._PAYLOAD:
+            raise ValueError('malformed binary entity')
+        f.seek(len(self._HEADER))
+        try:
+            return _EntityUnpickler(f).load()
+        except (pickle.UnpicklingError, EOFError, TypeError) as e:
+            raise ValueError(f'malformed binary entity: {e}') from None
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec(), PickleCodec())}
+
+
+def detect_codec(data):
+    if data[:len(BinaryCodec.MAGIC)] == BinaryCodec.MAGIC:
+        return CODECS['binary']
+    return CODECS['pickle']
+
+
+def decode_entity(data, pickled=False):
+    """
+    Decode entity data written by any of the CODECS
+
+    Loading a pickle runs code of the writer's choosing, so pickles are
+    only decoded if pickled is true: by kinds configured with the pickle
+    codec, and by migrate() for files written by it.  Other data which
+    is not in the binary format raises ValueError.
+    """
+    codec = detect_codec(data)
+    if codec is CODECS['pickle'] and not pickled:
+        raise ValueError('not a binary entity, pickled entities are only'
+                         ' read by migrate() or with the pickle codec')
+    return codec.loads(data)
 
 
 class Kind:
+    def __iter__(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
     def get(self, id):
         raise NotImplementedError
 
     def put(self, entity):
         raise NotImplementedError
 
+    def delete(self, id):
+        raise NotImplementedError
+
+    def scan(self, start_after=None, limit=None):
+        """
+        Iterate entities in id order after the start_after cursor
+
+        Entities deleted while scanning are replaced by the following ones,
+        so fewer than limit entities are only yielded at the end.
+        """
+        while limit is None or limit > 0:
+            n_requested = limit
+            ids = self._scan_ids(start_after, n_requested)
+            for id in ids:
+                # The cursor is the last id examined, found or not
+                start_after = id
+                entity = self.get(id)
+                if entity is not None:
+                    yield entity
+                    if limit is not None:
+                        limit -= 1
+            if limit is None or len(ids) < n_requested:
+                return
+
+    def _scan_ids(self, start_after=None, limit=None):
+        raise NotImplementedError
+
+    def items(self):
+        for entity in self:
+            yield entity['id'], entity
+
+
+def write_atomic(path, data):
+    """
+    Write a file seen whole or not at all, returning whether it was created
+
+    None is returned where hard links are not supported, as it is unknown.
+    """
+    tmp_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        tmp_path.write_bytes(data)
+        try:
+            # Fails if the path exists, unlike os.replace()
+            os.link(tmp_path, path)
+        except FileExistsError:
+            os.replace(tmp_path, path)
+            return False
+        except OSError:
+            os.replace(tmp_path, path)
+            return None
+        tmp_path.unlink()
+        return True
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            tmp_path.unlink()
+        raise
+
+
+def get_codec(codec=None):
+    if codec is None:
+        return CODECS['binary']
+    return CODECS[codec] if isinstance(codec, str) else codec
+
 
 class LocalStorageKind(Kind):
-    ENTITY_PATH_SUFFIX = '.pickle'
+    ENTITY_PATH_SUFFIXES = {codec.suffix for codec in CODECS.values()}
 
-    def __init__(self, path):
+    def __init__(self, path, codec=None):
         self.path = path
+        self.codec = get_codec(codec)
+        self.pickled = isinstance(self.codec, PickleCodec)
+        self._count = None
+        self._lock = threading.Lock()
 
     def _iter_entity_path(self):
         for path in self.path.iterdir():
-            if path.is_file() and path.suffix == self.ENTITY_PATH_SUFFIX:
+            if path.is_file() and path.suffix in self.ENTITY_PATH_SUFFIXES:
                 yield path
 
     def __iter__(self):
         for path in self._iter_entity_path():
-            yield pickle.load(path.open('br'))
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                continue
+            yield decode_entity(data, self.pickled)
+
+    def _scan_ids(self, start_after=None, limit=None):
+        # Only the next page of ids is held, however large the directory is
+        with os.scandir(self.path) as entries:
+            names = (os.path.splitext(entry.name) for entry in entries
+                     if entry.is_file())
+            ids = (id for id, suffix in names
+                   if suffix in self.ENTITY_PATH_SUFFIXES)
+            if start_after is not None:
+                ids = (id for id in ids if id > start_after)
+            if limit is None:
+                return sorted(set(ids))
+            # An id is listed twice while it is migrated to another codec
+            page = []
+            for id in ids:
+                if len(page) == limit and id >= page[-1]:
+                    continue
+                i = bisect.bisect_left(page, id)
+                if i < len(page) and page[i] == id:
+                    continue
+                page.insert(i, id)
+                if len(page) > limit:
+                    page.pop()
+            return page
 
     def __len__(self):
-        return len(list(self._iter_entity_path()))
+        # Counted once, then maintained by put() and delete() of this process
+        if self._count is None:
+            with self._lock:
+                if self._count is None:
+                    self._count = sum(1 for _ in self._iter_entity_path())
+        return self._count
 
-    def _get_entity_path(self, id):
-        return (self.path / str(id)).with_suffix(self.ENTITY_PATH_SUFFIX)
+    def _get_entity_path(self, id, suffix=None):
+        path = self.path / str(id)
+        return path.with_suffix(suffix or self.codec.suffix)
 
-    def get(self, id):
+    def _find_entity_path(self, id):
         path = self._get_entity_path(id)
         if path.is_file():
-            return pickle.load(path.open('br'))
+            return path
+        # Entities written by another codec until they are migrated
+        for suffix in self.ENTITY_PATH_SUFFIXES - {self.codec.suffix}:
+            path = self._get_entity_path(id, suffix)
+            if path.is_file():
+                return path
+
+    def get(self, id):
+        path = self._find_entity_path(id)
+        if path:
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                # Deleted by another thread or process since it was found
+                return None
+            return decode_entity(data, self.pickled)
 
     def put(self, entity):
         if 'id' not in entity:
             entity['id'] = uuid.uuid4().hex
+        old_path = self._find_entity_path(entity['id'])
         path = self._get_entity_path(entity['id'])
-        pickle.dump(entity, path.open('bw'))
+        created = write_atomic(path, self.codec.dumps(entity))
+        if old_path and old_path != path:
+            with contextlib.suppress(FileNotFoundError):
+                old_path.unlink()
+        if self._count is not None:
+            with self._lock:
+                if created is None:
+                    # Counted again by the next len()
+                    self._count = None
+                elif created and not old_path:
+                    self._count += 1
 
     def delete(self, id):
-        self._get_entity_path(id).unlink()
+        path = self._find_entity_path(id)
+        if not path:
+            raise FileNotFoundError(self._get_entity_path(id))
+        path.unlink()
+        if self._count is not None:
+            with self._lock:
+                self._count -= 1
+
+    def migrate(self):
+        n_migrated = 0
+        for path in list(self._iter_entity_path()):
+            data = path.read_bytes()
+            new_path = path.with_suffix(self.codec.suffix)
+            if new_path != path or detect_codec(data) is not self.codec:
+                # Only files named by the pickle codec may hold pickles
+                pickled = self.pickled or path.suffix == PickleCodec.suffix
+                entity = decode_entity(data, pickled)
+                write_atomic(new_path, self.codec.dumps(entity))
+                if new_path != path:
+                    path.unlink()
+                n_migrated += 1
+        return n_migrated
+
+
+# Storages whose transaction state is reset in forked children
+_local_storages = weakref.WeakSet()
+
+
+def _reset_local_storages():
+    for storage in list(_local_storages):
+        storage._reset_transaction()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_local_storages)
 
 
 class LocalStorage:
     kind_class = LocalStorageKind
 
-    def __init__(self, path=pathlib.Path.cwd() / 'storage'):
+    LOCK_NAME = '.lock'
+
+    # Kinds of every process see the writes of the others
+    multiprocess = True
+
+    def __init__(self, path=pathlib.Path.cwd() / 'storage', **options):
         self.path = path
         self.path.mkdir(parents=True, exist_ok=True)
+        self.options = options
+        self._kinds = {}
+        self._kinds_lock = threading.Lock()
+        self._reset_transaction()
+        _local_storages.add(self)
 
     def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
         return self[name.replace('_', '-')]
 
     def __getitem__(self, key):
-        for path in self.path.iterdir():
-            if path.is_dir() and path.name == key:
-                break
+        kind = self._kinds.get(key)
+        if kind is None:
+            with self._kinds_lock:
+                kind = self._kinds.get(key)
+                if kind is None:
+                    path = self.path / key
+                    path.mkdir(exist_ok=True)
+                    kind = self.kind_class(path, **self.options)
+                    self._kinds[key] = kind
+        return kind
+
+    def kinds(self):
+        return sorted(path.name for path in self.path.iterdir()
+                      if path.is_dir())
+
+    def _reset_transaction(self):
+        # A forked child must not share the lock or the file description
+        self._tx_lock = threading.RLock()
+        self._tx_depth = 0
+        self._tx_file = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Serialize transactions of every thread and process on the storage
+        """
+        with self._tx_lock:
+            if self._tx_file is None and fcntl:
+                self._tx_file = (self.path / self.LOCK_NAME).open('ab')
+            self._tx_depth += 1
+            try:
+                if self._tx_depth == 1 and self._tx_file:
+                    fcntl.flock(self._tx_file, fcntl.LOCK_EX)
+                yield self
+            finally:
+                if self._tx_depth == 1 and self._tx_file:
+                    fcntl.flock(self._tx_file, fcntl.LOCK_UN)
+                self._tx_depth -= 1
+
+
+class LogStorageKind(Kind):
+    """
+    Kind backed by a single append-only segment file with an offset index
+    """
+
+    SEGMENT_NAME = 'segment.log'
+
+    # op, crc32, id length, value length
+    RECORD_HEADER = struct.Struct('>BIII')
+    PUT = 1
+    DELETE = 2
+
+    def __init__(self, path, codec=None, sync_every=64, sync_interval=1.0,
+                 compact_min_bytes=1 << 20, compact_ratio=0.5):
+        self.path = path
+        self.codec = get_codec(codec)
+        self.pickled = isinstance(self.codec, PickleCodec)
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_min_bytes = compact_min_bytes
+        self.compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        self._open()
+        atexit.register(self.sync)
+
+    @property
+    def segment_path(self):
+        return self.path / self.SEGMENT_NAME
+
+    def _open(self):
+        flags = os.O_RDWR | os.O_CREAT | os.O_APPEND
+        self._fd = os.open(self.segment_path, flags, 0o644)
+        self._index = {}
+        self._dead = 0
+        self._end = self._load()
+        self._pending = 0
+        self._synced = time.monotonic()
+
+    def _load(self):
+        header = self.RECORD_HEADER
+        offset = 0
+        with open(self._fd, 'rb', closefd=False) as f:
+            f.seek(0)
+            while True:
+                head = f.read(header.size)
+                if len(head) < header.size:
+                    break
+                op, crc, id_length, value_length = header.unpack(head)
+                body = f.read(id_length + value_length)
+                if len(body) < id_length + value_length:
+                    break
+                if zlib.crc32(head[:1] + body) != crc:
+                    break
+                id = body[:id_length].decode()
+                self._drop(id)
+                if op == self.PUT:
+                    value_offset = offset + header.size + id_length
+                    self._index[id] = value_offset, value_length
+                else:
+                    self._dead += header.size + id_length
+                offset += header.size + id_length + value_length
+        if offset < os.fstat(self._fd).st_size:
+            # Torn or corrupt tail left by a crash, drop it
+            os.ftruncate(self._fd, offset)
+            os.fsync(self._fd)
+        return offset
+
+    def _drop(self, id):
+        if id in self._index:
+            _, value_length = self._index.pop(id)
+            self._dead += self.RECORD_HEADER.size + len(id.encode())
+            self._dead += value_length
+
+    def _append(self, op, id, value=b''):
+        id_bytes = id.encode()
+        body = id_bytes + value
+        crc = zlib.crc32(op.to_bytes(1, 'big') + body)
+        head = self.RECORD_HEADER.pack(op, crc, len(id_bytes), len(value))
+        os.write(self._fd, head + body)
+        offset = self._end
+        self._end += len(head) + len(body)
+        self._pending += 1
+        return offset + len(head) + len(id_bytes)
+
+    def _after_write(self):
+        now = time.monotonic()
+        if (self._pending >= self.sync_every
+                or now - self._synced >= self.sync_interval):
+            self.sync()
+        if (self._dead >= self.compact_min_bytes
+                and self._dead >= self._end * self.compact_ratio):
+            self.compact()
+
+    def __iter__(self):
+        with self._lock:
+            ids = list(self._index)
+        for id in ids:
+            entity = self.get(id)
+            if entity is not None:
+                yield entity
+
+    def __len__(self):
+        return len(self._index)
+
+    def _scan_ids(self, start_after=None, limit=None):
+        with self._lock:
+            ids = iter(self._index)
+            if start_after is not None:
+                ids = (id for id in ids if id > start_after)
+            if limit is None:
+                return sorted(ids)
+            return heapq.nsmallest(limit, ids)
+
+    def __contains__(self, id):
+        return str(id) in self._index
+
+    def get(self, id):
+        with self._lock:
+            location = self._index.get(str(id))
+            if location:
+                offset, length = location
+                data = os.pread(self._fd, length, offset)
+                return decode_entity(data, self.pickled)
+
+    def put(self, entity):
+        if 'id' not in entity:
+            entity['id'] = uuid.uuid4().hex
+        id = str(entity['id'])
+        value = self.codec.dumps(entity)
+        with self._lock:
+            offset = self._append(self.PUT, id, value)
+            self._drop(id)
+            self._index[id] = offset, len(value)
+            self._after_write()
+
+    def delete(self, id):
+        id = str(id)
+        with self._lock:
+            if id not in self._index:
+                raise KeyError(id)
+            self._append(self.DELETE, id)
+            self._drop(id)
+            self._dead += self.RECORD_HEADER.size + len(id.encode())
+            self._after_write()
+
+    def sync(self):
+        with self._lock:
+            if self._pending and self._fd is not None:
+                os.fsync(self._fd)
+                self._pending = 0
+            self._synced = time.monotonic()
+
+    def compact(self, reencode=False):
+        with self._lock:
+            tmp_path = self.segment_path.with_suffix('.compact')
+            with tmp_path.open('wb') as f:
+                for id, (offset, length) in self._index.items():
+                    id_bytes = id.encode()
+                    value = os.pread(self._fd, length, offset)
+                    if reencode and detect_codec(value) is not self.codec:
+                        # Only reencoded by migrate()
+                        entity = decode_entity(value, pickled=True)
+                        value = self.codec.dumps(entity)
+                    body = id_bytes + value
+                    crc = zlib.crc32(self.PUT.to_bytes(1, 'big') + body)
+                    f.write(self.RECORD_HEADER.pack(self.PUT, crc,
+                                                    len(id_bytes), len(value)))
+                    f.write(body)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.segment_path)
+            dir_fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            os.close(self._fd)
+            self._open()
+
+    def migrate(self):
+        n_migrated = sum(1 for offset, length in self._index.values()
+                         if detect_codec(os.pread(self._fd, 4, offset))
+                         is not self.codec)
+        if n_migrated:
+            self.compact(reencode=True)
+        return n_migrated
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+
+
+class LogStorage(LocalStorage):
+    kind_class = LogStorageKind
+
+    # The offset index of a kind only knows the writes of its own process
+    multiprocess = False
+
+
+class SQLiteKind(Kind):
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self._table = '"' + name.replace('"', '""') + '"'
+        with storage.transaction() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {self._table}'
+                         ' (id TEXT PRIMARY KEY, entity BLOB NOT NULL)'
+                         ' WITHOUT ROWID')
+
+    def __iter__(self):
+        conn = self.storage.connection
+        for entity, in conn.execute(f'SELECT entity FROM {self._table}'):
+            yield decode_entity(entity, self.storage.pickled)
+
+    def __len__(self):
+        conn = self.storage.connection
+        row = conn.execute(f'SELECT COUNT(*) FROM {self._table}').fetchone()
+        return row[0]
+
+    def scan(self, start_after=None, limit=None):
+        conn = self.storage.connection
+        rows = conn.execute(f'SELECT entity FROM {self._table}'
+                            ' WHERE id > ? ORDER BY id LIMIT ?',
+                            ('' if start_after is None else str(start_after),
+                             -1 if limit is None else limit))
+        for entity, in rows:
+            yield decode_entity(entity, self.storage.pickled)
+
+    def get(self, id):
+        conn = self.storage.connection
+        row = conn.execute(f'SELECT entity FROM {self._table} WHERE id = ?',
+                           (str(id),)).fetchone()
+        if row:
+            return decode_entity(row[0], self.storage.pickled)
+
+    def put(self, entity):
+        if 'id' not in entity:
+            entity['id'] = uuid.uuid4().hex
+        with self.storage.transaction() as conn:
+            conn.execute(f'INSERT OR REPLACE INTO {self._table} VALUES (?, ?)',
+                         (str(entity['id']), self.storage.codec.dumps(entity)))
+
+    def delete(self, id):
+        with self.storage.transaction() as conn:
+            cursor = conn.execute(f'DELETE FROM {self._table} WHERE id = ?',
+                                  (str(id),))
+            if not cursor.rowcount:
+                raise KeyError(id)
+
+    def migrate(self):
+        n_migrated = 0
+        codec = self.storage.codec
+        with self.storage.transaction() as conn:
+            rows = conn.execute(f'SELECT id, entity FROM {self._table}')
+            for id, data in rows.fetchall():
+                if detect_codec(data) is not codec:
+                    entity = decode_entity(data, pickled=True)
+                    conn.execute(f'UPDATE {self._table} SET entity = ?'
+                                 ' WHERE id = ?', (codec.dumps(entity), id))
+                    n_migrated += 1
+        return n_migrated
+
+
+class SQLiteStorage:
+    """
+    Storage in one SQLite database with a pooled connection per thread
+    """
+
+    kind_class = SQLiteKind
+
+    multiprocess = True
+
+    def __init__(self, path=pathlib.Path.cwd() / 'storage.sqlite3',
+                 codec=None, synchronous='FULL', timeout=30):
+        self.path = path
+        self.codec = get_codec(codec)
+        self.pickled = isinstance(self.codec, PickleCodec)
+        self.synchronous = synchronous
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._kinds = {}
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None or self._local.pid != os.getpid():
+            # close() may be called from any thread of the process
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={self.synchronous}')
+            self._local.connection = conn
+            self._local.pid = os.getpid()
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append((os.getpid(), conn))
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.connection
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        finally:
+            self._local.depth = 0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name.replace('_', '-')]
+
+    def __getitem__(self, key):
+        kind = self._kinds.get(key)
+        if kind is None:
+            kind = self.kind_class(self, key)
+            # The table may still be rolled back with an open transaction
+            if not getattr(self._local, 'depth', 0):
+                self._kinds[key] = kind
+        return kind
+
+    def kinds(self):
+        rows = self.connection.execute("SELECT name FROM sqlite_master"
+                                       " WHERE type = 'table' ORDER BY name")
+        return [name for name, in rows]
+
+    def close(self):
+        """
+        Close the connections of every thread of this process
+
+        Connections inherited from a parent process are left to it, and
+        kept referenced so that they are not closed when collected.
+        """
+        pid = os.getpid()
+        with self._lock:
+            for conn_pid, conn in self._connections:
+                if conn_pid == pid:
+                    conn.close()
+            self._connections = [(conn_pid, conn) for conn_pid, conn
+                                 in self._connections if conn_pid != pid]
+        self._local = threading.local()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    storage_classes = dict(local=LocalStorage, log=LogStorage,
+                           sqlite=SQLiteStorage)
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparser = subparsers.add_parser('migrate')
+    subparser.add_argument('--layout', choices=list(storage_classes),
+                           default='local')
+    subparser.add_argument('--codec', choices=list(CODECS), default='binary')
+    subparser.add_argument('path', type=pathlib.Path, nargs='?')
+
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        storage_class = storage_classes[args.layout]
+        if args.path:
+            storage = storage_class(args.path, codec=args.codec)
         else:
-            path = self.path / key
-            path.mkdir()
-        return self.kind_class(path)
+            storage = storage_class(codec=args.codec)
+        for name in storage.kinds():
+            print(name, storage[name].migrate())